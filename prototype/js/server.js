@@ -6,8 +6,16 @@ const os = require('os');
 // change to websockets because streaming over http is a pain
 const WebSocket = require('ws');
 
+let LLAMA = null;
 let MODEL = null;
 let MODEL_PATH = ""
+// grammars built from json schemas, building them is not free and the same schemas come in every turn
+const JSON_SCHEMA_GRAMMARS = new Map();
+// context kept alive between generations that ask for it, so the evaluated prompt prefix
+// can be reused by the next generation instead of being prefilled again
+let PERSISTENT_CONTEXT = null;
+let PERSISTENT_SEQUENCE = null;
+let PERSISTENT_CONTEXT_BUSY = false;
 async function load_model(model) {
     console.log("Loading model:", model);
     if (MODEL_PATH === model && MODEL !== null) {
@@ -15,6 +23,15 @@ async function load_model(model) {
         return;
     }
 
+    if (PERSISTENT_CONTEXT !== null) {
+        try {
+            await PERSISTENT_CONTEXT.dispose();
+        } catch {
+        }
+        PERSISTENT_CONTEXT = null;
+        PERSISTENT_SEQUENCE = null;
+    }
+
     if (MODEL !== null) {
         console.log('Unloading previous model');
         await MODEL.dispose();
@@ -24,6 +41,10 @@ async function load_model(model) {
 
     const { getLlama } = await import('node-llama-cpp');
     const llama = await getLlama();
+    if (LLAMA !== llama) {
+        JSON_SCHEMA_GRAMMARS.clear();
+    }
+    LLAMA = llama;
     
     console.log('GPU Support:', llama.gpu || 'Unknown');
     console.log('Build Info:', llama.buildInfo);
@@ -45,7 +66,110 @@ async function load_model(model) {
 
 const wss = new WebSocket.Server({ port: 8000 });
 
-async function generateCompletion(data, onToken, onDone, onError) {
+async function classifyCompletion(data) {
+    // scores the candidate labels from the distribution of the next token after the prompt, a single
+    // forward pass instead of sampling an answer and guessing which label it was
+    // labels is an object of label name -> list of ways of writing it, only their first token counts
+    const context = await MODEL.createContext();
+    try {
+        const sequence = context.getSequence();
+        const tokens = MODEL.tokenize(data.prompt);
+        if (MODEL.tokens.bos !== null && MODEL.tokens.bos !== undefined) {
+            tokens.unshift(MODEL.tokens.bos);
+        }
+        const lastToken = tokens.pop();
+        const input = [...tokens, [lastToken, {
+            generateNext: {
+                probabilities: true,
+                options: { temperature: 1, topK: 40, topP: 1, minP: 0 },
+            },
+        }]];
+        const result = await sequence.controlledEvaluate(input);
+        const nextProbabilities = result[result.length - 1].next.probabilities;
+
+        // a token shared by several labels would be counted for all of them, warn so the labels get fixed
+        const tokenOwners = new Map();
+        const labelTokens = {};
+        for (const [label, variants] of Object.entries(data.labels)) {
+            labelTokens[label] = new Set();
+            for (const variant of variants) {
+                const variantTokens = MODEL.tokenize(variant);
+                if (variantTokens.length === 0) continue;
+                labelTokens[label].add(variantTokens[0]);
+                const owner = tokenOwners.get(variantTokens[0]);
+                if (owner !== undefined && owner !== label) {
+                    console.log(`Classification labels '${owner}' and '${label}' start with the same token`);
+                }
+                tokenOwners.set(variantTokens[0], label);
+            }
+        }
+
+        const scores = {};
+        let total = 0;
+        for (const [label, firstTokens] of Object.entries(labelTokens)) {
+            let score = 0;
+            for (const token of firstTokens) {
+                score += nextProbabilities.get(token) || 0;
+            }
+            scores[label] = score;
+            total += score;
+        }
+        // normalize over the labels only, whatever else the model wanted to say is ignored
+        const probabilities = {};
+        const labelCount = Object.keys(scores).length;
+        for (const [label, score] of Object.entries(scores)) {
+            probabilities[label] = total > 0 ? score / total : 1 / labelCount;
+        }
+        return probabilities;
+    } finally {
+        try {
+            await context.dispose();
+        } catch {
+        }
+    }
+}
+
+async function getJsonSchemaGrammar(schema) {
+    const key = JSON.stringify(schema);
+    let grammar = JSON_SCHEMA_GRAMMARS.get(key);
+    if (!grammar) {
+        grammar = await LLAMA.createGrammarForJsonSchema(schema);
+        JSON_SCHEMA_GRAMMARS.set(key, grammar);
+    }
+    return grammar;
+}
+
+// groups the streamed tokens into frames of several tokens, a frame is sent when it has maxTokens tokens
+// or when its first token has waited intervalMs, so the client handles one message per frame instead of per token
+function createTokenFramer(send, intervalMs, maxTokens) {
+    let texts = [];
+    let timer = null;
+
+    const flush = () => {
+        if (timer !== null) {
+            clearTimeout(timer);
+            timer = null;
+        }
+        if (texts.length === 0) {
+            return;
+        }
+        send({ type: 'tokens', texts, text: texts.join('') });
+        texts = [];
+    };
+
+    const push = (text) => {
+        texts.push(text);
+        if (maxTokens > 0 && texts.length >= maxTokens) {
+            flush();
+        } else if (timer === null) {
+            timer = setTimeout(flush, intervalMs);
+        }
+    };
+
+    return { push, flush };
+}
+
+async function generateCompletion(data, onToken, onDone, onError, signal = undefined) {
     let prompt = data.prompt;
     let isDisposed = false;
     let isContextDisposed = false;
@@ -64,11 +188,31 @@ async function generateCompletion(data, onToken, onDone, onError) {
 
     let context = null
     let completion = null;
+    // only one generation at a time can own the persistent context, the rest get a fresh one
+    const usePersistentContext = data.keep_context === true && !PERSISTENT_CONTEXT_BUSY;
+    if (usePersistentContext) {
+        PERSISTENT_CONTEXT_BUSY = true;
+        // prevent it from being disposed below
+        isContextDisposed = true;
+    }
     try {
         // Create context and completion for raw text
-        context = await MODEL.createContext();
+        let sequence = null;
+        if (usePersistentContext) {
+            if (PERSISTENT_CONTEXT === null) {
+                PERSISTENT_CONTEXT = await MODEL.createContext();
+                PERSISTENT_SEQUENCE = PERSISTENT_CONTEXT.getSequence();
+            }
+            context = PERSISTENT_CONTEXT;
+            sequence = PERSISTENT_SEQUENCE;
+        } else {
+            context = await MODEL.createContext();
+            sequence = context.getSequence();
+        }
         completion = new LlamaCompletion({
-            contextSequence: context.getSequence()
+            contextSequence: sequence,
+            // the persistent sequence must outlive this completion
+            autoDisposeSequence: false,
         });
 
         const basicConfig = {
@@ -82,17 +226,25 @@ async function generateCompletion(data, onToken, onDone, onError) {
             customStopTriggers: data.stop || [],
             maxTokens: data.max_tokens || 512,
         }
+        if (data.json_schema) {
+            // constrain the output to the given json schema, used by the structured analysis
+            basicConfig.grammar = await getJsonSchemaGrammar(data.json_schema);
+        }
         if (typeof data.max_paragraphs === "number") {
             console.log("Max paragraphs limit set to:", data.max_paragraphs);
         }
         if (typeof data.max_characters === "number") {
             console.log("Max characters limit set to:", data.max_characters);
         }
-        console.log("Generation config:", basicConfig);
+        console.log("Generation config:", { ...basicConfig, grammar: basicConfig.grammar ? "json_schema" : undefined });
         await completion.generateCompletion(prompt, {
             ...basicConfig,
+            // a cancelled generation stops decoding and finishes normally with what it has
+            signal,
+            stopOnAbortSignal: true,
             onToken(tokens) {
                 if (isDisposed || weDisposedOurselves) return;
+                if (signal && signal.aborted) return;
                 // Stream token-by-token for better responsiveness
                 const text = MODEL.detokenize(tokens);
                 try {
@@ -183,52 +335,107 @@ async function generateCompletion(data, onToken, onDone, onError) {
             console.log(e.message);
             onError(e);
         }
+    } finally {
+        if (usePersistentContext) {
+            PERSISTENT_CONTEXT_BUSY = false;
+        }
     }
 }
 
 wss.on('connection', (ws) => {
     console.log('Client connected');
     
+    // generations of this client that are still running, by request id, so they can be cancelled
+    const activeGenerations = new Map();
+
     ws.on('message', async (message) => {
+        // every answer carries the request_id it was sent with, so a single socket
+        // can have several requests in flight at once
+        let requestId = null;
+        const reply = (payload) => {
+            ws.send(JSON.stringify({ ...payload, request_id: requestId }));
+        };
         try {
             const data = JSON.parse(message);
+            requestId = data.request_id === undefined ? null : data.request_id;
             
             // Handle different actions
             if (data.action === 'load_model') {
                 try {
                     await load_model(data.model_path);
-                    ws.send(JSON.stringify({ type: 'model_loaded' }));
+                    reply({ type: 'model_loaded' });
                 } catch (e) {
                     console.log(e.message);
-                    ws.send(JSON.stringify({ type: 'error', message: e.message }));
+                    reply({ type: 'error', message: e.message });
                 }
             } 
             else if (data.action === 'generate') {
                 if (!MODEL) {
-                    ws.send(JSON.stringify({ type: 'error', message: 'Model not loaded' }));
+                    reply({ type: 'error', message: 'Model not loaded' });
                     return;
                 }
 
-                await generateCompletion(data, (text) => {
-                    ws.send(JSON.stringify({ type: 'token', text }));
-                }, () => {
-                    ws.send(JSON.stringify({ type: 'done' }));
-                }, (error) => {
-                    ws.send(JSON.stringify({ type: 'error', message: error.message }));
-                });
+                const abortController = new AbortController();
+                activeGenerations.set(requestId, abortController);
+
+                // without frame options every token goes out on its own as before
+                const frameIntervalMs = data.frame_interval_ms || 0;
+                const frameMaxTokens = data.frame_max_tokens || 0;
+                const framer = (frameIntervalMs > 0 || frameMaxTokens > 1) ? createTokenFramer(reply, frameIntervalMs, frameMaxTokens) : null;
+                try {
+                    await generateCompletion(data, (text) => {
+                        if (framer) {
+                            framer.push(text);
+                        } else {
+                            reply({ type: 'token', text });
+                        }
+                    }, () => {
+                        // the last frame always goes before done
+                        if (framer) framer.flush();
+                        reply({ type: 'done' });
+                    }, (error) => {
+                        if (framer) framer.flush();
+                        reply({ type: 'error', message: error.message });
+                    }, abortController.signal);
+                } finally {
+                    activeGenerations.delete(requestId);
+                }
+            } else if (data.action === 'cancel') {
+                // the client already has its answer, stop decoding the rest of it
+                const abortController = activeGenerations.get(data.target_request_id);
+                if (abortController) {
+                    console.log("Cancelling generation for request:", data.target_request_id);
+                    abortController.abort();
+                }
+                reply({ type: 'cancelled' });
 
+            } else if (data.action === 'classify') {
+                if (!MODEL) {
+                    reply({ type: 'error', message: 'Model not loaded' });
+                    return;
+                }
+                const probabilities = await classifyCompletion(data);
+                reply({ type: 'classification', probabilities });
             } else if (data.action === 'count_tokens') {
                 if (!MODEL) {
-                    ws.send(JSON.stringify({ type: 'error', message: 'Model not loaded' }));
+                    reply({ type: 'error', message: 'Model not loaded' });
                     return;
                 }
                 const text = data.text;
                 const tokens = MODEL.tokenize(text);
-                ws.send(JSON.stringify({ type: 'token_count', n_tokens: tokens.length }));
+                reply({ type: 'token_count', n_tokens: tokens.length });
+            } else if (data.action === 'count_tokens_batch') {
+                if (!MODEL) {
+                    reply({ type: 'error', message: 'Model not loaded' });
+                    return;
+                }
+                // count many texts at once so the client doesn't have to do a round-trip per text
+                const counts = data.texts.map((text) => MODEL.tokenize(text).length);
+                reply({ type: 'token_counts', n_tokens: counts });
             }
         } catch (e) {
             console.log(e.message);
-            ws.send(JSON.stringify({ type: 'error', message: e.message }));
+            reply({ type: 'error', message: e.message });
         }
     });
     
@@ -0,0 +1,181 @@
+import gzip
+import json
+import lzma
+import os
+import shutil
+import threading
+import time
+
+from lib.persistence import write_text_atomic, write_chunks_atomic
+
+# compression -> (how a chunk file is opened, extension of the chunk files)
+COMPRESSIONS = {
+    "gzip": (gzip.open, ".jsonl.gz"),
+    "lzma": (lzma.open, ".jsonl.xz"),
+}
+
+# fields of the conversation state the manifest has on their own
+MANIFEST_FIELDS = ["history", "username", "bond", "bond_2nd", "stranger", "ended", "visited_locations"]
+
+class ConversationArchive:
+    """Finished conversations, each one as compressed chunks of its messages plus an entry in a manifest with
+    what is needed to list and pick them, so listing reads a single small file and reading a range of messages
+    only decompresses the chunks it falls in"""
+
+    def __init__(self, archive_folder: str, compression: str = "gzip", chunk_size: int = 200):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown archive compression: {compression}")
+        self.archive_folder = archive_folder
+        # only used for new archives, every entry remembers how its chunks were written
+        self.compression = compression
+        # messages per chunk
+        self.chunk_size = chunk_size
+        self.manifest_path = os.path.join(archive_folder, "manifest.json")
+        # read on first use and kept in memory, every change writes it whole
+        self.manifest = None
+        self.lock = threading.Lock()
+
+    def _load_manifest(self) -> dict:
+        if self.manifest is None:
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    self.manifest = json.load(f)
+            else:
+                self.manifest = {"next_index": 1, "sessions": []}
+        return self.manifest
+
+    def _save_manifest(self):
+        os.makedirs(self.archive_folder, exist_ok=True)
+        write_text_atomic(self.manifest_path, json.dumps(self.manifest, ensure_ascii=False, indent=4))
+
+    def _entry(self, name: str) -> dict:
+        for entry in self._load_manifest()["sessions"]:
+            if entry["name"] == name:
+                return entry
+        return None
+
+    def next_name(self, logs_folder: str = None) -> str:
+        """Name for the next archived conversation, from the counter in the manifest instead of trying every name,
+        skipping the uncompressed archived logs older versions left in the logs folder"""
+        with self.lock:
+            i = self._load_manifest()["next_index"]
+        while logs_folder is not None and os.path.exists(os.path.join(logs_folder, f"archived_{i}.json")):
+            i += 1
+        return f"archived_{i}"
+
+    def list_sessions(self) -> list[dict]:
+        """Every archived conversation without its messages, newest first"""
+        with self.lock:
+            sessions = list(self._load_manifest()["sessions"])
+        return sorted(sessions, key=lambda entry: entry["archived_at"], reverse=True)
+
+    def get_session(self, name: str) -> dict:
+        """The manifest entry of the archived conversation, or None"""
+        with self.lock:
+            return self._entry(name)
+
+    def archive(self, name: str, state: dict) -> dict:
+        """Write the conversation as compressed chunks and add it to the manifest, returns its entry"""
+        open_chunk, extension = COMPRESSIONS[self.compression]
+        session_folder = os.path.join(self.archive_folder, name)
+        os.makedirs(session_folder, exist_ok=True)
+
+        history = state.get("history", [])
+        chunks = []
+        turn_count = 0
+        for start in range(0, len(history), self.chunk_size):
+            # sliced so a paged history is read a page at a time too
+            messages = history[start:start + self.chunk_size]
+            turn_count += len([msg for msg in messages if msg["role"] == "assistant"])
+            chunk_file = f"{len(chunks):05d}{extension}"
+            with open_chunk(os.path.join(session_folder, chunk_file), "wt", encoding="utf-8") as f:
+                for msg in messages:
+                    f.write(json.dumps(msg, ensure_ascii=False) + "\n")
+            chunks.append({"file": chunk_file, "start": start, "count": len(messages)})
+
+        entry = {
+            "name": name,
+            "archived_at": time.time(),
+            "compression": self.compression,
+            "message_count": len(history),
+            # a turn is an answer of the character, the same as in the conversation store
+            "turn_count": turn_count,
+            "username": state.get("username"),
+            "bond": state.get("bond", 0.0),
+            "bond_2nd": state.get("bond_2nd", 0.0),
+            "stranger": state.get("stranger", True),
+            "ended": state.get("ended"),
+            "visited_locations": list(state.get("visited_locations", [])),
+            # the other plain fields so the conversation can be restored as it was
+            "fields": {key: value for key, value in state.items() if key not in MANIFEST_FIELDS},
+            "chunks": chunks,
+        }
+
+        # the chunks are all on disk before the manifest says the conversation is there
+        with self.lock:
+            manifest = self._load_manifest()
+            manifest["sessions"] = [session for session in manifest["sessions"] if session["name"] != name]
+            manifest["sessions"].append(entry)
+            if name.startswith("archived_") and name[len("archived_"):].isdigit():
+                manifest["next_index"] = max(manifest["next_index"], int(name[len("archived_"):]) + 1)
+            self._save_manifest()
+        return entry
+
+    def _read_chunk(self, entry: dict, chunk: dict) -> list[dict]:
+        open_chunk = COMPRESSIONS[entry["compression"]][0]
+        with open_chunk(os.path.join(self.archive_folder, entry["name"], chunk["file"]), "rt", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def read_messages(self, name: str, start: int = 0, end: int = None) -> list[dict]:
+        """The messages of the archived conversation from start up to but not including end,
+        only the chunks the range falls in are decompressed"""
+        entry = self.get_session(name)
+        if entry is None:
+            raise ValueError(f"No archived conversation named {name}")
+        if end is None:
+            end = entry["message_count"]
+        messages = []
+        for chunk in entry["chunks"]:
+            chunk_end = chunk["start"] + chunk["count"]
+            if chunk_end <= start or chunk["start"] >= end:
+                continue
+            messages.extend(self._read_chunk(entry, chunk)[max(start - chunk["start"], 0):end - chunk["start"]])
+        return messages
+
+    def _state_without_history(self, entry: dict) -> dict:
+        state = dict(entry["fields"])
+        state.update({key: entry[key] for key in MANIFEST_FIELDS if key != "history"})
+        if state["ended"] is None:
+            del state["ended"]
+        return state
+
+    def load_session(self, name: str) -> dict:
+        """The whole archived conversation in the same format as the conversation logs"""
+        entry = self.get_session(name)
+        if entry is None:
+            raise ValueError(f"No archived conversation named {name}")
+        return {"history": self.read_messages(name), **self._state_without_history(entry)}
+
+    def restore(self, name: str, snapshot_path: str):
+        """Write the archived conversation back as a conversation log so it can go on, and take it out of the archive"""
+        entry = self.get_session(name)
+        if entry is None:
+            raise ValueError(f"No archived conversation named {name}")
+        rest = json.dumps(self._state_without_history(entry), ensure_ascii=False)
+
+        def chunks():
+            # a chunk at a time, the messages are never all in memory
+            yield '{"history": ['
+            for i, chunk in enumerate(entry["chunks"]):
+                page = ", ".join(json.dumps(msg, ensure_ascii=False) for msg in self._read_chunk(entry, chunk))
+                yield page if i == 0 else ", " + page
+            yield "], " + rest[1:]
+
+        write_chunks_atomic(snapshot_path, chunks())
+
+        # the log is on disk before the archive lets go of the conversation
+        with self.lock:
+            manifest = self._load_manifest()
+            manifest["sessions"] = [session for session in manifest["sessions"] if session["name"] != name]
+            self._save_manifest()
+        shutil.rmtree(os.path.join(self.archive_folder, name), ignore_errors=True)
@@ -1,7 +1,36 @@
 from os import path, listdir
 import json
+import re
 from typing_extensions import Literal
 
+# the labels used by the structured post inference analysis, with their bond change
+STRUCTURED_SENTIMENT_LABELS = {
+    "extremely negative": -3,
+    "very negative": -2,
+    "negative": -1,
+    "neutral": 0,
+    "positive": 1,
+    "very positive": 2,
+    "extremely positive": 3,
+}
+
+# labels for scoring the interaction sentiment by label probability, the answer is prefilled up to the
+# sentiment so only the first token of each label is scored, very and extremely come before the polarity
+# so they need a second pass with the polarity labels
+SENTIMENT_CLASSIFICATION_PREFILL = "*The interaction was"
+SENTIMENT_CLASSIFICATION_LABELS = {
+    "positive": [" Positive", " positive"],
+    "negative": [" Negative", " negative"],
+    "neutral": [" Neutral", " neutral"],
+    "very": [" very", " Very"],
+    "extremely": [" extremely", " Extremely"],
+}
+SENTIMENT_CLASSIFICATION_INTENSITIES = ["very", "extremely"]
+SENTIMENT_POLARITY_LABELS = {
+    "positive": [" Positive", " positive"],
+    "negative": [" Negative", " negative"],
+}
+
 class BondsHandler:
     def __init__(self, character_folder):
         self.character_folder = character_folder
@@ -417,8 +446,8 @@ class BondsHandler:
             "\n\nYou MUST respond with:\"YES\" or \"NO\" each of the questions given, do not explain your answers, simply output in the format. " + \
             "\n\n1. YES, 2. NO, etc. to the questions. that come after QUESTIONS:"
     
-    def get_2nd_bond_post_inference_confirmation_prompt(self, current_bond, current_2nd_bond, stranger_bond) -> str:
-        """Return the post inference confirmation prompt"""
+    def get_2nd_bond_ascent_questions(self, current_bond, current_2nd_bond, stranger_bond) -> list[str]:
+        """Return the ascent questions for the given bond and second bond"""
         # get the questions from the ascent rules for the given bond and second bond
         exceptional, processed_bond = self.get_processed_bond(
             current_bond,
@@ -430,12 +459,27 @@ class BondsHandler:
         elif not processed_bond:
             raise ValueError("Cannot get ascent questions for invalid bond")
         
-        ascent_questions = processed_bond.get("ascent_rules", [])
+        return processed_bond.get("ascent_rules", [])
+
+    def get_2nd_bond_post_inference_confirmation_prompt(self, current_bond, current_2nd_bond, stranger_bond) -> str:
+        """Return the post inference confirmation prompt"""
+        ascent_questions = self.get_2nd_bond_ascent_questions(current_bond, current_2nd_bond, stranger_bond)
         ascent_questions_formatted = ""
         for i, question in enumerate(ascent_questions):
             ascent_questions_formatted += f"{i + 1}. {question}\n"
         return f"QUESTIONS:\n\n{ascent_questions_formatted}\n\nYour response should be in the format: 1. YES or NO, 2. YES or NO, etc. Answer the questions"
     
+    def has_2nd_bond_ascent_rules(self, current_bond: int, current_2nd_bond: int, stranger_bond: bool) -> bool:
+        """Check whether the current bond has ascent rules, regardless of how the interaction went"""
+        is_dead_end, processed_bond = self.get_processed_bond(
+            current_bond,
+            current_2nd_bond,
+            stranger_bond,
+        )
+        if is_dead_end or not processed_bond:
+            return False
+        return len(processed_bond.get("ascent_rules", [])) > 0
+
     def can_ascend_2nd_bond(self, current_bond: int, current_2nd_bond: int, stranger_bond: bool, expected_next_bond_change: int) -> bool:
         # second bond can only ascend if the expected next bond change is positive
         if expected_next_bond_change <= 0:
@@ -472,6 +516,22 @@ class BondsHandler:
             change = 3
         return change
     
+    def is_2nd_bond_response_decided(self, post_inference_response: str, question_count: int) -> bool:
+        """Check whether a partial answer to the ascent questions already settles the change,
+        that is every question has been answered or the change is already at its maximum"""
+        words = re.findall(r"[a-z]+", post_inference_response.lower())
+        # the last word may still be incomplete
+        if words and post_inference_response[-1:].isalpha():
+            words = words[:-1]
+        yes_count = words.count("yes")
+        return yes_count >= 3 or yes_count + words.count("no") >= question_count
+
+    def is_post_inference_response_decided(self, post_inference_response: str) -> bool:
+        """Check whether a partial sentiment answer already settles the bond change, the intensity
+        comes before the polarity in the phrase so once the polarity is there nothing else changes"""
+        response_lower = post_inference_response.lower()
+        return "positive" in response_lower or "negative" in response_lower or "neutral" in response_lower
+
     def analyze_response_for_bond_change(self, post_inference_response: str) -> int:
         if post_inference_response is None:
             return 0
@@ -496,4 +556,50 @@ class BondsHandler:
         elif "extreme" in response_lower or "overwhelm" in response_lower:
             change *= 3
 
-        return change
\ No newline at end of file
+        return change
+
+    def get_structured_post_inference_instructions(self) -> str:
+        """Return the instructions for the sentiment field of the structured post inference analysis"""
+        return "\"sentiment\": whether the interaction was positive, negative or neutral for " + self.character_name + \
+            ", one of: " + ", ".join(STRUCTURED_SENTIMENT_LABELS.keys()) + \
+            "; consider the tone, content, and emotional context of the message in your analysis."
+
+    def get_structured_post_inference_schema(self) -> dict:
+        """Return the json schema properties for the sentiment field"""
+        return {
+            "sentiment": {"enum": list(STRUCTURED_SENTIMENT_LABELS.keys())},
+        }
+
+    def get_structured_2nd_bond_instructions(self, ascent_questions: list[str]) -> str:
+        """Return the instructions for the ascent answers field of the structured post inference analysis"""
+        ascent_questions_formatted = ""
+        for i, question in enumerate(ascent_questions):
+            ascent_questions_formatted += f"{i + 1}. {question}\n"
+        return "\"ascent_answers\": answer YES or NO to each of these questions, in order:\n" + ascent_questions_formatted
+
+    def get_structured_2nd_bond_schema(self, ascent_questions: list[str]) -> dict:
+        """Return the json schema properties for the ascent answers field"""
+        return {
+            "ascent_answers": {
+                "type": "array",
+                "items": {"enum": ["YES", "NO"]},
+                "minItems": len(ascent_questions),
+                "maxItems": len(ascent_questions),
+            },
+        }
+
+    def get_bond_change_from_structured_analysis(self, analysis: dict) -> int:
+        """Calculate the bond change from the parsed structured analysis"""
+        sentiment = analysis.get("sentiment")
+        if sentiment not in STRUCTURED_SENTIMENT_LABELS:
+            print("Warning: Unable to determine bond change from structured analysis, defaulting to neutral.")
+            return 0
+        return STRUCTURED_SENTIMENT_LABELS[sentiment]
+
+    def get_2nd_bond_change_from_structured_analysis(self, analysis: dict) -> int:
+        """Calculate the second bond change from the parsed structured analysis, the amount of yes answers"""
+        answers = analysis.get("ascent_answers") or []
+        change = len([answer for answer in answers if answer == "YES"])
+        if change > 3:
+            change = 3
+        return change
@@ -1,6 +1,7 @@
 from os import path, listdir
 
 from lib.nlp import SubjectDetector
+from lib.matcher import PhraseMatcher, PhraseScanner
 
 def read_emotion_list(emotion_path: str, all_states: list[str]):
     """Read the list of emotions from the given file path"""
@@ -207,6 +208,16 @@ def expand_emotion(emotion: str) -> set[str]:
 
     return variations
 
+def merge_triggered_states(states: list[tuple[str, str]], states_triggered_add: set, states_triggered_discard: set):
+    """Fold the (sign, state) pairs in order into the states to add and to discard, the last sign of a state wins"""
+    for sign, state_name in states:
+        if sign == "+":
+            states_triggered_add.add(state_name)
+            states_triggered_discard.discard(state_name)
+        elif sign == "-":
+            states_triggered_discard.add(state_name)
+            states_triggered_add.discard(state_name)
+
 class EmotionHandler:
     """Class to handle emotions for characters"""
 
@@ -227,6 +238,19 @@ class EmotionHandler:
         self.all_phrases_general, self.all_phrases_subject = read_phrase_list(path.join(general_path, "phrases.txt"), self.all_emotions)
         
         print(f"Expanded emotions into count: {len(self.all_emotions_expanded)}")
+
+        # every trigger and phrase compiled once, in the order they have priority in when two start at the same place,
+        # the triggers of the emotions and every phrase when the character is the subject, only the general phrases otherwise
+        subject_patterns = []
+        for emotion in self.all_emotions:
+            for trigger in get_emotion_alternatives(emotion, self.all_emotions_expanded):
+                subject_patterns.append((trigger, emotion))
+        subject_patterns += list(self.all_phrases_subject.items()) + list(self.all_phrases_general.items())
+        self.subject_matcher = PhraseMatcher(subject_patterns)
+        self.general_matcher = PhraseMatcher(list(self.all_phrases_general.items()))
+        # the rolling text only grows between restarts, so only what was added is scanned every token
+        self.subject_scanner = PhraseScanner(self.subject_matcher)
+        self.general_scanner = PhraseScanner(self.general_matcher)
         
         # check that for each emotion there is a corresponding folder in emotions/
         for emotion in self.all_emotions:
@@ -293,9 +317,11 @@ class EmotionHandler:
     def restart_rolling_emotions(self):
         self.in_asterisk_description = False
         self.rolling_text = ""
+        self.subject_scanner.reset()
+        self.general_scanner.reset()
         print("Restarted rolling emotion detection.")
 
-    def process_rolling_token(self, token: str):
+    def process_rolling_token(self, token: str, log: bool = True):
         self.rolling_text += token
 
         text_to_process = self.rolling_text
@@ -318,33 +344,14 @@ class EmotionHandler:
             return (None, [])
 
         # check if the first subject is the character
-        last_emotion_in_sentence = None
         last_states_triggered = []
-        last_emotion_in_sentence_index = -1
         if first_subject and first_subject.lower() == self.character_name.lower():
-            rolling_text_comparable = f" {text_to_process.lower()} "
-            for emotion in self.all_emotions:
-                emotion_all_triggers = get_emotion_alternatives(emotion, self.all_emotions_expanded)
-                for trigger in emotion_all_triggers:
-                    index = rolling_text_comparable.rfind(f" {trigger} ")
-                    if index > last_emotion_in_sentence_index:
-                        last_emotion_in_sentence_index = index
-                        last_emotion_in_sentence = emotion
-                        last_states_triggered = self.emotions.get(emotion, []) + self.common_emotions.get(emotion, [])
-            for phrase, emotion in list(self.all_phrases_subject.items()) + list(self.all_phrases_general.items()):
-                index = rolling_text_comparable.rfind(f" {phrase} ")
-                if index > last_emotion_in_sentence_index:
-                    last_emotion_in_sentence_index = index
-                    last_emotion_in_sentence = emotion
-                    last_states_triggered = self.emotions.get(emotion, []) + self.common_emotions.get(emotion, [])
+            scanner = self.subject_scanner
         else:
-            for phrase, emotion in self.all_phrases_general.items():
-                rolling_text_comparable = f" {text_to_process.lower()} "
-                index = rolling_text_comparable.rfind(f" {phrase} ")
-                if index > last_emotion_in_sentence_index:
-                    last_emotion_in_sentence_index = index
-                    last_emotion_in_sentence = emotion
-                    last_states_triggered = self.emotions.get(emotion, []) + self.common_emotions.get(emotion, [])
+            scanner = self.general_scanner
+        _, last_emotion_in_sentence = scanner.last_match(text_to_process.lower())
+        if last_emotion_in_sentence is not None:
+            last_states_triggered = self.emotions.get(last_emotion_in_sentence, []) + self.common_emotions.get(last_emotion_in_sentence, [])
 
         # the character has changed just now we need to update our rolling text, if it hasn't already
         if last_subject != first_subject and not asterisk_updated_rolling_text:
@@ -355,7 +362,31 @@ class EmotionHandler:
             else:
                 self.rolling_text = text_to_process[last_subject_index:]
 
-        if last_emotion_in_sentence is not None:
+        if last_emotion_in_sentence is not None and log:
             print(f"Detected rolling emotion: {last_emotion_in_sentence} triggering states {last_states_triggered} from text: {text_to_process}")
 
-        return (last_emotion_in_sentence, last_states_triggered)
\ No newline at end of file
+        return (last_emotion_in_sentence, last_states_triggered)
+
+    def process_rolling_chunk(self, tokens: list[str]) -> list[tuple[str, list[tuple[str, str]]]]:
+        """Process the tokens of a streamed frame one at a time, the same as if each came on its own, returns the
+        (emotion, states) detected in order, what was detected is printed once for the whole frame"""
+        events = []
+        for token in tokens:
+            emotion, states = self.process_rolling_token(token, log=False)
+            if emotion is not None:
+                events.append((emotion, states))
+        if events:
+            print(f"Detected rolling emotions: {[emotion for emotion, _ in events]} triggering states {[state for _, states in events for state in states]}")
+        return events
+
+    def analyze_message(self, content: str) -> list[tuple[str, list[tuple[str, str]]]]:
+        """The (emotion, states) detected in a whole message, in order, the same as if it was streamed
+        a word at a time, the rolling detection is restarted before and is left at the end of the message"""
+        self.restart_rolling_emotions()
+        events = []
+        for word in content.split():
+            emotion, states = self.process_rolling_token(word + " ", log=False)
+            if emotion is not None:
+                events.append((emotion, states))
+        print(f"Analysed a message of {len(content)} characters, detected {len(events)} emotions.")
+        return events
@@ -0,0 +1,154 @@
+import json
+import queue
+import subprocess
+import sys
+import threading
+from os import path
+
+from lib.emotion import EmotionHandler
+
+class EmotionWorker:
+    """Detects the emotions of the streamed reply in its own process, so the nltk work doesn't hold the
+    interpreter lock of the window, the text is sent as it streams and the events come back in the same order,
+    each one tagged with the chunk it came from"""
+
+    def __init__(self, general_path: str, all_states: list[str], timeout: float = 10):
+        # started as a module and not with multiprocessing, spawning would run start.py again in the child
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "lib.emotion_worker"],
+            cwd=path.dirname(path.dirname(path.abspath(__file__))),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            encoding="utf-8",
+            bufsize=1,
+        )
+        # guards the pipe to the process, chunks are sent from the inference thread and the rest from wherever
+        self.send_lock = threading.Lock()
+        # the events the reader thread got, the ones of an older turn are dropped when read
+        self.events_queue = queue.Queue()
+        # every restart is a new turn, chunks are numbered within it
+        self.turn = 0
+        self.seq = 0
+        # the last chunk of the turn we got the event of
+        self.received_seq = 0
+        # the tokens of every chunk of the turn, so someone else can take over if the process dies
+        self.chunks = []
+        # the process is gone and no more events will come
+        self.stopped = False
+        # how long to wait for the next event before giving up on the process, a stuck one never sends it
+        self.timeout = timeout
+
+        reader = threading.Thread(target=self._read_loop, daemon=True)
+        reader.start()
+
+        self._send({"type": "setup", "general_path": general_path, "all_states": all_states})
+
+    @property
+    def alive(self) -> bool:
+        return not self.stopped and self.process.poll() is None
+
+    def _send(self, message: dict):
+        with self.send_lock:
+            try:
+                self.process.stdin.write(json.dumps(message, ensure_ascii=False) + "\n")
+                self.process.stdin.flush()
+            except (OSError, ValueError) as e:
+                print("Failed to send to the emotion worker:", e)
+
+    def _read_loop(self):
+        for line in self.process.stdout:
+            self.events_queue.put(json.loads(line))
+        # the process is gone, whoever waits for an event will never get it
+        self.events_queue.put({"type": "stopped"})
+
+    def apply_names(self, character_name: str, username: str, character_pronouns: list[str]):
+        self._send({"type": "names", "character_name": character_name, "username": username, "character_pronouns": character_pronouns})
+
+    def restart(self):
+        """Start a new reply, the events of the last one that didn't arrive yet are dropped"""
+        self.turn += 1
+        self.seq = 0
+        self.received_seq = 0
+        self.chunks = []
+        self._send({"type": "restart", "turn": self.turn})
+
+    def feed(self, tokens: list[str]):
+        """Send the tokens of a frame of the reply, its events come back later"""
+        self.seq += 1
+        self.chunks.append(tokens)
+        self._send({"type": "chunk", "turn": self.turn, "seq": self.seq, "tokens": tokens})
+
+    def _take(self, block: bool) -> list[tuple[str, list]]:
+        events = []
+        while self.received_seq < self.seq and not self.stopped:
+            try:
+                message = self.events_queue.get(block=block, timeout=self.timeout if block else None)
+            except queue.Empty:
+                if block:
+                    # whoever waits takes over the chunks left, so the process isn't used anymore
+                    print(f"The emotion worker didn't answer in {self.timeout} seconds, {self.seq - self.received_seq} chunks of the reply weren't analysed by it.")
+                    self.stopped = True
+                    self.process.kill()
+                break
+            if message["type"] == "stopped":
+                print(f"The emotion worker stopped, {self.seq - self.received_seq} chunks of the reply weren't analysed by it.")
+                self.stopped = True
+                break
+            if message["turn"] != self.turn:
+                continue
+            if message["seq"] != self.received_seq + 1:
+                raise Exception(f"Emotion worker event {message['seq']} came out of order, expected {self.received_seq + 1}")
+            self.received_seq = message["seq"]
+            events.extend((emotion, [tuple(state) for state in states]) for emotion, states in message["events"])
+        return events
+
+    def events(self) -> list[tuple[str, list]]:
+        """The (emotion, states) events that arrived since the last call, in order, without waiting"""
+        return self._take(block=False)
+
+    def finish(self) -> list[tuple[str, list]]:
+        """Wait for the events of every chunk sent, the ones not returned by events yet, in order,
+        it returns early if the process stops or doesn't answer in time, the chunks after received_seq never got theirs then"""
+        return self._take(block=True)
+
+    def close(self):
+        """Stop the process, it also stops on its own once this process goes away"""
+        self._send({"type": "stop"})
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+def run():
+    """The worker process, reads the messages from stdin and writes the events to stdout"""
+    # the handler prints what it detects, that goes to stderr so stdout only has events
+    channel = sys.stdout
+    sys.stdout = sys.stderr
+    sys.stdin.reconfigure(encoding="utf-8")
+    channel.reconfigure(encoding="utf-8")
+
+    emotion_handler = None
+    for line in sys.stdin:
+        message = json.loads(line)
+        message_type = message["type"]
+        if message_type == "setup":
+            emotion_handler = EmotionHandler(message["general_path"], message["all_states"])
+        elif message_type == "names":
+            emotion_handler.apply_names(message["character_name"], message["username"], character_pronouns=message["character_pronouns"])
+        elif message_type == "restart":
+            emotion_handler.restart_rolling_emotions()
+        elif message_type == "chunk":
+            try:
+                events = emotion_handler.process_rolling_chunk(message["tokens"])
+            except Exception as e:
+                # a chunk that can't be analysed still gets its event, the reply goes on
+                print("Failed to detect emotions in the streamed text:", e)
+                events = []
+            channel.write(json.dumps({"type": "event", "turn": message["turn"], "seq": message["seq"], "events": events}) + "\n")
+            channel.flush()
+        elif message_type == "stop":
+            break
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,265 @@
+from bisect import bisect_left
+from collections import OrderedDict
+import threading
+
+class PagedHistory:
+    """The history messages of a conversation with only the last ones, and the older pages used lately, in memory,
+    the rest is read from disk a page at a time when someone asks for it, otherwise it works like the list it replaces"""
+
+    def __init__(self, count_messages, read_messages, sync=None, page_size=100, resident_pages=8):
+        # (start, end) -> the messages in the range as they are on disk
+        self.read_messages = read_messages
+        # brings what is on disk up to date with the changes made here, called before reading from it
+        self.sync = sync
+        self.page_size = page_size
+        # how many pages older than the tail are kept around
+        self.resident_pages = resident_pages
+
+        self.lock = threading.RLock()
+        self.length = count_messages()
+        # the messages from tail_start on are always in memory, new messages go there
+        self.tail_start = max(0, self.length - page_size)
+        self.tail = read_messages(self.tail_start, self.length)
+        # page number -> its messages, least recently used first, page n has the messages
+        # from n * page_size up to the next page or the tail, whatever comes first
+        self.pages = OrderedDict()
+        # bumped on every change, the disk has all the changes up to synced_version
+        self.version = 0
+        self.synced_version = 0
+
+        # for benchmarking
+        self.page_loads = 0
+        self.page_evictions = 0
+
+    def __len__(self):
+        return self.length
+
+    def _normalize(self, index: int) -> int:
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("history index out of range")
+        return index
+
+    def _drop_pages_from(self, first_page: int):
+        for page in [page for page in self.pages if page >= first_page]:
+            del self.pages[page]
+
+    def append(self, msg: dict):
+        with self.lock:
+            self.tail.append(msg)
+            self.length += 1
+            self.version += 1
+            if len(self.tail) >= 2 * self.page_size:
+                # keep the last page, what is dropped is read back from disk when needed
+                new_tail_start = (self.length - self.page_size) // self.page_size * self.page_size
+                # the page the tail started in may have been cut short by it
+                self._drop_pages_from(self.tail_start // self.page_size)
+                del self.tail[:new_tail_start - self.tail_start]
+                self.tail_start = new_tail_start
+
+    def set_content(self, index: int, content: str):
+        """Change the text of a message, if it isn't in memory the change only reaches it through the disk"""
+        with self.lock:
+            index = self._normalize(index)
+            if index >= self.tail_start:
+                self.tail[index - self.tail_start]["content"] = content
+            else:
+                page = self.pages.get(index // self.page_size)
+                if page is not None:
+                    page[index % self.page_size]["content"] = content
+            self.version += 1
+
+    def __delitem__(self, index: int):
+        with self.lock:
+            index = self._normalize(index)
+            if index >= self.tail_start:
+                del self.tail[index - self.tail_start]
+            else:
+                # every message after it moves back one place, so the pages from it on are read again
+                self._drop_pages_from(index // self.page_size)
+                self.tail_start -= 1
+            self.length -= 1
+            self.version += 1
+
+    def _read(self, start: int, end: int) -> list[dict]:
+        """The messages in the range, loading the pages that are not in memory"""
+        while True:
+            with self.lock:
+                end = min(end, self.length)
+                pages = []
+                if start < min(end, self.tail_start):
+                    pages = range(start // self.page_size, (min(end, self.tail_start) - 1) // self.page_size + 1)
+                missing = [page for page in pages if page not in self.pages]
+                if not missing or self.sync is None or self.synced_version == self.version:
+                    for page in missing:
+                        self.pages[page] = self.read_messages(page * self.page_size, min((page + 1) * self.page_size, self.tail_start))
+                        self.page_loads += 1
+                    messages = []
+                    for page in pages:
+                        self.pages.move_to_end(page)
+                        page_start = page * self.page_size
+                        messages.extend(self.pages[page][max(start - page_start, 0):min(end, self.tail_start) - page_start])
+                    if end > self.tail_start:
+                        messages.extend(self.tail[max(start - self.tail_start, 0):end - self.tail_start])
+                    while len(self.pages) > self.resident_pages:
+                        self.pages.popitem(last=False)
+                        self.page_evictions += 1
+                    return messages
+                version = self.version
+            # outside of our lock, syncing waits for whoever is changing the history through the conversation log
+            self.sync()
+            with self.lock:
+                self.synced_version = max(self.synced_version, version)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return self._read(start, stop) if start < stop else []
+        with self.lock:
+            index = self._normalize(index)
+        return self._read(index, index + 1)[0]
+
+    def __iter__(self):
+        for start in range(0, self.length, self.page_size):
+            yield from self._read(start, start + self.page_size)
+
+    def __reversed__(self):
+        # newest first a page at a time, looking for the last message of some kind only reads the tail
+        for end in range(self.length, 0, -self.page_size):
+            yield from reversed(self._read(max(0, end - self.page_size), end))
+
+class HistoryTokenIndex:
+    """Formatted text and token count of the history messages, plus the running sum of the counts
+    so the tokens of any range of messages, and where a window has to start, are found without a loop
+    counting is deferred until refresh so the messages can be added before the model is loaded
+    only the messages from offset on are indexed, older ones are brought in when a prompt could reach them"""
+
+    def __init__(self, format_message, count_tokens_batch, page_size=100):
+        # message -> formatted text, or None for messages that never go in the prompt
+        self.format_message = format_message
+        # list of texts -> list of token counts
+        self.count_tokens_batch = count_tokens_batch
+        # how many messages are indexed or forgotten at once
+        self.page_size = page_size
+
+        # the history the older messages are read from
+        self.history = []
+        # index in the history of the first message indexed, the lists below start there
+        self.offset = 0
+        self.texts = []
+        # None until counted
+        self.counts = []
+        # prefix[i] is the amount of tokens of the indexed messages before i
+        self.prefix = [0]
+        # first indexed message whose count or prefix sum is out of date
+        self.dirty_from = 0
+        # the turn stages and the window can touch the index from different threads
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return self.offset + len(self.texts)
+
+    def rebuild(self, history, start: int = 0):
+        """Index the history from start on"""
+        with self.lock:
+            self.history = history
+            self.offset = start
+            self.texts = [self.format_message(msg) for msg in history[start:]]
+            self.counts = [None] * len(self.texts)
+            self.prefix = [0]
+            self.dirty_from = 0
+
+    def append(self, msg: dict):
+        with self.lock:
+            self.texts.append(self.format_message(msg))
+            self.counts.append(None)
+            self.dirty_from = min(self.dirty_from, len(self.texts) - 1)
+
+    def edit(self, index: int, msg: dict):
+        with self.lock:
+            if index < self.offset:
+                return
+            index -= self.offset
+            self.texts[index] = self.format_message(msg)
+            self.counts[index] = None
+            self.dirty_from = min(self.dirty_from, index)
+
+    def delete(self, index: int):
+        with self.lock:
+            if index < self.offset:
+                self.offset -= 1
+                return
+            index -= self.offset
+            del self.texts[index]
+            del self.counts[index]
+            self.dirty_from = min(self.dirty_from, index)
+
+    def refresh(self, extra_texts: list[str] = ()):
+        """Count whatever changed since the last refresh and bring the sums up to date,
+        the extra texts are counted in the same request so they are cached for later"""
+        with self.lock:
+            pending = [i for i in range(self.dirty_from, len(self.texts)) if self.counts[i] is None]
+            to_count = [self.texts[i] for i in pending if self.texts[i] is not None]
+            if to_count or extra_texts:
+                counts = iter(self.count_tokens_batch(to_count + list(extra_texts)))
+                for i in pending:
+                    self.counts[i] = 0 if self.texts[i] is None else next(counts)
+            else:
+                for i in pending:
+                    self.counts[i] = 0
+
+            del self.prefix[self.dirty_from + 1:]
+            total = self.prefix[-1]
+            for count in self.counts[self.dirty_from:]:
+                total += count
+                self.prefix.append(total)
+            self.dirty_from = len(self.texts)
+
+    def cover(self, available_tokens: int):
+        """Index older messages until the indexed ones don't fit in the available tokens or there are no more,
+        so a window never stops at the first indexed message because the older ones were not there, must be refreshed"""
+        with self.lock:
+            while self.offset > 0 and self.tokens_between(self.offset) <= available_tokens:
+                start = max(0, self.offset - self.page_size)
+                older = [self.format_message(msg) for msg in self.history[start:self.offset]]
+                self.texts[:0] = older
+                self.counts[:0] = [None] * len(older)
+                self.offset = start
+                self.prefix = [0]
+                self.dirty_from = 0
+                self.refresh()
+
+    def forget_before(self, index: int):
+        """Stop indexing the messages a page or more before index, prompts don't reach that far back, must be refreshed"""
+        with self.lock:
+            # a page at a time so it doesn't happen every turn
+            drop = (index - self.offset - self.page_size) // self.page_size * self.page_size
+            if drop <= 0 or drop > self.dirty_from:
+                return
+            del self.texts[:drop]
+            del self.counts[:drop]
+            del self.prefix[:drop]
+            base = self.prefix[0]
+            self.prefix = [total - base for total in self.prefix]
+            self.offset += drop
+            self.dirty_from = max(0, self.dirty_from - drop)
+
+    def tokens_between(self, start: int, end: int = None) -> int:
+        """Tokens of the indexed messages from start up to but not including end, must be refreshed"""
+        start = max(start - self.offset, 0)
+        end = len(self.texts) if end is None else end - self.offset
+        return self.prefix[end] - self.prefix[start]
+
+    def window_start(self, available_tokens: int, end: int = None) -> int:
+        """First message of the longest run of indexed messages ending at end that fits in the available tokens"""
+        end = len(self.texts) if end is None else end - self.offset
+        return self.offset + bisect_left(self.prefix, self.prefix[end] - available_tokens, 0, end + 1)
+
+    def window_texts(self, start: int, end: int = None) -> list[str]:
+        """The formatted texts of the messages in the range, leaving out the ones that don't go in the prompt"""
+        start = max(start - self.offset, 0)
+        end = None if end is None else end - self.offset
+        return [text for text in self.texts[start:end] if text is not None]
@@ -0,0 +1,190 @@
+import json
+import queue
+import threading
+import itertools
+import math
+import time
+from collections import deque
+import websocket
+
+class InferenceClient:
+    """Long lived client for the inference server, every request is tagged with an id so that
+    several of them can share the same websocket, the socket is reopened when it drops"""
+
+    def __init__(self, url: str, reconnect_attempts: int = 5, reconnect_delay: float = 0.5):
+        self.url = url
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+
+        self.ws = None
+        # guards the socket itself, websocket-client is not safe to send from many threads at once
+        self.send_lock = threading.Lock()
+        # request id -> (queue where its messages go, socket it was sent through)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+
+    def _ensure_connected(self):
+        """Open the socket if we don't have a live one, must be called with send_lock held"""
+        if self.ws is not None and self.ws.connected:
+            return
+
+        last_error = None
+        for attempt in range(self.reconnect_attempts):
+            try:
+                ws = websocket.create_connection(self.url)
+                break
+            except (OSError, websocket.WebSocketException) as e:
+                last_error = e
+                print(f"Could not connect to inference server (attempt {attempt + 1}/{self.reconnect_attempts}): {e}")
+                time.sleep(self.reconnect_delay * (attempt + 1))
+        else:
+            raise Exception("Could not connect to inference server: " + str(last_error))
+
+        self.ws = ws
+        reader = threading.Thread(target=self._read_loop, args=(ws,), daemon=True)
+        reader.start()
+
+    def _read_loop(self, ws):
+        """Dispatch every incoming message to the queue of the request it belongs to"""
+        while True:
+            try:
+                raw = ws.recv()
+            except (OSError, websocket.WebSocketException):
+                break
+            if not raw:
+                break
+            message = json.loads(raw)
+            with self.pending_lock:
+                entry = self.pending.get(message.get("request_id"))
+            if entry is not None:
+                entry[0].put(message)
+
+        # the socket is gone, whoever was waiting on it will never get an answer
+        with self.pending_lock:
+            lost = [(request_id, entry[0]) for request_id, entry in self.pending.items() if entry[1] is ws]
+        for request_id, request_queue in lost:
+            request_queue.put({
+                "type": "error",
+                "message": "Connection to inference server lost",
+                "request_id": request_id,
+                "connection_lost": True,
+            })
+        try:
+            ws.close()
+        except (OSError, websocket.WebSocketException):
+            pass
+
+    def _send(self, action: dict):
+        request_id = next(self.request_ids)
+        request_queue = queue.Queue()
+        payload = json.dumps({**action, "request_id": request_id})
+        with self.send_lock:
+            for attempt in range(2):
+                self._ensure_connected()
+                with self.pending_lock:
+                    self.pending[request_id] = (request_queue, self.ws)
+                try:
+                    self.ws.send(payload)
+                    return request_id, request_queue
+                except (OSError, websocket.WebSocketException) as e:
+                    print("Failed to send request to inference server, reconnecting:", e)
+                    with self.pending_lock:
+                        del self.pending[request_id]
+                    try:
+                        self.ws.close()
+                    except (OSError, websocket.WebSocketException):
+                        pass
+                    self.ws = None
+                    if attempt == 1:
+                        raise Exception("Failed to send request to inference server: " + str(e))
+
+    def _release(self, request_id: int):
+        with self.pending_lock:
+            self.pending.pop(request_id, None)
+
+    def request(self, action: dict) -> dict:
+        """Send an action that is answered with a single message and wait for that message"""
+        for attempt in range(2):
+            request_id, request_queue = self._send(action)
+            try:
+                message = request_queue.get()
+            finally:
+                self._release(request_id)
+            # single answer requests are safe to resend if the socket dropped before answering
+            if message.get("connection_lost") and attempt == 0:
+                continue
+            return message
+
+    def stream(self, action: dict):
+        """Send a streaming action and yield its messages, the last one yielded is either done or error
+        closing the generator before that cancels the rest of the generation in the server"""
+        for attempt in range(2):
+            request_id, request_queue = self._send(action)
+            received = False
+            finished = False
+            try:
+                while True:
+                    message = request_queue.get()
+                    # we can only retry if nothing was streamed yet, otherwise we would duplicate text
+                    if message.get("connection_lost") and not received and attempt == 0:
+                        finished = True
+                        break
+                    received = True
+                    if message["type"] == "done" or message["type"] == "error":
+                        finished = True
+                    yield message
+                    if finished:
+                        return
+            finally:
+                self._release(request_id)
+                if not finished:
+                    self.cancel(request_id)
+
+    def cancel(self, request_id: int):
+        """Ask the server to stop a streaming request, whatever it still sends for it is dropped"""
+        try:
+            cancel_request_id, _ = self._send({"action": "cancel", "target_request_id": request_id})
+            # nobody waits for the acknowledgement
+            self._release(cancel_request_id)
+        except Exception as e:
+            print("Failed to cancel request", request_id, ":", e)
+
+    def close(self):
+        with self.send_lock:
+            if self.ws is not None:
+                try:
+                    self.ws.close()
+                except (OSError, websocket.WebSocketException):
+                    pass
+                self.ws = None
+
+class AdaptiveTokenBudget:
+    """Keeps the max tokens of each kind of generation close to the lengths actually observed for it,
+    so a call that stops on its own never reserves much more than it needs"""
+
+    def __init__(self, window: int = 20, headroom: float = 1.5, minimum: int = 4):
+        self.window = window
+        self.headroom = headroom
+        self.minimum = minimum
+        # key -> recent lengths in tokens
+        self.observations = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str, default: int) -> int:
+        """Return the max tokens to use for the key, never more than the default"""
+        with self.lock:
+            observed = self.observations.get(key)
+            if not observed:
+                return default
+            budget = math.ceil(max(observed) * self.headroom)
+        return max(self.minimum, min(default, budget))
+
+    def observe(self, key: str, used_tokens: int, budget: int, decided: bool):
+        """Record how many tokens a generation used, if it ran out of budget without deciding
+        the budget was too small so it's recorded as double to grow the next one"""
+        if not decided and used_tokens >= budget:
+            used_tokens = budget * 2
+        with self.lock:
+            observed = self.observations.setdefault(key, deque(maxlen=self.window))
+            observed.append(used_tokens)
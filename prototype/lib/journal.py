@@ -0,0 +1,197 @@
+import json
+import os
+import threading
+
+from lib.persistence import write_text_atomic
+
+# the kinds of events a conversation is made of, see apply_event
+MESSAGE_APPENDED = "message_appended"
+MESSAGE_EDITED = "message_edited"
+MESSAGE_DELETED = "message_deleted"
+BOND_UPDATED = "bond_updated"
+STATES_UPDATED = "states_updated"
+LOCATION_VISITED = "location_visited"
+FIELDS_UPDATED = "fields_updated"
+
+def apply_event(state: dict, event: dict):
+    """Apply a single event to the conversation state, both when it happens and when the journal is replayed"""
+    event_type = event["type"]
+    if event_type == MESSAGE_APPENDED:
+        state["history"].append(event["message"])
+    elif event_type == MESSAGE_EDITED:
+        history = state["history"]
+        if hasattr(history, "set_content"):
+            # a paged history may not have the message in memory, it doesn't have to read it to change it
+            history.set_content(event["index"], event["content"])
+        else:
+            history[event["index"]]["content"] = event["content"]
+    elif event_type == MESSAGE_DELETED:
+        del state["history"][event["index"]]
+    elif event_type == BOND_UPDATED:
+        # only the values that changed are in the event
+        for key in ["bond", "bond_2nd", "stranger"]:
+            if key in event:
+                state[key] = event[key]
+    elif event_type == STATES_UPDATED:
+        state["applied_states"] = event["applied_states"]
+    elif event_type == LOCATION_VISITED:
+        visited_locations = state.setdefault("visited_locations", [])
+        if event["location"] not in visited_locations:
+            visited_locations.append(event["location"])
+    elif event_type == FIELDS_UPDATED:
+        # everything else that is a plain value, username, ended, location change counters...
+        state.update(event["fields"])
+    else:
+        raise ValueError(f"Unknown conversation event type: {event_type}")
+
+class ConversationLog:
+    """The conversation as a snapshot plus an append only journal of the events since the snapshot,
+    saving only appends the new events, the journal is folded into the snapshot in the background once it grows"""
+
+    def __init__(self, snapshot_path: str, compact_after: int = 256, write_snapshot=None):
+        # the snapshot has the same format as the old conversation logs, plus the last event it includes
+        self.snapshot_path = snapshot_path
+        self.journal_path = os.path.splitext(snapshot_path)[0] + ".journal.jsonl"
+        self.compact_after = compact_after
+        # snapshot path -> last event included, writes the snapshot from something that mirrors the journal
+        # instead of from the state, for when the state doesn't have the whole history in memory
+        self.write_snapshot = write_snapshot
+
+        self.state = None
+        # sequence number of the last event recorded
+        self.seq = 0
+        # sequence number of the last event that is in the snapshot
+        self.snapshot_seq = 0
+        # events recorded but not in the journal file yet
+        self.pending = []
+
+        # guards the state and the pending events
+        self.lock = threading.RLock()
+        # guards the journal file, appending and compacting can't happen at the same time
+        self.journal_lock = threading.Lock()
+        self.compaction_thread = None
+        # called with every batch of events once it is in the journal, e.g. to mirror them in the conversation store
+        self.observers = []
+
+    def load(self, default_state: dict, snapshot: tuple[dict, int] = None) -> dict:
+        """Read the snapshot and replay the journal on top of it, returns the state, which is kept up to date by record
+        the snapshot can be given as (state, last event it includes) when it comes from somewhere else than the file"""
+        if snapshot is not None:
+            state = {**snapshot[0], "journal_seq": snapshot[1]}
+        elif os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        else:
+            state = json.loads(json.dumps(default_state))
+
+        self.snapshot_seq = state.pop("journal_seq", 0)
+        self.seq = self.snapshot_seq
+
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            # bytes of the journal made of whole events
+            valid_size = 0
+            truncated = False
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        truncated = True
+                        break
+                    valid_size += len(line)
+                    # events already in the snapshot, a compaction didn't get to trim them
+                    if event["seq"] <= self.snapshot_seq:
+                        continue
+                    apply_event(state, event)
+                    self.seq = event["seq"]
+                    replayed += 1
+            if truncated:
+                # a crash in the middle of a write only ever loses the last line, cut it so we append after whole events
+                print("Ignoring a truncated event at the end of the conversation journal.")
+                with open(self.journal_path, "r+b") as f:
+                    f.truncate(valid_size)
+
+        if replayed > 0:
+            print(f"Replayed {replayed} events from the conversation journal.")
+
+        self.state = state
+        return state
+
+    def record(self, event: dict):
+        """Apply the event to the state right away, it is written to disk on the next commit"""
+        with self.lock:
+            self.seq += 1
+            event = {**event, "seq": self.seq}
+            apply_event(self.state, event)
+            self.pending.append(event)
+
+    def commit(self):
+        """Append the pending events to the journal with a single fsync"""
+        # the journal lock is taken first so two commits can't write their events out of order
+        with self.journal_lock:
+            with self.lock:
+                events = self.pending
+                self.pending = []
+            if events:
+                with open(self.journal_path, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events))
+                    f.flush()
+                    os.fsync(f.fileno())
+                # still under the journal lock so the observers see the batches in order
+                for observer in self.observers:
+                    try:
+                        observer(events)
+                    except Exception as e:
+                        print("Failed to pass the conversation events to an observer:", e)
+
+        if events and self.seq - self.snapshot_seq >= self.compact_after:
+            self.compact_in_background()
+
+    def compact_in_background(self):
+        if self.compaction_thread is not None and self.compaction_thread.is_alive():
+            return
+        self.compaction_thread = threading.Thread(target=self.compact, daemon=True)
+        self.compaction_thread.start()
+
+    def compact(self):
+        """Write the state as a new snapshot and drop the journal events it includes"""
+        if self.write_snapshot is not None:
+            # what mirrors the journal has every committed event once we hold the journal lock, and
+            # nothing can be committed while the snapshot is written from it
+            with self.journal_lock:
+                snapshot_seq = self.write_snapshot(self.snapshot_path)
+                self._trim_journal(snapshot_seq)
+        else:
+            with self.lock:
+                # serializing under the lock is what gives us a consistent copy of the state,
+                # it includes the pending events too, they are skipped when the journal is replayed
+                snapshot_seq = self.seq
+                serialized = json.dumps({**self.state, "journal_seq": snapshot_seq}, ensure_ascii=False)
+            write_text_atomic(self.snapshot_path, serialized)
+
+            # keep only the events that happened while we were writing the snapshot
+            with self.journal_lock:
+                self._trim_journal(snapshot_seq)
+
+        self.snapshot_seq = snapshot_seq
+        print(f"Compacted the conversation journal into the snapshot at event {snapshot_seq}.")
+
+    def _trim_journal(self, snapshot_seq: int):
+        """Drop the journal events the snapshot includes, the journal lock must be held"""
+        remaining = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        if json.loads(line)["seq"] > snapshot_seq:
+                            remaining.append(line)
+                    except json.JSONDecodeError:
+                        break
+        write_text_atomic(self.journal_path, "".join(remaining))
+
+    def close(self):
+        """Commit whatever is pending and wait for a compaction that is running"""
+        self.commit()
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
@@ -0,0 +1,112 @@
+from collections import deque
+
+class PhraseMatcher:
+    """Aho-Corasick automaton over a list of phrases, finds where the last whole word occurrence of any of them
+    starts in a single pass over the text, instead of looking for every phrase on its own"""
+
+    def __init__(self, phrases: list[tuple[str, object]]):
+        """The phrases come with the value to give back when they match, in order of priority, when two of them
+        start at the same place the one that came first wins"""
+        # node -> {character -> node}, node 0 is the root
+        self.goto = [{}]
+        # node -> node of the longest proper suffix of its text that is also in the automaton
+        self.fail = [0]
+        # node -> (length, priority, value) if a phrase ends at the node
+        self.output = [None]
+        # node -> closest node along the fail links that has an output, so the matches are found without walking every link
+        self.output_link = [None]
+
+        for priority, (phrase, value) in enumerate(phrases):
+            if not phrase:
+                continue
+            node = 0
+            for character in phrase:
+                next_node = self.goto[node].get(character)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][character] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.output_link.append(None)
+                node = next_node
+            # the same phrase twice only ever matches as the first one
+            if self.output[node] is None:
+                self.output[node] = (len(phrase), priority, value)
+
+        # breadth first so the fail link of a node is known before its children need it
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for character, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and character not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(character, 0)
+                link = self.fail[child]
+                self.output_link[child] = link if self.output[link] is not None else self.output_link[link]
+
+    def __len__(self):
+        return len(self.goto)
+
+    def _advance(self, node: int, character: str) -> int:
+        while node and character not in self.goto[node]:
+            node = self.fail[node]
+        return self.goto[node].get(character, 0)
+
+    def _settle(self, text: str, end: int, node: int, best: tuple) -> tuple:
+        """Take the matches that end at end into account, whatever comes after end ends the word,
+        best is (start, priority, value) of the match that starts last so far"""
+        match = node if self.output[node] is not None else self.output_link[node]
+        while match is not None:
+            length, priority, value = self.output[match]
+            start = end - length + 1
+            if (start == 0 or text[start - 1] == " ") and (start > best[0] or (start == best[0] and priority < best[1])):
+                best = (start, priority, value)
+            match = self.output_link[match]
+        return best
+
+    def last_match(self, text: str) -> tuple[int, object]:
+        """Where the match that starts last begins and its value, or (-1, None), a match has to have
+        a space or the edge of the text at both sides"""
+        best = (-1, None, None)
+        node = 0
+        for end, character in enumerate(text):
+            node = self._advance(node, character)
+            # the next character has to end the word for anything that ends here
+            if end + 1 == len(text) or text[end + 1] == " ":
+                best = self._settle(text, end, node, best)
+        return best[0], best[2]
+
+class PhraseScanner:
+    """The last match of a matcher in a text that keeps growing, only what was added since the last call is scanned,
+    a text that doesn't continue the last one starts over"""
+
+    def __init__(self, matcher: PhraseMatcher):
+        self.matcher = matcher
+        self.reset()
+
+    def reset(self):
+        self.text = ""
+        # the state of the automaton after the last character of the text
+        self.node = 0
+        # the last match that ends before the last character, the ones ending at it depend on what comes next
+        self.best = (-1, None, None)
+
+    def last_match(self, text: str) -> tuple[int, object]:
+        """Same as PhraseMatcher.last_match"""
+        if not text.startswith(self.text):
+            self.reset()
+        matcher = self.matcher
+        for end in range(len(self.text), len(text)):
+            # the character before this one is settled now that we know what follows it
+            if end > 0 and text[end] == " ":
+                self.best = matcher._settle(text, end - 1, self.node, self.best)
+            self.node = matcher._advance(self.node, text[end])
+        self.text = text
+
+        best = self.best
+        if text:
+            best = matcher._settle(text, len(text) - 1, self.node, best)
+        return best[0], best[2]
@@ -1,63 +1,189 @@
+import functools
+import re
+from collections import OrderedDict
+
 import nltk
+from nltk.tag.perceptron import PerceptronTagger
 
 nltk.download('averaged_perceptron_tagger', quiet=True)
 nltk.download('punkt', quiet=True)
 nltk.download('averaged_perceptron_tagger_eng', quiet=True)
 nltk.download('punkt_tab', quiet=True)
 
+# the word being written at the end of a text, it isn't complete until whitespace comes after it
+LAST_WORD = re.compile(r"\S*$")
+
+@functools.lru_cache(maxsize=1)
+def get_abbreviations() -> set[str]:
+    """The abbreviations punkt knows, lowercase and without their last period, the ones word_tokenize uses"""
+    return nltk.tokenize._get_punkt_tokenizer("english")._params.abbrev_types
+
+@functools.lru_cache(maxsize=8192)
+def tokenize_word(word: str, ends_text: bool = False) -> tuple[str, ...]:
+    """The tokens of a single whitespace separated word as word_tokenize gives them for the whole text, the same words
+    come up again and again, on its own the word ends a sentence so its last period is split off, within the text punkt
+    only ends the sentence there if it isn't an abbreviation it knows, so "Mr." "Dr." or "U.S." keep their period then,
+    what punkt decides from the word that follows, like an abbreviation ending a sentence, isn't looked at"""
+    tokens = list(nltk.word_tokenize(word))
+    if not ends_text and len(tokens) >= 2 and tokens[-1] == "." and word.endswith(tokens[-2] + "."):
+        abbreviation = tokens[-2].lower()
+        abbreviations = get_abbreviations()
+        if abbreviation in abbreviations or abbreviation.split("-")[-1] in abbreviations:
+            tokens[-2:] = [tokens[-2] + "."]
+    return tuple(tokens)
+
+@functools.lru_cache(maxsize=1)
+def get_tagger() -> PerceptronTagger:
+    """The tagger nltk.pos_tag uses, loaded once"""
+    return PerceptronTagger()
+
 class SubjectDetector:
-    def __init__(self, known_subject: str, subject_pronouns: list[str]):
+    """Finds who is being talked about in a text, it is meant to be given the same text again and again while it grows,
+    only the words completed since the last call are tokenized and tagged and the subjects found so far are remembered,
+    a text that doesn't continue the last one starts over"""
+
+    def __init__(self, known_subject: str, subject_pronouns: list[str], cache_size: int = 4096):
         self.known_subject_original = known_subject
         self.known_subject = known_subject.lower()
         self.pronouns = subject_pronouns
-    
-    def analyze_sentence(self, text: str, own: bool = False) -> list[str]:
-        tokens = nltk.word_tokenize(text)
-        pos_tags = nltk.pos_tag(tokens)
-        
-        results = []
-        current_subject = None
-        
-        for i, (word, tag) in enumerate(pos_tags):
-            # Detect subjects: proper nouns, pronouns, or "the [noun]"
-            next_subject = None
-            next_subject_simple = None
-
-            if tag in ('NNP', 'PRP'):  # Proper noun or pronoun
-                next_subject = word.lower()
-                next_subject_simple = next_subject
-
-                if own and word.lower() in ["i", "me"]:
-                    next_subject = self.known_subject
-                    next_subject_simple = self.known_subject
-            elif word.lower() in ["someone", "somebody", "anyone", "anybody"]:
-                next_subject = word.lower()
-                next_subject_simple = word.lower()
-            elif (word.lower() == 'the' or word.lower() == "a" or word.lower() == "an") and i + 1 < len(pos_tags):
-                # "the man" -> subject is "the man"
-                next_word, next_tag = pos_tags[i + 1]
-                next_next_word, next_next_tag = pos_tags[i + 2] if i + 2 < len(pos_tags) else (None, None)
-                if next_tag.startswith('NN'):
-                    next_subject = f"{word} {next_word}"
-                    next_subject_simple = next_word.lower()
-                if next_next_tag is not None and next_next_tag.startswith('NN') and next_tag in ('JJ', 'DT'):
-                    next_subject = f"{word} {next_word} {next_next_word}"
-                    next_subject_simple = next_next_word.lower()
-
-            if next_subject is None:
-                continue
-
-            # detect if the next_subject is actually the current known subject
-            if current_subject is not None and current_subject == self.known_subject and next_subject_simple in self.pronouns:
-                next_subject = self.known_subject
-            else:
-                next_subject = next_subject.lower()
 
-            if next_subject.lower() == self.known_subject:
-                current_subject = self.known_subject
-                results.append(self.known_subject_original)
+        self.tagger = get_tagger()
+        # the tag of a token only depends on the two tags before it and on the two words at each side,
+        # so the window is the key, (previous tags, word, window) -> tag, least recently used first
+        self.tag_cache = OrderedDict()
+        self.cache_size = cache_size
+
+        # for benchmarking
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self.reset()
+
+    def reset(self, own: bool = False):
+        """Forget the text analysed so far"""
+        self.text = ""
+        self.own = own
+        # the text up to here is whole words, tokenized into tokens
+        self.completed_length = 0
+        self.tokens = []
+        # the tags that can't change anymore, a tag is final once there are two complete tokens after it
+        self.tags = []
+        # the subjects found in the tokens before subject_position, and who the subject was at that point,
+        # a subject is final once the two tags after it are
+        self.subjects = []
+        self.subject_position = 0
+        self.current_subject = None
+
+    def _tag(self, i: int, tokens: list[str], tags: list[str]) -> str:
+        """Tag the token the same way nltk.pos_tag would with these tokens, given the tags before it"""
+        # the tagger starts with both previous tags at the start markers and shifts them by one per token
+        previous = [*self.tagger.START[::-1], *tags[max(0, i - 2):i]]
+        prev, prev2 = previous[-1], previous[-2]
+        word = tokens[i]
+        tag = self.tagger.tagdict.get(word)
+        if tag:
+            return tag
+
+        window = []
+        for j in range(i - 2, i + 3):
+            if j < 0:
+                window.append(self.tagger.START[j + 2])
+            elif j >= len(tokens):
+                window.append(self.tagger.END[j - len(tokens)])
             else:
-                current_subject = next_subject
-                results.append(next_subject)
-        
-        return results
\ No newline at end of file
+                window.append(self.tagger.normalize(tokens[j]))
+        key = (prev, prev2, word, *window)
+        tag = self.tag_cache.get(key)
+        if tag is not None:
+            self.tag_cache.move_to_end(key)
+            self.cache_hits += 1
+            return tag
+
+        self.cache_misses += 1
+        # the features of the middle token of the window, it is the token at 0 once the start is skipped
+        features = self.tagger._get_features(0, word, window, prev, prev2)
+        tag, _ = self.tagger.model.predict(features)
+        self.tag_cache[key] = tag
+        if len(self.tag_cache) > self.cache_size:
+            self.tag_cache.popitem(last=False)
+        return tag
+
+    def _subject_at(self, i: int, tokens: list[str], tags: list[str], current_subject: str):
+        """The subject the token starts, if any, and who the subject is after it"""
+        word = tokens[i]
+        tag = tags[i]
+
+        # Detect subjects: proper nouns, pronouns, or "the [noun]"
+        next_subject = None
+        next_subject_simple = None
+
+        if tag in ('NNP', 'PRP'):  # Proper noun or pronoun
+            next_subject = word.lower()
+            next_subject_simple = next_subject
+
+            if self.own and word.lower() in ["i", "me"]:
+                next_subject = self.known_subject
+                next_subject_simple = self.known_subject
+        elif word.lower() in ["someone", "somebody", "anyone", "anybody"]:
+            next_subject = word.lower()
+            next_subject_simple = word.lower()
+        elif (word.lower() == 'the' or word.lower() == "a" or word.lower() == "an") and i + 1 < len(tokens):
+            # "the man" -> subject is "the man"
+            next_word, next_tag = tokens[i + 1], tags[i + 1]
+            next_next_word, next_next_tag = (tokens[i + 2], tags[i + 2]) if i + 2 < len(tokens) else (None, None)
+            if next_tag.startswith('NN'):
+                next_subject = f"{word} {next_word}"
+                next_subject_simple = next_word.lower()
+            if next_next_tag is not None and next_next_tag.startswith('NN') and next_tag in ('JJ', 'DT'):
+                next_subject = f"{word} {next_word} {next_next_word}"
+                next_subject_simple = next_next_word.lower()
+
+        if next_subject is None:
+            return None, current_subject
+
+        # detect if the next_subject is actually the current known subject
+        if current_subject is not None and current_subject == self.known_subject and next_subject_simple in self.pronouns:
+            next_subject = self.known_subject
+        else:
+            next_subject = next_subject.lower()
+
+        if next_subject.lower() == self.known_subject:
+            return self.known_subject_original, self.known_subject
+        return next_subject, next_subject
+
+    def analyze_sentence(self, text: str, own: bool = False) -> list[str]:
+        """The subjects of the text in order, own means the text is spoken by the known subject so I and me are them"""
+        if own != self.own or not text.startswith(self.text):
+            self.reset(own)
+        self.text = text
+
+        # tokenize the words completed since the last call, the one still being written is tokenized every time
+        # the last word can't start before the one of the last call
+        last_word_start = LAST_WORD.search(text, self.completed_length).start()
+        for word in text[self.completed_length:last_word_start].split():
+            self.tokens.extend(tokenize_word(word))
+        self.completed_length = last_word_start
+        last_word = text[last_word_start:]
+        tokens = self.tokens + list(tokenize_word(last_word, ends_text=True)) if last_word else self.tokens
+
+        # tag whatever became final, then the last tokens as if the text ended here
+        while len(self.tags) < len(self.tokens) - 2:
+            self.tags.append(self._tag(len(self.tags), self.tokens, self.tags))
+        tags = list(self.tags)
+        for i in range(len(tags), len(tokens)):
+            tags.append(self._tag(i, tokens, tags))
+
+        # the same for the subjects
+        while self.subject_position < len(self.tags) - 2:
+            subject, self.current_subject = self._subject_at(self.subject_position, self.tokens, self.tags, self.current_subject)
+            if subject is not None:
+                self.subjects.append(subject)
+            self.subject_position += 1
+        results = list(self.subjects)
+        current_subject = self.current_subject
+        for i in range(self.subject_position, len(tokens)):
+            subject, current_subject = self._subject_at(i, tokens, tags, current_subject)
+            if subject is not None:
+                results.append(subject)
+
+        return results
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+def write_text_atomic(file_path: str, text: str):
+    """Write the text to a temporary file and move it over the old one, a crash never leaves half a file"""
+    write_chunks_atomic(file_path, [text])
+
+def write_chunks_atomic(file_path: str, chunks):
+    """Same as write_text_atomic for text that comes in pieces, so it never has to be in memory all at once"""
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+class PersistenceWorker:
+    """Does the disk writes of the other threads in its own thread, a write is asked for with a key and
+    only the last write asked for each key runs, so a burst of saves of the same thing is a single write"""
+
+    def __init__(self, delay: float = 0.2):
+        # how long to wait after the first write of a burst for the rest of it to come
+        self.delay = delay
+
+        # key -> function that does the write, in the order they were first asked for
+        self.writes = OrderedDict()
+        self.condition = threading.Condition()
+        # every write asked for gets the next ticket, flush waits for the tickets up to its own
+        self.requested = 0
+        self.completed = 0
+        self.flush_requested = False
+        self.closed = False
+
+        # how many writes were asked for and how many actually ran, for benchmarking
+        self.writes_requested = 0
+        self.writes_done = 0
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def mark_dirty(self, key: str, write):
+        """Ask for the write to be done soon, replaces the write that was waiting for the same key"""
+        with self.condition:
+            if self.closed:
+                raise Exception("Persistence worker is closed")
+            self.writes[key] = write
+            self.requested += 1
+            self.writes_requested += 1
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.writes and not self.closed:
+                    self.condition.wait()
+                if not self.writes and self.closed:
+                    return
+                # let the rest of the burst arrive, unless someone is waiting for it
+                deadline = time.monotonic() + self.delay
+                while not self.flush_requested and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                writes = self.writes
+                self.writes = OrderedDict()
+                ticket = self.requested
+                self.flush_requested = False
+
+            for key, write in writes.items():
+                try:
+                    write()
+                except Exception as e:
+                    print(f"Failed to write {key}:", e)
+                self.writes_done += 1
+
+            with self.condition:
+                self.completed = ticket
+                self.condition.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until every write asked for before this call is on disk, returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            ticket = self.requested
+            self.flush_requested = True
+            self.condition.notify_all()
+            while self.completed < ticket:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def close(self):
+        """Write whatever is waiting and stop the thread"""
+        self.flush()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
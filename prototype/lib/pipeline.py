@@ -0,0 +1,147 @@
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+class Stage:
+    def __init__(self, name: str, function, inputs: list[str], outputs: list[str]):
+        self.name = name
+        self.function = function
+        self.inputs = inputs
+        self.outputs = outputs
+
+class Pipeline:
+    """A set of stages that declare which values they need and which they produce, every stage is started
+    as soon as all of its inputs are ready so independent stages overlap instead of waiting on each other"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stages = {}
+        # stage name -> (start, end) in seconds since the start of the last run
+        self.timings = {}
+        # stage name -> the stages it waited for in the last run
+        self.dependencies = {}
+
+    def add_stage(self, name: str, function, inputs: list[str] = None, outputs: list[str] = None):
+        """Add a stage, the function gets its inputs as keyword arguments and returns its output,
+        or a tuple with one value per output if it has several, the output defaults to the stage name"""
+        if name in self.stages:
+            raise ValueError(f"Duplicate stage in pipeline {self.name}: {name}")
+        self.stages[name] = Stage(name, function, inputs or [], outputs or [name])
+
+    def _resolve_dependencies(self, initial_values: dict) -> dict:
+        """Find the stages each stage has to wait for, and check the graph can actually run"""
+        producers = {}
+        for stage in self.stages.values():
+            for output in stage.outputs:
+                if output in producers or output in initial_values:
+                    raise ValueError(f"Value '{output}' is produced more than once in pipeline {self.name}")
+                producers[output] = stage.name
+
+        dependencies = {}
+        for stage in self.stages.values():
+            dependencies[stage.name] = set()
+            for value in stage.inputs:
+                if value in initial_values:
+                    continue
+                if value not in producers:
+                    raise ValueError(f"Stage '{stage.name}' needs '{value}' but nothing produces it in pipeline {self.name}")
+                dependencies[stage.name].add(producers[value])
+
+        # make sure there are no cycles, otherwise the run would never finish
+        remaining = {name: set(deps) for name, deps in dependencies.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"Pipeline {self.name} has a cycle between stages: {', '.join(remaining.keys())}")
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+        return dependencies
+
+    def _run_stage(self, stage: Stage, values: dict, run_start: float):
+        start = time.perf_counter() - run_start
+        result = stage.function(**{value: values[value] for value in stage.inputs})
+        end = time.perf_counter() - run_start
+        return result, start, end
+
+    def _store_result(self, stage: Stage, result, values: dict):
+        if len(stage.outputs) == 1:
+            values[stage.outputs[0]] = result
+        else:
+            for output, value in zip(stage.outputs, result):
+                values[output] = value
+
+    def run(self, executor=None, **initial_values) -> dict:
+        """Run every stage and return all the values, with no executor the stages run one after the other
+        in this thread, in the order they were added as long as their inputs allow it"""
+        self.dependencies = self._resolve_dependencies(initial_values)
+        self.timings = {}
+        values = dict(initial_values)
+        done = set()
+        run_start = time.perf_counter()
+
+        if executor is None:
+            while len(done) < len(self.stages):
+                for stage in self.stages.values():
+                    if stage.name not in done and self.dependencies[stage.name] <= done:
+                        result, start, end = self._run_stage(stage, values, run_start)
+                        self.timings[stage.name] = (start, end)
+                        self._store_result(stage, result, values)
+                        done.add(stage.name)
+                        break
+            return values
+
+        running = {}
+        while len(done) < len(self.stages):
+            for stage in self.stages.values():
+                if stage.name in done or stage in running.values():
+                    continue
+                if self.dependencies[stage.name] <= done:
+                    running[executor.submit(self._run_stage, stage, values, run_start)] = stage
+
+            finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    result, start, end = future.result()
+                except Exception:
+                    # stages that didn't start yet are dropped, the ones running can't be stopped from here
+                    for other in running:
+                        other.cancel()
+                    raise
+                self.timings[stage.name] = (start, end)
+                self._store_result(stage, result, values)
+                done.add(stage.name)
+
+        return values
+
+    def critical_path(self, target: str = None) -> list[tuple[str, float]]:
+        """Return the chain of stages that decided when the target stage (by default the last one to finish)
+        finished in the last run, as (stage, duration in seconds), each stage waited on the one before it"""
+        if not self.timings:
+            return []
+        if target is None:
+            target = max(self.timings, key=lambda name: self.timings[name][1])
+
+        path = []
+        current = target
+        while current is not None:
+            start, end = self.timings[current]
+            path.append((current, end - start))
+            waited_for = [name for name in self.dependencies[current] if name in self.timings]
+            current = max(waited_for, key=lambda name: self.timings[name][1]) if waited_for else None
+        path.reverse()
+        return path
+
+    def report(self, target: str = None):
+        """Print the critical path of the last run"""
+        path = self.critical_path(target)
+        if not path:
+            return
+        end = self.timings[path[-1][0]][1]
+        busy = sum(stage_end - stage_start for stage_start, stage_end in self.timings.values())
+        print(
+            f"{self.name} critical path ({end * 1000:.0f}ms, {busy * 1000:.0f}ms of work in {len(self.timings)} stages): " +
+            " -> ".join(f"{name} {duration * 1000:.0f}ms" for name, duration in path)
+        )
@@ -1,6 +1,18 @@
 from os import path
 import random
 
+# candidate answers for the scenery checks when they are scored by label probability,
+# only the first token of each way of writing them counts so they must start differently
+SCENERY_CHANGE_CHECK_LABELS = {
+    "yes": ["YES", "Yes", "yes"],
+    "no": ["NO", "No", "no"],
+    "not_asked": ["NOT ASKED", "Not asked", "not asked"],
+}
+SCENERY_SANITY_CHECK_LABELS = {
+    "yes": ["YES", "Yes", "yes"],
+    "no": ["NO", "No", "no"],
+}
+
 def read_scenery_file(file_path: str) -> str:
 
     content = None
@@ -154,6 +166,23 @@ class SceneryHandler:
     def get_system_prompt_confirmation_sanity_prompt(self, last_requested_location_change: str) -> str:
         """Return the post inference confirmation prompt"""
         return f"Are the characters already at: {last_requested_location_change.replace('_', ' ').capitalize()}? Answer with a simple 'YES' or 'NO'."
+
+    def is_check_response_decided(self, response: str) -> bool:
+        """Check whether a partial answer to the location change check already settles it, a yes anywhere
+        wins so it's final right away, a no can still turn into not asked further on so it waits for the whole answer
+        unless it already says asked"""
+        lowered = response.strip().lower()
+        if "yes" in lowered or "accept" in lowered or "sure" in lowered or "yeah" in lowered or "yep" in lowered:
+            return True
+        return "asked" in lowered or "question" in lowered
+
+    def is_sanity_response_decided(self, response: str) -> bool:
+        """Check whether a partial answer to the sanity check already settles it, a yes anywhere
+        wins so it's final right away, otherwise the first sentence of the answer is taken as the answer"""
+        lowered = response.strip().lower()
+        if "yes" in lowered or "accept" in lowered or "sure" in lowered or "yeah" in lowered or "yep" in lowered:
+            return True
+        return any(terminator in lowered for terminator in (".", "!", "\n"))
     
     def get_random_scenery_change(
         self,
@@ -258,6 +258,17 @@ class StatesHandler:
         """Return the post inference confirmation prompt"""
         return "Your analysis MUST be (output ONLY in the exact format):\n\nIncrease: state1, state2, ...\nDecrease: state3, state4, ..."
     
+    def is_post_inference_response_decided(self, llm_response: str) -> bool:
+        """Check whether a partial states answer already has both of its lines complete, the decrease line
+        has to have its states on it, a decrease line on its own is followed by its states on the next lines"""
+        complete_lines = llm_response.lower().split("\n")[:-1]
+        has_increase_line = any("increase" in line or "add" in line for line in complete_lines)
+        has_decrease_line = any(
+            ("decrease" in line or "reduce" in line) and ":" in line and line.split(":", 1)[1].strip()
+            for line in complete_lines
+        )
+        return has_increase_line and has_decrease_line
+
     def analyze_response_for_states(self, llm_response: str) -> tuple[list[str], list[str], list[str]]:
         """Analyze the LLM response to determine which states to increase and decrease"""
         llm_response = llm_response.lower()
@@ -330,6 +341,42 @@ class StatesHandler:
         # but it could happen, it's a LLM kinda unpredictable thing
         return increase_states, decrease_states, remove_states
     
+    def get_structured_post_inference_instructions(self) -> str:
+        """Return the instructions for the states fields of the structured post inference analysis"""
+        return f"\"increase\": the states that should be applied or increased for {self.character_name}, at most 2\n" + \
+               f"\"decrease\": the states that should be decreased for {self.character_name}, at most 2\n" + \
+               f"Only include states that are relevant to the conversation, leave the lists empty otherwise." + \
+               f"\n\n{self.character_name} commonly experiences the following states:\n" + \
+               f"{', '.join(self.states.keys())}\n\n" + \
+               f"A list of all possible states:\n" + \
+               f"{', '.join(self.get_all_states())}\n"
+
+    def get_structured_post_inference_schema(self) -> dict:
+        """Return the json schema properties for the states fields"""
+        states_list = {
+            "type": "array",
+            "items": {"enum": self.get_all_states()},
+            "maxItems": 2,
+        }
+        return {
+            "increase": states_list,
+            "decrease": states_list,
+        }
+
+    def analyze_structured_analysis_for_states(self, analysis: dict) -> tuple[list[str], list[str], list[str]]:
+        """Read the states to increase and decrease from the parsed structured analysis"""
+        all_states = self.get_all_states()
+        increase_states = []
+        decrease_states = []
+        for state in analysis.get("increase") or []:
+            if state in all_states and state not in increase_states:
+                increase_states.append(state)
+        for state in analysis.get("decrease") or []:
+            if state in all_states and state not in decrease_states and state not in increase_states:
+                decrease_states.append(state)
+        # there is no remove in the structured analysis, same as the prompt based one
+        return increase_states, decrease_states, []
+
     def get_mini_bonuses(self, applied_states: list[list[str, int, int]]) -> int:
         """Get the number of mini bond bonuses from the applied states"""
         mini_bonuses = 0
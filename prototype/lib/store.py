@@ -0,0 +1,378 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from lib.persistence import write_chunks_atomic
+from lib.journal import (
+    ConversationLog,
+    MESSAGE_APPENDED,
+    MESSAGE_EDITED,
+    MESSAGE_DELETED,
+    BOND_UPDATED,
+    STATES_UPDATED,
+    LOCATION_VISITED,
+    FIELDS_UPDATED,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    created_at REAL NOT NULL,
+    username TEXT,
+    bond REAL NOT NULL DEFAULT 0,
+    bond_2nd REAL NOT NULL DEFAULT 0,
+    stranger INTEGER NOT NULL DEFAULT 1,
+    applied_states TEXT NOT NULL DEFAULT '[]',
+    ended TEXT,
+    -- the other plain fields of the conversation, as json
+    fields TEXT NOT NULL DEFAULT '{}',
+    -- last journal event included, and the size and time of the log files it was imported from
+    journal_seq INTEGER NOT NULL DEFAULT 0,
+    signature TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_position ON messages(session_id, position);
+CREATE INDEX IF NOT EXISTS messages_by_role ON messages(session_id, role);
+CREATE TABLE IF NOT EXISTS turn_snapshots (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    turn INTEGER NOT NULL,
+    bond REAL NOT NULL,
+    bond_2nd REAL NOT NULL,
+    stranger INTEGER NOT NULL,
+    applied_states TEXT NOT NULL,
+    PRIMARY KEY (session_id, turn)
+);
+CREATE TABLE IF NOT EXISTS visited_locations (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    location TEXT,
+    turn INTEGER NOT NULL,
+    PRIMARY KEY (session_id, location)
+);
+CREATE INDEX IF NOT EXISTS visited_by_location ON visited_locations(location);
+"""
+
+# fields of the conversation state that have their own column or table
+STATE_COLUMNS = ["history", "username", "bond", "bond_2nd", "stranger", "applied_states", "ended", "visited_locations"]
+
+def log_signature(log_path: str) -> str:
+    """Size and modification time of a log snapshot and its journal, tells if a log changed without reading it"""
+    journal_path = os.path.splitext(log_path)[0] + ".journal.jsonl"
+    parts = []
+    for file_path in [log_path, journal_path]:
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            parts.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+        else:
+            parts.append("-")
+    return "/".join(parts)
+
+class ConversationStore:
+    """Every conversation of a character in a single sqlite database, kept in sync with the conversation logs
+    by applying the same events, so listing sessions or looking across them doesn't parse the log files"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        # the journal commits from the inference threads and the UI thread, sqlite connections are per thread
+        # unless told otherwise, a single connection behind a lock is simpler
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(SCHEMA)
+        # reentrant so exporting a session can read it with the other methods while holding it
+        self.lock = threading.RLock()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def _session_id(self, name: str):
+        row = self.connection.execute("SELECT id FROM sessions WHERE name = ?", (name,)).fetchone()
+        return row["id"] if row is not None else None
+
+    def _current_turn(self, session_id: int) -> int:
+        # a turn is an answer of the character
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM messages WHERE session_id = ? AND role = 'assistant'", (session_id,)
+        ).fetchone()[0]
+
+    def _snapshot_turn(self, session_id: int):
+        """Store the bond and states the session has right now as the ones of the current turn"""
+        self.connection.execute(
+            """INSERT OR REPLACE INTO turn_snapshots (session_id, turn, bond, bond_2nd, stranger, applied_states)
+            SELECT id, ?, bond, bond_2nd, stranger, applied_states FROM sessions WHERE id = ?""",
+            (self._current_turn(session_id), session_id),
+        )
+
+    def get_session(self, name: str):
+        with self.lock:
+            return self.connection.execute("SELECT * FROM sessions WHERE name = ?", (name,)).fetchone()
+
+    def list_sessions(self) -> list:
+        """Every session with its message and turn count, newest first"""
+        with self.lock:
+            return self.connection.execute(
+                """SELECT sessions.*,
+                    (SELECT COUNT(*) FROM messages WHERE session_id = sessions.id) AS message_count,
+                    (SELECT COUNT(*) FROM messages WHERE session_id = sessions.id AND role = 'assistant') AS turn_count
+                FROM sessions ORDER BY created_at DESC"""
+            ).fetchall()
+
+    def create_session(self, name: str):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT INTO sessions (name, created_at) VALUES (?, ?)", (name, time.time()))
+
+    def rename_session(self, name: str, new_name: str):
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE sessions SET name = ? WHERE name = ?", (new_name, name))
+
+    def set_signature(self, name: str, signature: str):
+        """Mark the session as having the same conversation as the log files with the signature"""
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE sessions SET signature = ? WHERE name = ?", (signature, name))
+
+    def replace_session(self, name: str, state: dict, journal_seq: int = 0, signature: str = None):
+        """Store the whole conversation state under the name, replacing what was there"""
+        with self.lock, self.connection:
+            session_id = self._session_id(name)
+            if session_id is None:
+                session_id = self.connection.execute(
+                    "INSERT INTO sessions (name, created_at) VALUES (?, ?)", (name, time.time())
+                ).lastrowid
+            else:
+                for table in ["messages", "turn_snapshots", "visited_locations"]:
+                    self.connection.execute(f"DELETE FROM {table} WHERE session_id = ?", (session_id,))
+
+            self.connection.execute(
+                """UPDATE sessions SET username = ?, bond = ?, bond_2nd = ?, stranger = ?, applied_states = ?,
+                ended = ?, fields = ?, journal_seq = ?, signature = ? WHERE id = ?""",
+                (
+                    state.get("username"),
+                    state.get("bond", 0.0),
+                    state.get("bond_2nd", 0.0),
+                    int(state.get("stranger", True)),
+                    json.dumps(state.get("applied_states", [])),
+                    state.get("ended"),
+                    json.dumps({key: value for key, value in state.items() if key not in STATE_COLUMNS}),
+                    journal_seq,
+                    signature,
+                    session_id,
+                ),
+            )
+            self.connection.executemany(
+                "INSERT INTO messages (session_id, position, role, content) VALUES (?, ?, ?, ?)",
+                [(session_id, position, msg["role"], msg["content"]) for position, msg in enumerate(state.get("history", []))],
+            )
+            # the logs only have the final values, the earlier turns are only known from here on
+            self._snapshot_turn(session_id)
+            turn = self._current_turn(session_id)
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO visited_locations (session_id, location, turn) VALUES (?, ?, ?)",
+                [(session_id, location, turn) for location in state.get("visited_locations", [])],
+            )
+
+    def apply_events(self, name: str, events: list[dict]):
+        """Apply the events the conversation log just committed, the same ones apply_event handles"""
+        with self.lock, self.connection:
+            session_id = self._session_id(name)
+            if session_id is None:
+                session_id = self.connection.execute(
+                    "INSERT INTO sessions (name, created_at) VALUES (?, ?)", (name, time.time())
+                ).lastrowid
+
+            for event in events:
+                event_type = event["type"]
+                if event_type == MESSAGE_APPENDED:
+                    position = self.connection.execute(
+                        "SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)
+                    ).fetchone()[0]
+                    self.connection.execute(
+                        "INSERT INTO messages (session_id, position, role, content) VALUES (?, ?, ?, ?)",
+                        (session_id, position, event["message"]["role"], event["message"]["content"]),
+                    )
+                elif event_type == MESSAGE_EDITED:
+                    self.connection.execute(
+                        "UPDATE messages SET content = ? WHERE session_id = ? AND position = ?",
+                        (event["content"], session_id, event["index"]),
+                    )
+                elif event_type == MESSAGE_DELETED:
+                    self.connection.execute(
+                        "DELETE FROM messages WHERE session_id = ? AND position = ?", (session_id, event["index"])
+                    )
+                    self.connection.execute(
+                        "UPDATE messages SET position = position - 1 WHERE session_id = ? AND position > ?",
+                        (session_id, event["index"]),
+                    )
+                elif event_type == BOND_UPDATED:
+                    for key in ["bond", "bond_2nd", "stranger"]:
+                        if key in event:
+                            value = int(event[key]) if key == "stranger" else event[key]
+                            self.connection.execute(f"UPDATE sessions SET {key} = ? WHERE id = ?", (value, session_id))
+                    self._snapshot_turn(session_id)
+                elif event_type == STATES_UPDATED:
+                    self.connection.execute(
+                        "UPDATE sessions SET applied_states = ? WHERE id = ?",
+                        (json.dumps(event["applied_states"]), session_id),
+                    )
+                    self._snapshot_turn(session_id)
+                elif event_type == LOCATION_VISITED:
+                    self.connection.execute(
+                        "INSERT OR IGNORE INTO visited_locations (session_id, location, turn) VALUES (?, ?, ?)",
+                        (session_id, event["location"], self._current_turn(session_id)),
+                    )
+                elif event_type == FIELDS_UPDATED:
+                    fields = dict(event["fields"])
+                    for key in ["username", "ended"]:
+                        if key in fields:
+                            self.connection.execute(f"UPDATE sessions SET {key} = ? WHERE id = ?", (fields.pop(key), session_id))
+                    if fields:
+                        row = self.connection.execute("SELECT fields FROM sessions WHERE id = ?", (session_id,)).fetchone()
+                        self.connection.execute(
+                            "UPDATE sessions SET fields = ? WHERE id = ?",
+                            (json.dumps({**json.loads(row["fields"]), **fields}), session_id),
+                        )
+                else:
+                    raise ValueError(f"Unknown conversation event type: {event_type}")
+
+            if events:
+                self.connection.execute("UPDATE sessions SET journal_seq = ? WHERE id = ?", (events[-1]["seq"], session_id))
+
+    def load_session(self, name: str, with_history: bool = True):
+        """The conversation state of the session in the same format as the logs and the last event it includes,
+        or None if there is no such session, without the history the messages are left to be read with get_messages"""
+        with self.lock:
+            session = self.connection.execute("SELECT * FROM sessions WHERE name = ?", (name,)).fetchone()
+            if session is None:
+                return None
+            messages = []
+            if with_history:
+                messages = self.connection.execute(
+                    "SELECT role, content FROM messages WHERE session_id = ? ORDER BY position", (session["id"],)
+                ).fetchall()
+            locations = self.connection.execute(
+                "SELECT location FROM visited_locations WHERE session_id = ? ORDER BY turn, rowid", (session["id"],)
+            ).fetchall()
+
+        state = json.loads(session["fields"])
+        if with_history:
+            state["history"] = [{"role": row["role"], "content": row["content"]} for row in messages]
+        state.update({
+            "username": session["username"],
+            "bond": session["bond"],
+            "bond_2nd": session["bond_2nd"],
+            "stranger": bool(session["stranger"]),
+            "applied_states": json.loads(session["applied_states"]),
+            "visited_locations": [row["location"] for row in locations],
+        })
+        if session["ended"] is not None:
+            state["ended"] = session["ended"]
+        return state, session["journal_seq"]
+
+    def get_messages(self, name: str, start: int = 0, end: int = None) -> list[dict]:
+        """The messages of the session from start up to but not including end, read through the position index"""
+        with self.lock:
+            session_id = self._session_id(name)
+            if session_id is None:
+                return []
+            rows = self.connection.execute(
+                "SELECT role, content FROM messages WHERE session_id = ? AND position >= ? AND position < ? ORDER BY position",
+                (session_id, start, end if end is not None else 2 ** 62),
+            ).fetchall()
+        return [{"role": row["role"], "content": row["content"]} for row in rows]
+
+    def export_session(self, name: str, file_path: str, page_size: int = 500) -> int:
+        """Write the session as a conversation log snapshot, the messages a page at a time so they are never
+        all in memory, returns the last journal event the snapshot includes"""
+        with self.lock:
+            state, journal_seq = self.load_session(name, with_history=False)
+            session_id = self._session_id(name)
+            tail = json.dumps({**state, "journal_seq": journal_seq}, ensure_ascii=False)
+
+            def chunks():
+                yield '{"history": ['
+                start = 0
+                while True:
+                    rows = self.connection.execute(
+                        "SELECT role, content FROM messages WHERE session_id = ? AND position >= ? AND position < ? ORDER BY position",
+                        (session_id, start, start + page_size),
+                    ).fetchall()
+                    if not rows:
+                        break
+                    page = ", ".join(json.dumps({"role": row["role"], "content": row["content"]}, ensure_ascii=False) for row in rows)
+                    yield page if start == 0 else ", " + page
+                    start += page_size
+                # the rest of the state goes after the history, it is the same object without its opening brace
+                yield "], " + tail[1:]
+
+            write_chunks_atomic(file_path, chunks())
+        return journal_seq
+
+    def count_messages(self, name: str, roles: list[str] = None) -> int:
+        """How many messages the session has, only the ones with those roles if given"""
+        with self.lock:
+            session_id = self._session_id(name)
+            if session_id is None:
+                return 0
+            if roles is None:
+                return self.connection.execute("SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)).fetchone()[0]
+            return self.connection.execute(
+                f"SELECT COUNT(*) FROM messages WHERE session_id = ? AND role IN ({', '.join('?' for _ in roles)})",
+                (session_id, *roles),
+            ).fetchone()[0]
+
+    def get_turn_snapshots(self, name: str) -> list:
+        """The bond and states at the end of every turn that changed them"""
+        with self.lock:
+            return self.connection.execute(
+                """SELECT turn, bond, bond_2nd, stranger, applied_states FROM turn_snapshots
+                WHERE session_id = (SELECT id FROM sessions WHERE name = ?) ORDER BY turn""",
+                (name,),
+            ).fetchall()
+
+    def find_sessions_visiting(self, location: str) -> list[str]:
+        with self.lock:
+            rows = self.connection.execute(
+                """SELECT sessions.name FROM visited_locations JOIN sessions ON sessions.id = visited_locations.session_id
+                WHERE visited_locations.location = ? ORDER BY sessions.created_at""",
+                (location,),
+            ).fetchall()
+        return [row["name"] for row in rows]
+
+    def search_messages(self, text: str, limit: int = 50) -> list:
+        """Messages of any session that contain the text, newest session first"""
+        with self.lock:
+            return self.connection.execute(
+                """SELECT sessions.name, messages.position, messages.role, messages.content
+                FROM messages JOIN sessions ON sessions.id = messages.session_id
+                WHERE messages.content LIKE ? ORDER BY sessions.created_at DESC, messages.position LIMIT ?""",
+                ("%" + text + "%", limit),
+            ).fetchall()
+
+def import_json_logs(store: ConversationStore, logs_folder: str, default_state: dict, skip: list[str] = ()) -> int:
+    """Import the json conversation logs that are not in the store, or that changed since they were imported,
+    a log that didn't change is only looked at with a stat, returns how many were imported"""
+    imported = 0
+    for file_name in sorted(os.listdir(logs_folder)):
+        if not file_name.endswith(".json") or file_name == "token_cache.json" or file_name in skip:
+            continue
+        log_path = os.path.join(logs_folder, file_name)
+        signature = log_signature(log_path)
+        session = store.get_session(file_name)
+        if session is not None and session["signature"] == signature:
+            continue
+
+        log = ConversationLog(log_path)
+        state = log.load(default_state)
+        store.replace_session(file_name, state, log.seq, signature)
+        imported += 1
+        print(f"Imported conversation log {file_name} into the conversation store.")
+    return imported
@@ -0,0 +1,218 @@
+from os import path
+from collections import OrderedDict
+import hashlib
+import json
+import math
+import sys
+import threading
+
+from lib.persistence import write_text_atomic
+
+class ServerTokenCounter:
+    """Counts tokens with the model loaded in the node server, exact but needs the server up and loaded"""
+    name = "server"
+    cacheable = True
+
+    def __init__(self, inference_client, model_name: str = None):
+        self.inference_client = inference_client
+        # counts are only valid for the model that produced them
+        self.identity = f"server:{model_name}"
+
+    def count_batch(self, texts: list[str]) -> list[int]:
+        response = self.inference_client.request({"action": "count_tokens_batch", "texts": texts})
+        if response["type"] == "error":
+            raise Exception("Failed to count tokens:", response["message"])
+        return response["n_tokens"]
+
+class LocalTokenizerCounter:
+    """Counts tokens in process from a llama 3 tokenizer.json file, no network hop involved
+    role tags such as <|eot_id|> are tokenized as plain text, the same as the server does"""
+    name = "local"
+    cacheable = True
+
+    def __init__(self, tokenizer_path: str):
+        # optional dependency, only needed if this backend is selected
+        from tokenizers import Tokenizer
+        self.tokenizer_path = tokenizer_path
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.identity = f"local:{path.basename(tokenizer_path)}"
+
+    def _count(self, text: str) -> int:
+        # encode would match the special tokens as a single token each, so go through the
+        # normalizer, the pre tokenizer and the model ourselves, which knows nothing about them
+        if self.tokenizer.normalizer is not None:
+            text = self.tokenizer.normalizer.normalize_str(text)
+        pieces = [text] if self.tokenizer.pre_tokenizer is None else [piece for piece, _ in self.tokenizer.pre_tokenizer.pre_tokenize_str(text)]
+        return sum(len(self.tokenizer.model.tokenize(piece)) for piece in pieces)
+
+    def count_batch(self, texts: list[str]) -> list[int]:
+        return [self._count(text) for text in texts]
+
+class EstimatorTokenCounter:
+    """Estimates token counts from the amount of characters, the safety margin makes it err on the side
+    of more tokens so the window never overflows, calibrate it against real counts when possible"""
+    name = "estimate"
+    # counting is cheaper than hashing the text to look it up, and the counts change with every calibration
+    cacheable = False
+
+    def __init__(self, characters_per_token: float = 3.6, safety_margin: float = 1.1):
+        self.characters_per_token = characters_per_token
+        self.safety_margin = safety_margin
+
+    @property
+    def identity(self) -> str:
+        # changes with every calibration, so estimates from before it are not reused
+        return f"estimate:{self.characters_per_token:.4f}:{self.safety_margin}"
+
+    def calibrate(self, texts: list[str], counts: list[int]):
+        """Adjust the characters per token ratio from texts whose real token count is known"""
+        total_characters = sum(len(text) for text in texts)
+        total_tokens = sum(counts)
+        if total_characters == 0 or total_tokens == 0:
+            return
+        self.characters_per_token = total_characters / total_tokens
+        print(f"Token estimator calibrated to {self.characters_per_token:.2f} characters per token from {len(texts)} texts")
+
+    def count_batch(self, texts: list[str]) -> list[int]:
+        return [math.ceil(len(text) / self.characters_per_token * self.safety_margin) for text in texts]
+
+def create_token_counter(
+        counter_type: str,
+        inference_client,
+        model_name: str = None,
+        tokenizer_path: str = None,
+        characters_per_token: float = 3.6,
+        safety_margin: float = 1.1,
+    ):
+    """Create the token counter for the given type, server, local or estimate
+    the local tokenizer falls back to the estimator if it can't be loaded"""
+    if counter_type == "server":
+        return ServerTokenCounter(inference_client, model_name)
+    elif counter_type == "local":
+        if tokenizer_path and path.exists(tokenizer_path):
+            try:
+                counter = LocalTokenizerCounter(tokenizer_path)
+                print("Using local tokenizer for token counting:", tokenizer_path)
+                return counter
+            except ImportError:
+                print("Warning: the 'tokenizers' package is not installed, falling back to the token estimator.")
+            except Exception as e:
+                print(f"Warning: could not load tokenizer '{tokenizer_path}' ({e}), falling back to the token estimator.")
+        else:
+            print(f"Warning: tokenizer file '{tokenizer_path}' not found, falling back to the token estimator.")
+        return EstimatorTokenCounter(characters_per_token, safety_margin)
+    elif counter_type == "estimate":
+        return EstimatorTokenCounter(characters_per_token, safety_margin)
+    raise ValueError(f"Unknown token counter type '{counter_type}', must be one of server, local or estimate")
+
+class TokenCountCache:
+    """Token counts by content hash with least recently used eviction, bounded in entries and memory,
+    it can be saved to a file so the counts survive a restart as long as the counter is the same"""
+
+    def __init__(self, counter, cache_path: str = None, max_entries: int = 20000, max_memory: int = 4 * 1024 * 1024):
+        self.counter = counter
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+
+        # hash -> token count, the most recently used at the end
+        self.entries = OrderedDict()
+        self.memory = 0
+        self.identity = counter.identity
+        # the counts of a counter that isn't cacheable go straight through, nothing is kept or saved
+        self.enabled = counter.cacheable
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _entry_size(self, key: str, count: int) -> int:
+        return sys.getsizeof(key) + sys.getsizeof(count)
+
+    def _check_identity(self):
+        """Drop everything if the counter changed, must be called with the lock held"""
+        if self.counter.identity != self.identity:
+            print(f"Token counter changed from {self.identity} to {self.counter.identity}, clearing the token cache")
+            self.entries.clear()
+            self.memory = 0
+            self.identity = self.counter.identity
+            self.dirty = True
+
+    def _put(self, key: str, count: int):
+        """Store a count and evict the least recently used entries past the bounds, lock must be held"""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = count
+        self.memory += self._entry_size(key, count)
+        while len(self.entries) > self.max_entries or self.memory > self.max_memory:
+            old_key, old_count = self.entries.popitem(last=False)
+            self.memory -= self._entry_size(old_key, old_count)
+        self.dirty = True
+
+    def count_batch(self, texts: list[str]) -> list[int]:
+        """Return the token count of every text, the ones not cached are counted with a single call to the counter"""
+        if not self.enabled:
+            return self.counter.count_batch(texts)
+        keys = [self._key(text) for text in texts]
+        counts = {}
+        missing = {}
+        with self.lock:
+            self._check_identity()
+            for key, text in zip(keys, texts):
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    counts[key] = self.entries[key]
+                elif key not in missing:
+                    missing[key] = text
+
+        if missing:
+            # counting may be a round-trip to the server, don't hold the lock meanwhile
+            missing_counts = self.counter.count_batch(list(missing.values()))
+            with self.lock:
+                for key, count in zip(missing.keys(), missing_counts):
+                    self._put(key, count)
+                    counts[key] = count
+
+        return [counts[key] for key in keys]
+
+    def count(self, text: str) -> int:
+        return self.count_batch([text])[0]
+
+    def load(self):
+        """Load the counts saved by a previous session, ignored if they came from a different counter"""
+        if not self.enabled or not self.cache_path or not path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: could not read token cache '{self.cache_path}' ({e}), starting empty.")
+            return
+        if data.get("counter") != self.counter.identity:
+            print(f"Token cache was made by {data.get('counter')}, not {self.counter.identity}, starting empty.")
+            return
+        with self.lock:
+            self.identity = self.counter.identity
+            # saved from least to most recently used, so the order is kept
+            for key, count in data.get("entries", []):
+                self._put(key, count)
+            self.dirty = False
+        print(f"Loaded {len(self.entries)} token counts from {self.cache_path}")
+
+    def save(self):
+        """Save the counts if anything changed since the last save, the file is replaced atomically"""
+        if not self.enabled or not self.cache_path:
+            return
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                data = {
+                    "counter": self.identity,
+                    "entries": list(self.entries.items()),
+                }
+                self.dirty = False
+            write_text_atomic(self.cache_path, json.dumps(data))
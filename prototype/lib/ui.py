@@ -2,8 +2,11 @@
 from PySide6 import QtWidgets, QtCore, QtGui
 from PySide6.QtWidgets import QMainWindow, QLabel, QVBoxLayout, QWidget, QHBoxLayout
 from PySide6.QtCore import QThread, Signal, Slot
+from collections import OrderedDict
 import os
 import signal
+import threading
+import time
 import traceback
 
 def format_content(content):
@@ -42,6 +45,23 @@ def format_content(content):
 
     return formatted
 
+class IncrementalFormatter:
+    """Format content that arrives in chunks, only the new text is looked at each time
+    and whether we are inside an asterisk run is carried over from the chunk before"""
+
+    def __init__(self):
+        self.bold = False
+
+    def feed(self, text):
+        """Split the new text into (text, bold) runs, the asterisks themselves are dropped like in format_content"""
+        runs = []
+        for i, part in enumerate(text.split("*")):
+            if i > 0:
+                self.bold = not self.bold
+            if part:
+                runs.append((part, self.bold))
+        return runs
+
 def reformat_content(content):
     """Reformat content from QLabel back to plain text (removes HTML tags)"""
     # replace <br> with newlines
@@ -74,10 +94,9 @@ class RunInferenceThread(QThread):
     finished_actual = Signal()
     error = Signal(str, str)  # Emit error message and traceback
     # Signals for UI updates from worker thread
+    # the streamed text and emotions go through the UiUpdateCoalescer instead
     character_is_typing = Signal()
-    add_character_text = Signal(str)
     character_finished_typing = Signal(str)
-    showcase_emotion = Signal(str)
     add_system_text = Signal(str)
     
     def __init__(self, run_inference_function, user_input, dangling_user_message, chat_window):
@@ -112,6 +131,25 @@ class RunPostInferenceThread(QThread):
             tb = traceback.format_exc()
             self.error.emit(str(e), tb)
 
+class LoadOlderMessagesThread(QThread):
+    """Thread for reading a page of older messages without blocking UI, the ones not in memory come from disk"""
+    finished_actual = Signal(int, int, object)  # Emits the start and end of the page and its messages
+    error = Signal(str, str)  # Emit error message and traceback
+
+    def __init__(self, history, start, end):
+        super().__init__()
+        self.history = history
+        self.start_index = start
+        self.end_index = end
+
+    def run(self):
+        try:
+            messages = self.history[self.start_index:self.end_index]
+            self.finished_actual.emit(self.start_index, self.end_index, messages)
+        except Exception as e:
+            tb = traceback.format_exc()
+            self.error.emit(str(e), tb)
+
 class UserInputEventFilter(QtCore.QObject):
     """Event filter to capture Enter key presses in QTextEdit"""
     enter_pressed = Signal()
@@ -123,7 +161,147 @@ class UserInputEventFilter(QtCore.QObject):
                 return True  # Event handled
         return super().eventFilter(obj, event)
     
+class UiUpdateCoalescer(QtCore.QObject):
+    """Collects the streamed text, emotion and scroll updates coming from the worker threads and hands them
+    to the UI at most once per display frame, instead of one signal and one timer per token"""
+    # emitted from the worker thread only when nothing is waiting yet, so at most once per flush
+    updates_pending = Signal()
+
+    def __init__(self, add_text, showcase_emotion, scroll_to_bottom, frame_interval_ms=16, parent=None):
+        super().__init__(parent)
+        self.add_text = add_text
+        self.showcase_emotion = showcase_emotion
+        self.scroll_to_bottom = scroll_to_bottom
+        self.frame_interval_ms = frame_interval_ms
+
+        self.lock = threading.Lock()
+        self.text_chunks = []
+        # only the last emotion matters, None is a valid emotion so it has its own flag
+        self.emotion = None
+        self.has_emotion = False
+        self.scroll_requested = False
+        self.flush_pending = False
+        self.last_flush = 0.0
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+        # queued when emitted from a worker thread, so the flush happens on the UI thread
+        self.updates_pending.connect(self._schedule_flush)
+
+        # counters for benchmarking, see get_stats
+        self.texts_received = 0
+        self.emotions_received = 0
+        self.signals_emitted = 0
+        self.flushes = 0
+        self.text_updates = 0
+        self.emotion_updates = 0
+        self.scrolls = 0
+
+    def _mark_pending(self):
+        # must be called with the lock held, returns whether a signal has to go out
+        if self.flush_pending:
+            return False
+        self.flush_pending = True
+        self.signals_emitted += 1
+        return True
+
+    def push_text(self, text):
+        """Called from the worker thread for every streamed token"""
+        with self.lock:
+            self.text_chunks.append(text)
+            self.texts_received += 1
+            self.scroll_requested = True
+            notify = self._mark_pending()
+        if notify:
+            self.updates_pending.emit()
+
+    def push_emotion(self, emotion):
+        """Called from the worker thread whenever the emotion may have changed"""
+        with self.lock:
+            self.emotion = emotion
+            self.has_emotion = True
+            self.emotions_received += 1
+            notify = self._mark_pending()
+        if notify:
+            self.updates_pending.emit()
+
+    def request_scroll(self):
+        """Scroll to the bottom on the next flush, asking several times before then only scrolls once"""
+        with self.lock:
+            self.scroll_requested = True
+            notify = self._mark_pending()
+        if notify:
+            self.updates_pending.emit()
+
+    def _schedule_flush(self):
+        if self.timer.isActive():
+            return
+        wait_ms = self.frame_interval_ms - (time.perf_counter() - self.last_flush) * 1000
+        if wait_ms <= 0:
+            self.flush()
+        else:
+            self.timer.start(int(wait_ms))
+
+    def flush(self):
+        """Apply everything that is waiting right now, called by the timer or by whoever needs
+        the UI to be up to date before going on (e.g. when the character finishes typing)"""
+        self.timer.stop()
+        with self.lock:
+            text = "".join(self.text_chunks)
+            self.text_chunks = []
+            emotion = self.emotion
+            has_emotion = self.has_emotion
+            self.has_emotion = False
+            scroll = self.scroll_requested
+            self.scroll_requested = False
+            self.flush_pending = False
+
+        if text:
+            self.add_text(text)
+            self.text_updates += 1
+        if has_emotion:
+            self.showcase_emotion(emotion)
+            self.emotion_updates += 1
+        if scroll:
+            self.scroll_to_bottom()
+            self.scrolls += 1
+        self.flushes += 1
+        self.last_flush = time.perf_counter()
+
+    def get_stats(self):
+        return {
+            "texts_received": self.texts_received,
+            "emotions_received": self.emotions_received,
+            "signals_emitted": self.signals_emitted,
+            "flushes": self.flushes,
+            "text_updates": self.text_updates,
+            "emotion_updates": self.emotion_updates,
+            "scrolls": self.scrolls,
+        }
+
+    def reset_stats(self):
+        self.texts_received = 0
+        self.emotions_received = 0
+        self.signals_emitted = 0
+        self.flushes = 0
+        self.text_updates = 0
+        self.emotion_updates = 0
+        self.scrolls = 0
+
+# background colour of each role, the dashed border marks an assistant message that is still waiting for text
+MESSAGE_BACKGROUNDS = {
+    "user": "#D1E7DD",
+    "assistant": "#F8D7DA",
+    "system": "#E2E3E5",
+}
+MESSAGE_PADDING = 5
+MESSAGE_SPACING = 6
+
 class ChatMessage:
+    """One entry of the chat history, it holds the text and the view state of the row,
+    the widgets are only created by the view for the rows on screen"""
+
     def __init__(
             self,
             parent,
@@ -131,180 +309,199 @@ class ChatMessage:
             content,
             uninitialized=False,
             scroll_to_bottom=True,
+            older=False,
         ):
         self.parent = parent
-        self.label = QLabel()
-        if role == "user":
-            self.label.setStyleSheet("background-color: #D1E7DD; padding: 5px; border-radius: 5px;")
-        elif role == "assistant":
-            if uninitialized:
-                self.label.setStyleSheet("background-color: #F8D7DA; padding: 5px; border-radius: 5px; border: 2px dashed #6c757d;")
-            else:
-                self.label.setStyleSheet("background-color: #F8D7DA; padding: 5px; border-radius: 5px;")
-        else:
-            self.label.setStyleSheet("background-color: #E2E3E5; padding: 5px; border-radius: 5px;")
 
-        if role == "user" or role == "assistant":
-            self.label.setTextFormat(QtCore.Qt.RichText)
-            if uninitialized:
-                self.label.setText("<i>" + format_content(content) + "</i>")
-            else:
-                self.label.setText(format_content(content))
-        else:
-            self.label.setTextFormat(QtCore.Qt.PlainText)
-            self.label.setText(content)
-
-        if not uninitialized:
-            self.label.setTextInteractionFlags(QtCore.Qt.TextSelectableByMouse)
-
-        # change the cursor to one for selecting text
-        self.label.setCursor(QtCore.Qt.IBeamCursor)
-
-        # add metadata to the label for role
+        # add metadata to the message for role
         self.role = role
         self.editing = False
-        self.index = len(parent.messages)
-        self.plain_text = content
+        self.text_edit = None
+        # index in the chat history, the window may only have the messages from history_offset on
+        self.index = parent.history_offset + len(parent.messages)
+        # while streaming the text is kept in chunks and only joined when someone reads it
+        self._plain_text = content
+        self._plain_text_chunks = []
         self.uninitialized = uninitialized
+        # while streaming the text goes into a document we keep appending to, see append_text
+        self.streaming = False
+        self.stream_document = None
+        self.stream_cursor = None
+        self.stream_formatter = None
+        # (width, height) the row was last laid out at, so scrolling doesn't lay the text out again
+        self.size_cache = None
+        # bumped whenever what the row shows changes, so cached documents are thrown away
+        self.version = 0
+
+        if older:
+            # the window puts a whole page of older messages at the top at once, see load_older_messages
+            return
+
+        # add the message to the end of the chat history
+        parent.chat_history_model.append_message(self)
 
-        # add a context menu to copy text
-        self.label.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
-        if not uninitialized and role in ["user", "assistant"]:
-            self.label.customContextMenuRequested.connect(self._show_context_menu)
-        
-        self.label.setWordWrap(True)
-
-        # add the label to the chat history layout before the stretch
-        layout = parent.chat_history_container.widget().layout()
-        layout.insertWidget(layout.count() - 1, self.label)
-        
         # scroll to bottom
         if scroll_to_bottom:
-            QtCore.QTimer.singleShot(100, self.parent._scroll_to_bottom)
+            self.parent.ui_updates.request_scroll()
 
         if role in ["user", "assistant"]:
             parent.messages.append(self)
 
-    def reinsert_into_layout(self, layout):
-        layout.insertWidget(layout.count() - 1, self.label)
+    def create_document(self):
+        """Lay the message out as rich text, the delegate calls this for the rows it paints"""
+        document = QtGui.QTextDocument()
+        document.setDocumentMargin(MESSAGE_PADDING)
+        if self.role == "user" or self.role == "assistant":
+            if self.uninitialized:
+                document.setHtml("<i>" + format_content(self.plain_text) + "</i>")
+            else:
+                document.setHtml(format_content(self.plain_text))
+        else:
+            document.setPlainText(self.plain_text)
+        return document
+
+    def _changed(self, relayout=True):
+        """Tell the view the row has to be painted again, and measured again if its text changed"""
+        if relayout:
+            self.size_cache = None
+            self.version += 1
+        self.parent.chat_history_model.message_changed(self, relayout)
 
     def unmark_uninitialized(self):
         if self.uninitialized:
             self.uninitialized = False
-
-            self.label.setTextInteractionFlags(QtCore.Qt.TextSelectableByMouse)
-            self.label.customContextMenuRequested.connect(self._show_context_menu)
-
-            # remove the dashed border
-            if self.role == "assistant":
-                self.label.setStyleSheet("background-color: #F8D7DA; padding: 5px; border-radius: 5px;")
+            # remove the dashed border and the italics
+            self._changed()
 
     def is_uninitialized(self):
         return self.uninitialized
-    
+
+    @property
+    def plain_text(self):
+        if self._plain_text_chunks:
+            self._plain_text += "".join(self._plain_text_chunks)
+            self._plain_text_chunks = []
+        return self._plain_text
+
+    @plain_text.setter
+    def plain_text(self, value):
+        self._plain_text = value
+        self._plain_text_chunks = []
+
     def setText(self, new_plain_text):
+        self.streaming = False
+        self.stream_document = None
+        self.stream_cursor = None
+        self.stream_formatter = None
         self.plain_text = new_plain_text
-        self.label.setText(format_content(new_plain_text))
+        self._changed()
+
+    def start_streaming(self):
+        """Keep a document for the row that streamed text is appended to, so only the new part is laid out"""
+        if self.streaming:
+            return
+        self.streaming = True
+        self.stream_document = self.create_document()
+        self.stream_cursor = QtGui.QTextCursor(self.stream_document)
+        self.stream_cursor.movePosition(QtGui.QTextCursor.End)
+        self.stream_formatter = IncrementalFormatter()
+        # carry over an open asterisk from the text that is already there
+        self.stream_formatter.bold = self.plain_text.count("*") % 2 == 1
+
+    def append_text(self, text):
+        """Append streamed text, only the new text is formatted and laid out"""
+        if not self.streaming:
+            self.start_streaming()
+        self._plain_text_chunks.append(text)
+
+        for run, bold in self.stream_formatter.feed(text):
+            char_format = QtGui.QTextCharFormat()
+            char_format.setFontWeight(QtGui.QFont.Bold if bold else QtGui.QFont.Normal)
+            self.stream_cursor.insertText(run, char_format)
+
+        # the row only has to be measured again when the text grew a line
+        height = self.stream_document.size().height()
+        relayout = self.size_cache is None or self.size_cache[1] != height
+        if relayout:
+            self.size_cache = (self.stream_document.textWidth(), height)
+        self.parent.chat_history_model.message_changed(self, relayout)
+
+    def finish_streaming(self):
+        """Stop appending, the row goes back to being laid out from the whole text when painted"""
+        if not self.streaming:
+            return
+        self.streaming = False
+        self.stream_document = None
+        self.stream_cursor = None
+        self.stream_formatter = None
+        self._changed()
 
     def reIndex(self, new_index):
         self.index = new_index
 
+    def model_index(self):
+        return self.parent.chat_history_model.index_of(self)
+
     def start_edit_mode(self):
         """Switch the message to edit mode"""
         if not self.editing:
-            self.editing = True
-
-            # replace the label with a QTextEdit
-            self.text_edit = QtWidgets.QTextEdit()
-            # make text_edit plain text
-            self.text_edit.setPlainText(self.plain_text)
-            self.text_edit.setStyleSheet("background-color: #fff3cd; padding: 5px; border-radius: 5px;")
-            
-            # Make it grow with content - no scrollbars
-            self.text_edit.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
-            self.text_edit.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
-            self.text_edit.setSizeAdjustPolicy(QtWidgets.QAbstractScrollArea.AdjustToContents)
-            
-            # Calculate height based on document
-            doc_height = self.text_edit.document().size().height()
-            self.text_edit.setMinimumHeight(int(doc_height) + 20)
-            
-            # Update height when content changes
-            self.text_edit.textChanged.connect(self._update_text_edit_height)
-
-            # trigger _update_text_edit_height to set initial height after some time because it is not doing so
-            # add scroll to bottom after layout is updated
-            QtCore.QTimer.singleShot(100, lambda: self._update_text_edit_height(scroll_to_bottom=True))
-
-            # set the custom context menu
-            self.text_edit.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
-            self.text_edit.customContextMenuRequested.connect(self._show_context_menu)
-            
-            layout = self.parent.chat_history_container.widget().layout()
-            layout.replaceWidget(self.label, self.text_edit)
-            self.label.hide()
-            self.text_edit.show()
-
-            # focus the text edit
-            self.text_edit.setFocus()
-    
-    def _update_text_edit_height(self, scroll_to_bottom=False):
-        """Update text edit height based on content"""
-        if hasattr(self, 'text_edit') and self.text_edit:
-            doc_height = self.text_edit.document().size().height()
-            self.text_edit.setMinimumHeight(int(doc_height) + 20)
-
-            if scroll_to_bottom:
-                # Move cursor to end and keep focus
-                cursor = self.text_edit.textCursor()
-                cursor.movePosition(QtGui.QTextCursor.End)
-                self.text_edit.setTextCursor(cursor)
-                self.text_edit.setFocus()
-                
-                # Scroll to show the entire text edit, focusing on the bottom
-                # Use negative yMargin to ensure bottom is visible
-                QtCore.QTimer.singleShot(50, lambda: self.parent.chat_history_container.ensureWidgetVisible(
-                    self.text_edit, 0, 100
-                ))
+            self.finish_streaming()
+            # the delegate creates the editor and calls back into attach_editor
+            view = self.parent.chat_history_view
+            index = self.model_index()
+            view.openPersistentEditor(index)
+            view.scrollTo(index)
+
+    def attach_editor(self, text_edit):
+        self.editing = True
+        self.text_edit = text_edit
+
+        # make text_edit plain text
+        self.text_edit.setPlainText(self.plain_text)
+        self.text_edit.setStyleSheet("background-color: #fff3cd; padding: 5px; border-radius: 5px;")
+
+        # Make it grow with content - no scrollbars
+        self.text_edit.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.text_edit.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+
+        # Update the row height when content changes
+        self.text_edit.document().documentLayout().documentSizeChanged.connect(lambda size: self._changed())
+
+        # set the custom context menu
+        self.text_edit.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
+        self.text_edit.customContextMenuRequested.connect(self._show_context_menu)
+
+        # Move cursor to end and focus the text edit
+        cursor = self.text_edit.textCursor()
+        cursor.movePosition(QtGui.QTextCursor.End)
+        self.text_edit.setTextCursor(cursor)
+        QtCore.QTimer.singleShot(0, self.text_edit.setFocus)
+        self._changed()
+
+    def _close_editor(self):
+        view = self.parent.chat_history_view
+        self.editing = False
+        self.text_edit = None
+        view.closePersistentEditor(self.model_index())
+        self._changed()
 
     def cancel_edit_mode(self):
         """Cancel edit mode and revert to original text"""
         if self.editing:
-            self.editing = False
-
-            # replace the QTextEdit with the label
-            layout = self.parent.chat_history_container.widget().layout()
-            layout.replaceWidget(self.text_edit, self.label)
-            self.text_edit.hide()
-            self.label.show()
-
-            # delete the text edit
-            self.text_edit.deleteLater()
-            self.text_edit = None
+            self._close_editor()
 
     def finish_edit_mode(self):
         """Finish edit mode and save changes"""
         if self.editing:
             new_text = self.text_edit.toPlainText()
             self.setText(new_text)
+            self._close_editor()
 
-            self.editing = False
-
-            # replace the QTextEdit with the label
-            layout = self.parent.chat_history_container.widget().layout()
-            layout.replaceWidget(self.text_edit, self.label)
-            self.text_edit.hide()
-            self.label.show()
-
-            # delete the text edit
-            self.text_edit.deleteLater()
-            self.text_edit = None
-                        
             self.parent.on_message_edited(self.index, new_text)
 
     def _show_context_menu(self, position):
-        """Show context menu for copying text"""
-        widget = self.label if not self.editing else self.text_edit
+        """Show context menu for copying text, the position is relative to the editor in edit mode, or the view otherwise"""
+        widget = self.text_edit if self.editing else self.parent.chat_history_view.viewport()
         
         menu = QtWidgets.QMenu()
         copy_action = menu.addAction("Copy")
@@ -328,40 +525,229 @@ class ChatMessage:
         if action == copy_action:
             clipboard = QtWidgets.QApplication.clipboard()
             # copy the selected text if any, else copy all text
-            if self.editing:
+            if self.editing and self.text_edit.textCursor().hasSelection():
                 # in edit mode it is already plain text
-                if self.text_edit.textCursor().hasSelection():
-                    clipboard.setText(self.text_edit.textCursor().selectedText())
-                else:
-                    clipboard.setText(self.text_edit.toPlainText())
+                clipboard.setText(self.text_edit.textCursor().selectedText().replace("\u2029", "\n"))
+            elif self.editing:
+                clipboard.setText(self.text_edit.toPlainText())
             else:
-                if self.label.hasSelectedText():
-                    clipboard.setText(reformat_content(self.label.selectedText()))
-                else:
-                    clipboard.setText(self.plain_text)
+                clipboard.setText(self.plain_text)
         elif action == edit_action and edit_action is not None:
-            # get the message object for that index
-            message_obj = self
             # change the message to edit mode
-            # call the method on the main thread somehow
-            message_obj.start_edit_mode()
+            self.start_edit_mode()
         elif action == save_action and save_action is not None:
-            # get the message object for that index
-            message_obj = self.parent.messages[self.index]
-            message_obj.finish_edit_mode()
+            self.finish_edit_mode()
         elif action == cancel_action and cancel_action is not None:
-            # get the message object for that index
             self.cancel_edit_mode()
         elif action == delete_action and delete_action is not None:
             self.parent.on_message_deleted(self.index)
-            self.label.deleteLater()
+            self.parent.chat_history_model.remove_message(self)
+
+class ChatHistoryModel(QtCore.QAbstractListModel):
+    """Every entry shown in the chat history, including system text that is not part of the messages"""
+
+    # a row changed size and has to be measured again
+    layout_changed_rows = Signal(QtCore.QModelIndex)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+
+    def rowCount(self, parent=None):
+        return 0 if parent is not None and parent.isValid() else len(self.rows)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        message = self.rows[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return message.plain_text
+        if role == QtCore.Qt.UserRole:
+            return message
+        return None
+
+    def message_at(self, index):
+        return self.rows[index.row()]
+
+    def flags(self, index):
+        flags = super().flags(index)
+        if index.isValid() and self.rows[index.row()].role in ["user", "assistant"]:
+            flags |= QtCore.Qt.ItemIsEditable
+        return flags
+
+    def append_message(self, message):
+        row = len(self.rows)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self.rows.append(message)
+        self.endInsertRows()
+
+    def insert_messages(self, row, messages):
+        if not messages:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), row, row + len(messages) - 1)
+        self.rows[row:row] = messages
+        self.endInsertRows()
+
+    def remove_message(self, message):
+        row = self.index_of(message).row()
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+        del self.rows[row]
+        self.endRemoveRows()
+
+    def index_of(self, message):
+        # messages that change are nearly always the last ones, so look from the end
+        for row in range(len(self.rows) - 1, -1, -1):
+            if self.rows[row] is message:
+                return self.index(row)
+        return QtCore.QModelIndex()
+
+    def message_changed(self, message, relayout=True):
+        index = self.index_of(message)
+        if not index.isValid():
+            return
+        if relayout:
+            # the view only measures rows again when the delegate says the size changed
+            self.layout_changed_rows.emit(index)
+        self.dataChanged.emit(index, index)
+
+class ChatMessageDelegate(QtWidgets.QStyledItemDelegate):
+    """Paints each message as a rounded box with its rich text, the documents of the rows
+    painted last are kept so scrolling back and forth doesn't lay them out again"""
+
+    def __init__(self, parent=None, cache_size=256):
+        super().__init__(parent)
+        self.cache_size = cache_size
+        # id of the message -> (message, version, document)
+        self.documents = OrderedDict()
+
+    def _document(self, message, width):
+        if message.streaming:
+            document = message.stream_document
+        else:
+            key = id(message)
+            cached = self.documents.get(key)
+            if cached is not None and cached[0] is message and cached[1] == message.version:
+                self.documents.move_to_end(key)
+                document = cached[2]
+            else:
+                document = message.create_document()
+                self.documents[key] = (message, message.version, document)
+                if len(self.documents) > self.cache_size:
+                    self.documents.popitem(last=False)
+        if document.textWidth() != width:
+            document.setTextWidth(width)
+        return document
+
+    def _width(self, option):
+        return max(option.rect.width() - MESSAGE_SPACING * 2, 50)
+
+    def sizeHint(self, option, index):
+        message = index.model().message_at(index)
+        width = self._width(option)
+        if message.editing and message.text_edit is not None:
+            return QtCore.QSize(width, int(message.text_edit.document().size().height()) + 20 + MESSAGE_SPACING)
+        if message.size_cache is None or message.size_cache[0] != width:
+            message.size_cache = (width, self._document(message, width).size().height())
+        return QtCore.QSize(width, int(message.size_cache[1]) + MESSAGE_SPACING)
+
+    def paint(self, painter, option, index):
+        message = index.model().message_at(index)
+        if message.editing:
+            return
+        width = self._width(option)
+        document = self._document(message, width)
+
+        painter.save()
+        box = QtCore.QRectF(option.rect.x() + MESSAGE_SPACING, option.rect.y() + MESSAGE_SPACING / 2, width, document.size().height())
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        if message.role == "assistant" and message.uninitialized:
+            painter.setPen(QtGui.QPen(QtGui.QColor("#6c757d"), 2, QtCore.Qt.DashLine))
+        else:
+            painter.setPen(QtCore.Qt.NoPen)
+        painter.setBrush(QtGui.QColor(MESSAGE_BACKGROUNDS.get(message.role, MESSAGE_BACKGROUNDS["system"])))
+        painter.drawRoundedRect(box, 5, 5)
+        painter.translate(box.topLeft())
+        document.drawContents(painter)
+        painter.restore()
+
+    def createEditor(self, parent, option, index):
+        message = index.model().message_at(index)
+        text_edit = QtWidgets.QTextEdit(parent)
+        message.attach_editor(text_edit)
+        return text_edit
+
+    def updateEditorGeometry(self, editor, option, index):
+        editor.setGeometry(option.rect.adjusted(MESSAGE_SPACING, MESSAGE_SPACING // 2, -MESSAGE_SPACING, -MESSAGE_SPACING // 2))
+
+    def setEditorData(self, editor, index):
+        # the text is set once when the editor is attached, don't overwrite what is being typed
+        pass
+
+    def setModelData(self, editor, model, index):
+        # saving goes through the context menu, see ChatMessage.finish_edit_mode
+        pass
+
+    def eventFilter(self, editor, event):
+        # the editor is only closed by save and cancel, not by losing focus, tab or escape
+        return False
+
+class ChatHistoryView(QtWidgets.QListView):
+    """List of the chat history messages, only the rows on screen are painted and the editor
+    of a message is the only widget that is ever created for a row"""
+
+    def __init__(self, model, parent=None):
+        super().__init__(parent)
+        self.setModel(model)
+        self.delegate = ChatMessageDelegate(self)
+        self.setItemDelegate(self.delegate)
+        model.layout_changed_rows.connect(self.delegate.sizeHintChanged)
+
+        # rows have different heights, scroll by pixel so long messages don't jump
+        self.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.setResizeMode(QtWidgets.QListView.Adjust)
+        # lay long histories out a batch at a time instead of all at once at startup
+        self.setLayoutMode(QtWidgets.QListView.Batched)
+        self.setBatchSize(50)
+        self.setUniformItemSizes(False)
+        self.setWordWrap(True)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        self.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.setFocusPolicy(QtCore.Qt.NoFocus)
+        self.setStyleSheet("QListView { background: transparent; border: none; }")
+
+        # the context menu belongs to the message under the cursor
+        self.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
+        self.customContextMenuRequested.connect(self._show_context_menu)
+
+        # for benchmarking the streamed updates
+        self.paint_count = 0
+
+    def paintEvent(self, event):
+        self.paint_count += 1
+        super().paintEvent(event)
+
+    def _show_context_menu(self, position):
+        index = self.indexAt(position)
+        if not index.isValid():
+            return
+        message = index.model().message_at(index)
+        if message.uninitialized or message.role not in ["user", "assistant"]:
+            return
+        message._show_context_menu(position)
 
 class ChatWindow(QMainWindow):
-    def __init__(self, character_name, initial_chat_history, username):
+    def __init__(self, character_name, initial_chat_history, username, history_page_size=100):
         super().__init__()
 
         self.post_inference_thread = None
         self.inference_thread = None
+        # blocking waits for the post inference before running the next inference, optimistic doesn't
+        self.post_inference_policy = "blocking"
+        # post inference runs asked for while one was already running, they go one after the other
+        self.queued_post_inference_runs = 0
+        # called when the window closes, see set_close_function
+        self.close_function = None
 
         self.do_not_run_post_inference = False
 
@@ -377,6 +763,14 @@ class ChatWindow(QMainWindow):
         self.messages = []
         self.username = username
 
+        # only the last page of the history is shown at first, older pages are added as the user scrolls up
+        self.history = initial_chat_history
+        self.history_page_size = history_page_size
+        # index in the history of the first message shown
+        self.history_offset = max(0, len(initial_chat_history) - history_page_size)
+        # reads the page before history_offset while the user keeps scrolling, one page at a time
+        self.load_older_thread = None
+
         # add a status label
         self.status_label = QLabel("Status: Ready", self)
         self.status_label.setAlignment(QtCore.Qt.AlignCenter)
@@ -395,10 +789,14 @@ class ChatWindow(QMainWindow):
         # ensure that the status label and emotion label share the space equally
         labels_layout.setStretch(1, 1)
 
-        # create a container for the chat history that is scrollable
-        self.chat_history_container = QtWidgets.QScrollArea()
-        self.chat_history_container.setWidgetResizable(True)
-        layout.addWidget(self.chat_history_container)
+        # streamed text, emotions and scrolling reach the UI at most once per frame
+        self.ui_updates = UiUpdateCoalescer(self._add_character_text, self._showcase_emotion, self._scroll_to_bottom, parent=self)
+
+        # the chat history is a model/view list so only the messages on screen are laid out and painted
+        self.chat_history_model = ChatHistoryModel(self)
+        self.chat_history_view = ChatHistoryView(self.chat_history_model)
+        self.chat_history_view.verticalScrollBar().valueChanged.connect(self._on_history_scrolled)
+        layout.addWidget(self.chat_history_view)
 
         # add a text entry at the bottom for user input, the input should grow in a multiline fashion and not overflow
         # horizontally but vertically instead
@@ -430,25 +828,16 @@ class ChatWindow(QMainWindow):
         self.user_input.installEventFilter(self.user_input_event_filter)
         self.user_input_event_filter.enter_pressed.connect(self._on_user_input_enter)
 
-        # Create a widget and layout for the scroll area content
-        chat_content_widget = QWidget()
-        chat_content_layout = QVBoxLayout()
-        chat_content_widget.setLayout(chat_content_layout)
-        self.chat_history_container.setWidget(chat_content_widget)
-
-        # Add stretch to push content to top
-        chat_content_layout.addStretch()
-
-        # Add initial chat history to the layout
-        for msg in initial_chat_history:
+        # Add the last page of the initial chat history to the view
+        for msg in initial_chat_history[self.history_offset:]:
             content = msg["content"]
             self._add_message_label(msg["role"], content)
         
         # Scroll to bottom after UI is fully rendered (use longer delay to ensure layout is complete)
         QtCore.QTimer.singleShot(100, self._scroll_to_bottom)
+        # if the last page doesn't fill the view there is no scrolling up to ask for more
+        QtCore.QTimer.singleShot(100, lambda: self._on_history_scrolled(self.chat_history_view.verticalScrollBar().value()))
         
-        # make a copy to avoid potential mutation issues
-        self.initial_chat_history = initial_chat_history.copy()
         self.has_initialized_first = False
 
     def _add_message_label(
@@ -487,29 +876,66 @@ class ChatWindow(QMainWindow):
     def on_message_edited(self, index, new_content):
         self.edit_message_function(index, new_content)
 
-        # also update the initial chat history to reflect the change if has_initialized_first is still false
-        if not self.has_initialized_first:
-            if 0 <= index < len(self.initial_chat_history):
-                self.initial_chat_history[index]["content"] = new_content
-
     def on_message_deleted(self, index):
         self.delete_message_function(index)
 
-        # also update the initial chat history to reflect the change if has_initialized_first is still false
-        if not self.has_initialized_first:
-            if 0 <= index < len(self.initial_chat_history):
-                del self.initial_chat_history[index]
-
         # delete from messages list
-        del self.messages[index]
+        position = index - self.history_offset
+        del self.messages[position]
         # re-index remaining messages
-        for i in range(index, len(self.messages)):
-            self.messages[i].reIndex(i)
+        for i in range(position, len(self.messages)):
+            self.messages[i].reIndex(self.history_offset + i)
+
+    def _on_history_scrolled(self, value):
+        if value == self.chat_history_view.verticalScrollBar().minimum() and self.history_offset > 0:
+            self.load_older_messages()
+
+    def load_older_messages(self):
+        """Read the page of messages before the first one shown, it goes at the top of the chat history once read"""
+        if self.load_older_thread is not None:
+            return
+        start = max(0, self.history_offset - self.history_page_size)
+        self.load_older_thread = LoadOlderMessagesThread(self.history, start, self.history_offset)
+        self.load_older_thread.finished_actual.connect(self._on_older_messages_loaded)
+        self.load_older_thread.error.connect(self._on_older_messages_error)
+        self.load_older_thread.start()
+
+    def _on_older_messages_error(self, error_msg, traceback_str):
+        """Called if reading older messages fails, scrolling up again tries once more"""
+        self.load_older_thread = None
+        self.update_status(error_msg, "Error")
+        print(traceback_str)
+
+    def _on_older_messages_loaded(self, start, end, messages):
+        """Put the page that was read at the top of the chat history"""
+        self.load_older_thread = None
+        if end != self.history_offset:
+            # the messages shown changed while it was read, read it again if the view is still at the top
+            self._on_history_scrolled(self.chat_history_view.verticalScrollBar().value())
+            return
+        older = [
+            ChatMessage(parent=self, role=msg["role"], content=msg["content"], scroll_to_bottom=False, older=True)
+            for msg in messages
+        ]
+        self.history_offset = start
+        self.messages[:0] = [message for message in older if message.role in ["user", "assistant"]]
+        for i, message in enumerate(self.messages):
+            message.reIndex(self.history_offset + i)
+
+        self.chat_history_model.insert_messages(0, older)
+        # keep the message that was at the top where it was instead of jumping to the new ones
+        if older and len(self.chat_history_model.rows) > len(older):
+            # the view has to lay the new rows out before it knows where that message is now, all at once
+            # since it is only a page, batches would move the message down after we scrolled to it
+            view = self.chat_history_view
+            view.setLayoutMode(QtWidgets.QListView.SinglePass)
+            view.executeDelayedItemsLayout()
+            view.scrollTo(self.chat_history_model.index(len(older)), QtWidgets.QAbstractItemView.PositionAtTop)
+            view.setLayoutMode(QtWidgets.QListView.Batched)
 
     def _scroll_to_bottom(self):
         """Helper method to scroll chat history to bottom"""
-        scrollbar = self.chat_history_container.verticalScrollBar()
-        scrollbar.setValue(scrollbar.maximum())
+        self.chat_history_view.scrollToBottom()
 
     def closeEvent(self, event):
         """Override Qt's closeEvent to call cleanup before closing"""
@@ -538,7 +964,7 @@ class ChatWindow(QMainWindow):
             self.has_initialized_first = True
             # find the last user or assistant message in initial chat history
             dangling_message = None
-            for msg in reversed(self.initial_chat_history):
+            for msg in reversed(self.history):
                 if msg["role"] == "user":
                     dangling_message = msg["content"]
                     break
@@ -574,18 +1000,17 @@ class ChatWindow(QMainWindow):
         
         # Connect thread signals to main thread slots
         self.inference_thread.character_is_typing.connect(self._character_is_typing)
-        self.inference_thread.add_character_text.connect(self._add_character_text)
         self.inference_thread.character_finished_typing.connect(self._character_finished_typing)
         self.inference_thread.finished_actual.connect(self._on_inference_finished)
         self.inference_thread.error.connect(self._on_inference_error)
-        self.inference_thread.showcase_emotion.connect(self._showcase_emotion)
         self.inference_thread.add_system_text.connect(self._add_system_text)
         
         # check if there is a post inference thread running and if it is, not start inference
         # the cleanup of post inference thread will start the next inference if needed
         # basically we only start the inference thread if there is no post inference thread running
         # if it is running the post inference thread will start the next inference when it is done
-        if self.post_inference_thread is None:
+        # in optimistic mode the inference doesn't wait and uses the last committed state instead
+        if self.post_inference_thread is None or self.post_inference_policy == "optimistic":
             self.inference_thread.start()
 
     @Slot()
@@ -594,10 +1019,9 @@ class ChatWindow(QMainWindow):
         # this basically means to add a new entry with empty text for the assistant
         self._add_message_label("assistant", self.character_name + " is answering...", scroll_to_bottom=True, uninitialized=True)
     
-    @Slot(str)
     def _add_character_text(self, text):
-        """Slot called from worker thread - safe for UI updates"""
-        # find the last label which should be from assistant
+        """Called by the coalescer on the UI thread with all the text streamed since the last frame"""
+        # find the last message which should be from assistant
         last_message = self.messages[-1]
         if last_message.role == "assistant":
             # if it is uninitialized, replace the text whole
@@ -605,21 +1029,19 @@ class ChatWindow(QMainWindow):
                 last_message.setText(text)
                 last_message.unmark_uninitialized()
             else:
-                # append text
-                current_text = last_message.plain_text
-                new_text = current_text + text
-                last_message.setText(new_text)
-
-        # scroll to bottom
-        QtCore.QTimer.singleShot(100, self._scroll_to_bottom)
+                # only the new text is formatted and laid out
+                last_message.append_text(text)
     
     @Slot(str)
     def _character_finished_typing(self, ended=None):
         """Slot called from worker thread - safe for UI updates"""
-        # find the last assistant label and enable selection and editing
+        # the last tokens may still be waiting for the next frame
+        self.ui_updates.flush()
+        # find the last assistant message and enable selection and editing
         last_message = self.messages[-1]
         if last_message.role == "assistant":
             last_message.unmark_uninitialized()
+            last_message.finish_streaming()
 
         if ended:
             self.ended = ended
@@ -645,6 +1067,11 @@ class ChatWindow(QMainWindow):
         """Run post inference tasks in background thread"""
         if self.ended:
             return  # do not run post inference if chat has ended
+
+        if self.post_inference_thread is not None:
+            # only possible in optimistic mode, a turn finished while the previous one was still being analysed
+            self.queued_post_inference_runs += 1
+            return
         
         # call the post inference function in another thread
         # add message for status about running post inference tasks
@@ -658,7 +1085,14 @@ class ChatWindow(QMainWindow):
     def _on_post_inference_finished(self):
         """Called when post inference tasks are finished"""
         self.post_inference_thread = None  # clean up the thread reference
+        if self.queued_post_inference_runs > 0 and not self.ended and not self.errored:
+            self.queued_post_inference_runs -= 1
+            self.run_post_inference()
+            return
         self.update_status("Ready")
+        if self.post_inference_policy == "optimistic":
+            # the inference never waited for us, it handles the chat blocking by itself
+            return
         if not self.ended and not self.errored and self.inference_thread is not None:
             # start the next inference if needed
             self.inference_thread.start()
@@ -708,8 +1142,19 @@ class ChatWindow(QMainWindow):
             self.update_status("Chat has ended: " + ended)
             self.block_chat()
 
+    def set_post_inference_policy(self, policy: str):
+        """Set whether the next inference waits for the post inference, blocking or optimistic"""
+        self.post_inference_policy = policy
+
+    def set_close_function(self, close_function):
+        """Set a function that is called when the window closes, before the process is terminated"""
+        self.close_function = close_function
+
     def _on_window_close(self):
         """Called when window is closed - terminate application"""
+        if self.close_function is not None:
+            # e.g. wait for the pending writes, the threads are killed right after
+            self.close_function()
         # Force terminate the entire process (kills all threads)
         os.kill(os.getpid(), signal.SIGTERM)
 
@@ -718,11 +1163,18 @@ class ChatWindow(QMainWindow):
         self.inference_thread.character_is_typing.emit()
 
     def add_character_text(self, text):
-        # trigger the event from the thread, this is called from the inference thread
-        self.inference_thread.add_character_text.emit(text)
+        # called from the inference thread, the text is buffered until the next frame
+        self.ui_updates.push_text(text)
 
     def showcase_emotion(self, emotion: str):
-        self.inference_thread.showcase_emotion.emit(emotion)
+        # called from the inference thread, only the last emotion of a frame is shown
+        self.ui_updates.push_emotion(emotion)
+
+    def get_ui_update_stats(self):
+        """Counters of the streamed UI updates and of the chat history repaints, for benchmarking"""
+        stats = self.ui_updates.get_stats()
+        stats["repaints"] = self.chat_history_view.paint_count
+        return stats
 
     def showcase_emotion_from_prepare(self, emotion: str):
         self.prepare_thread.showcase_emotion.emit(emotion)
@@ -758,4 +1210,5 @@ class ChatWindow(QMainWindow):
     @Slot(str)
     def _add_system_text(self, text):
         """Slot called from worker thread - safe for UI updates"""
+        self.ui_updates.flush()
         self._add_message_label("system", text, scroll_to_bottom=True)
\ No newline at end of file
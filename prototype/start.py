@@ -3,13 +3,24 @@ from sys import argv
 from os import path
 import os
 import json
-from lib.bonds import BondsHandler
-from lib.emotion import EmotionHandler
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from lib.bonds import BondsHandler, SENTIMENT_CLASSIFICATION_PREFILL, SENTIMENT_CLASSIFICATION_LABELS, SENTIMENT_CLASSIFICATION_INTENSITIES, SENTIMENT_POLARITY_LABELS
+from lib.emotion import EmotionHandler, merge_triggered_states
+from lib.emotion_worker import EmotionWorker
 from lib.states import StatesHandler
-from lib.scenery import SceneryHandler
+from lib.scenery import SceneryHandler, SCENERY_CHANGE_CHECK_LABELS, SCENERY_SANITY_CHECK_LABELS
 from lib.ui import ChatWindow
+from lib.inference import InferenceClient, AdaptiveTokenBudget
+from lib.pipeline import Pipeline
+from lib.history import HistoryTokenIndex, PagedHistory
+from lib.tokens import create_token_counter, EstimatorTokenCounter, TokenCountCache
+from lib.store import ConversationStore, import_json_logs, log_signature
+from lib.archive import ConversationArchive
+from lib.persistence import PersistenceWorker, write_text_atomic
+from lib.journal import ConversationLog, MESSAGE_APPENDED, MESSAGE_EDITED, MESSAGE_DELETED, BOND_UPDATED, STATES_UPDATED, LOCATION_VISITED, FIELDS_UPDATED
 from PySide6.QtWidgets import QApplication
-import websocket
 
 CONTEXT_WINDOW_SIZE = 8192
 REPEAT_PENALTY = 1.1
@@ -17,6 +28,42 @@ FREQUENCY_PENALTY = 0.0
 PRESENCE_PENALTY = 0.0
 TEMPERATURE = 1.0
 TOP_P = 0.9
+# how to count tokens for the context window, server, local (tokenizer.json file) or estimate
+TOKEN_COUNTER = "server"
+TOKENIZER_PATH = None
+ESTIMATOR_CHARACTERS_PER_TOKEN = 3.6
+ESTIMATOR_SAFETY_MARGIN = 1.1
+# sequential runs the post inference analysis calls one after the other, concurrent overlaps them,
+# combined asks for everything in a single call constrained to a json schema
+POST_INFERENCE_MODE = "sequential"
+# sliding drops the oldest messages every turn, stable evicts in chunks so the prompt prefix
+# stays identical across turns and the server can reuse it, the hysteresis is the fraction freed
+WINDOW_MODE = "sliding"
+WINDOW_HYSTERESIS = 0.25
+# how the yes/no and sentiment checks are answered, sample generates an answer and looks for keywords,
+# logprobs scores the candidate labels from the next token probabilities in a single forward pass
+CLASSIFICATION_MODE = "sample"
+# with logprobs, a label whose probability is below this is not trusted and the check is sampled instead, 0 always trusts it
+CLASSIFICATION_MIN_CONFIDENCE = 0.0
+# blocking waits for the post inference analysis before the next turn, optimistic starts the next turn
+# right away with the last committed bond and states and applies the analysis on the turn after
+POST_INFERENCE_POLICY = "blocking"
+# json keeps the conversations only in the log files, sqlite also keeps every conversation of the character
+# in logs/conversations.db, indexed so sessions can be listed and searched without parsing the logs
+CONVERSATION_STORE = "json"
+# the server sends the streamed tokens in frames of several tokens, a frame goes out when it has this many tokens
+# or when its first token has waited this long, 0 for both sends every token on its own
+STREAM_FRAME_INTERVAL_MS = 30
+STREAM_FRAME_MAX_TOKENS = 16
+# the history is loaded and shown a page of messages at a time, newest first, with the sqlite store only the
+# last page and this many older pages are kept in memory, the rest is read back from the store when needed
+HISTORY_PAGE_SIZE = 100
+HISTORY_RESIDENT_PAGES = 8
+# how the finished conversations are compressed in logs/archive, gzip or lzma which is smaller but slower
+ARCHIVE_COMPRESSION = "gzip"
+# inline detects the emotions of the streamed reply in the inference thread, process does it in a worker process
+# so the nltk work doesn't hold the interpreter lock of the window while the reply streams
+EMOTION_DETECTION = "inline"
 
 LAST_EMOTIONS_TRIGGERED = set()
 LAST_STATES_TRIGGERED_ADD = set()
@@ -39,6 +86,9 @@ if not path.exists(character_folder):
     print("Character folder does not exist:", character_folder)
     exit(1)
 
+# every write to disk goes through here so the UI and inference threads never wait on it
+persistence_worker = PersistenceWorker()
+
 def save_settings():
     """Save current settings to settings.json"""
     global CONTEXT_WINDOW_SIZE
@@ -47,6 +97,23 @@ def save_settings():
     global PRESENCE_PENALTY
     global TEMPERATURE
     global TOP_P
+    global TOKEN_COUNTER
+    global TOKENIZER_PATH
+    global ESTIMATOR_CHARACTERS_PER_TOKEN
+    global ESTIMATOR_SAFETY_MARGIN
+    global POST_INFERENCE_MODE
+    global WINDOW_MODE
+    global WINDOW_HYSTERESIS
+    global CLASSIFICATION_MODE
+    global CLASSIFICATION_MIN_CONFIDENCE
+    global POST_INFERENCE_POLICY
+    global STREAM_FRAME_INTERVAL_MS
+    global STREAM_FRAME_MAX_TOKENS
+    global CONVERSATION_STORE
+    global HISTORY_PAGE_SIZE
+    global HISTORY_RESIDENT_PAGES
+    global ARCHIVE_COMPRESSION
+    global EMOTION_DETECTION
     global character_folder
     settings = {
         "context_window_size": CONTEXT_WINDOW_SIZE,
@@ -55,9 +122,26 @@ def save_settings():
         "presence_penalty": PRESENCE_PENALTY,
         "temperature": TEMPERATURE,
         "top_p": TOP_P,
+        "token_counter": TOKEN_COUNTER,
+        "tokenizer_path": TOKENIZER_PATH,
+        "estimator_characters_per_token": ESTIMATOR_CHARACTERS_PER_TOKEN,
+        "estimator_safety_margin": ESTIMATOR_SAFETY_MARGIN,
+        "post_inference_mode": POST_INFERENCE_MODE,
+        "window_mode": WINDOW_MODE,
+        "window_hysteresis": WINDOW_HYSTERESIS,
+        "classification_mode": CLASSIFICATION_MODE,
+        "classification_min_confidence": CLASSIFICATION_MIN_CONFIDENCE,
+        "post_inference_policy": POST_INFERENCE_POLICY,
+        "stream_frame_interval_ms": STREAM_FRAME_INTERVAL_MS,
+        "stream_frame_max_tokens": STREAM_FRAME_MAX_TOKENS,
+        "conversation_store": CONVERSATION_STORE,
+        "history_page_size": HISTORY_PAGE_SIZE,
+        "history_resident_pages": HISTORY_RESIDENT_PAGES,
+        "archive_compression": ARCHIVE_COMPRESSION,
+        "emotion_detection": EMOTION_DETECTION,
     }
-    with open(path.join(character_folder, "settings.json"), "w", encoding="utf-8") as f:
-        json.dump(settings, f, ensure_ascii=False, indent=4)
+    settings_path = path.join(character_folder, "settings.json")
+    persistence_worker.mark_dirty("settings", lambda: write_text_atomic(settings_path, json.dumps(settings, ensure_ascii=False, indent=4)))
 
 def load_settings():
     """Load settings from settings.json if it exists"""
@@ -67,6 +151,23 @@ def load_settings():
     global PRESENCE_PENALTY
     global TEMPERATURE
     global TOP_P
+    global TOKEN_COUNTER
+    global TOKENIZER_PATH
+    global ESTIMATOR_CHARACTERS_PER_TOKEN
+    global ESTIMATOR_SAFETY_MARGIN
+    global POST_INFERENCE_MODE
+    global WINDOW_MODE
+    global WINDOW_HYSTERESIS
+    global CLASSIFICATION_MODE
+    global CLASSIFICATION_MIN_CONFIDENCE
+    global POST_INFERENCE_POLICY
+    global STREAM_FRAME_INTERVAL_MS
+    global STREAM_FRAME_MAX_TOKENS
+    global CONVERSATION_STORE
+    global HISTORY_PAGE_SIZE
+    global HISTORY_RESIDENT_PAGES
+    global ARCHIVE_COMPRESSION
+    global EMOTION_DETECTION
     global character_folder
     settings_path = path.join(character_folder, "settings.json")
     if path.exists(settings_path):
@@ -78,6 +179,23 @@ def load_settings():
             PRESENCE_PENALTY = settings.get("presence_penalty", PRESENCE_PENALTY)
             TEMPERATURE = settings.get("temperature", TEMPERATURE)
             TOP_P = settings.get("top_p", TOP_P)
+            TOKEN_COUNTER = settings.get("token_counter", TOKEN_COUNTER)
+            TOKENIZER_PATH = settings.get("tokenizer_path", TOKENIZER_PATH)
+            ESTIMATOR_CHARACTERS_PER_TOKEN = settings.get("estimator_characters_per_token", ESTIMATOR_CHARACTERS_PER_TOKEN)
+            ESTIMATOR_SAFETY_MARGIN = settings.get("estimator_safety_margin", ESTIMATOR_SAFETY_MARGIN)
+            POST_INFERENCE_MODE = settings.get("post_inference_mode", POST_INFERENCE_MODE)
+            WINDOW_MODE = settings.get("window_mode", WINDOW_MODE)
+            WINDOW_HYSTERESIS = settings.get("window_hysteresis", WINDOW_HYSTERESIS)
+            CLASSIFICATION_MODE = settings.get("classification_mode", CLASSIFICATION_MODE)
+            CLASSIFICATION_MIN_CONFIDENCE = settings.get("classification_min_confidence", CLASSIFICATION_MIN_CONFIDENCE)
+            POST_INFERENCE_POLICY = settings.get("post_inference_policy", POST_INFERENCE_POLICY)
+            STREAM_FRAME_INTERVAL_MS = settings.get("stream_frame_interval_ms", STREAM_FRAME_INTERVAL_MS)
+            STREAM_FRAME_MAX_TOKENS = settings.get("stream_frame_max_tokens", STREAM_FRAME_MAX_TOKENS)
+            CONVERSATION_STORE = settings.get("conversation_store", CONVERSATION_STORE)
+            HISTORY_PAGE_SIZE = settings.get("history_page_size", HISTORY_PAGE_SIZE)
+            HISTORY_RESIDENT_PAGES = settings.get("history_resident_pages", HISTORY_RESIDENT_PAGES)
+            ARCHIVE_COMPRESSION = settings.get("archive_compression", ARCHIVE_COMPRESSION)
+            EMOTION_DETECTION = settings.get("emotion_detection", EMOTION_DETECTION)
 
             print("Settings loaded from", settings_path, ":", settings)
 
@@ -96,32 +214,99 @@ logs_folder = path.join(character_folder, "logs")
 if not path.exists(logs_folder):
     os.makedirs(logs_folder)
 
+# what a conversation that was never saved looks like
+DEFAULT_CONVERSATION = {"history": [], "username": None, "bond": 0.0, "bond_2nd": 0.0, "applied_states": [], "stranger": True, "ran_post_inference_last": True}
+
+conversation_store = None
+if CONVERSATION_STORE == "sqlite":
+    conversation_store = ConversationStore(path.join(logs_folder, "conversations.db"))
+
+# the finished conversations, compressed, only their manifest is read to know what is there
+conversation_archive = ConversationArchive(path.join(logs_folder, "archive"), compression=ARCHIVE_COMPRESSION)
+
 conversation_log_value = argv[3] if len(argv) > 3 else "last.json"
 if conversation_log_value == "new":
-    # we must copy last.json if it exists as an archived conversation
+    # we must move last.json if it exists to the archive
     # check if last.json exists
     last_log_path = path.join(character_folder, "logs", "last.json")
-    if path.exists(last_log_path):
-        # find a new name for the archived log
-        i = 1
-        while True:
-            archived_log_path = path.join(character_folder, "logs", f"archived_{i}.json")
-            if not path.exists(archived_log_path):
-                break
-            i += 1
-        # copy last.json to archived_{i}.json
-        os.rename(last_log_path, archived_log_path)
+    previous_log = ConversationLog(last_log_path)
+    if path.exists(last_log_path) or path.exists(previous_log.journal_path):
+        previous_log.load(DEFAULT_CONVERSATION)
+        # find a new name for the archived conversation
+        archived_log_name = conversation_archive.next_name(logs_folder)
+        conversation_archive.archive(archived_log_name, previous_log.state)
+        # the log files only go away once the archive has the conversation
+        for log_file_path in [last_log_path, previous_log.journal_path]:
+            if path.exists(log_file_path):
+                os.remove(log_file_path)
+        if conversation_store is not None:
+            conversation_store.rename_session("last.json", archived_log_name)
+            conversation_store.replace_session(archived_log_name, previous_log.state, previous_log.seq)
+    if conversation_store is not None:
+        conversation_store.create_session("last.json")
     conversation_log_value = "last.json"
-# check that last.json exists, if not create an empty one
-last_log_path = path.join(character_folder, "logs", "last.json")
-if not path.exists(last_log_path):
-    with open(last_log_path, "w", encoding="utf-8") as f:
-        f.write('{"history": [], "username": null, "bond": 0.0, "bond_2nd": 0.0, "applied_states": [], "stranger": true, "ran_post_inference_last": true}')
+elif not path.exists(path.join(logs_folder, conversation_log_value)) and conversation_archive.get_session(conversation_log_value) is not None:
+    # going on with an archived conversation, it is a log again until it is archived once more
+    conversation_archive.restore(conversation_log_value, path.join(logs_folder, conversation_log_value + ".json"))
+    if conversation_store is not None:
+        conversation_store.rename_session(conversation_log_value, conversation_log_value + ".json")
+    conversation_log_value += ".json"
 
 conversation_log_path = path.join(character_folder, "logs", conversation_log_value)
-# read the conversation log from json
-chat_history_all = json.load(open(conversation_log_path, "r", encoding="utf-8"))
+
+def sync_conversation_log():
+    """Have the persistence thread commit what the log has pending and wait for it, so the store has every change,
+    the journal write and the store observers never run on the thread that asked"""
+    persistence_worker.mark_dirty("conversation_log", conversation_log.commit)
+    persistence_worker.flush()
+
+# read the conversation log, the snapshot plus whatever the journal recorded after it
+if conversation_store is not None:
+    stored_session = conversation_store.get_session(conversation_log_value)
+    if stored_session is None or stored_session["signature"] != log_signature(conversation_log_path):
+        # the log changed since the store last saw it, parse it once to bring the store up to date
+        changed_log = ConversationLog(conversation_log_path)
+        changed_log.load(DEFAULT_CONVERSATION)
+        conversation_store.replace_session(conversation_log_value, changed_log.state, changed_log.seq, log_signature(conversation_log_path))
+        del changed_log
+    # the store mirrors the journal, so it writes the snapshots and the history is read from it a page at a time
+    conversation_log = ConversationLog(
+        conversation_log_path,
+        write_snapshot=lambda snapshot_path: conversation_store.export_session(conversation_log_value, snapshot_path),
+    )
+    stored_state, stored_seq = conversation_store.load_session(conversation_log_value, with_history=False)
+    stored_state["history"] = PagedHistory(
+        lambda: conversation_store.count_messages(conversation_log_value),
+        lambda start, end: conversation_store.get_messages(conversation_log_value, start, end),
+        # the messages that are not in memory are read from the store, it must have every change first
+        sync=sync_conversation_log,
+        page_size=HISTORY_PAGE_SIZE,
+        resident_pages=HISTORY_RESIDENT_PAGES,
+    )
+    chat_history_all = conversation_log.load(DEFAULT_CONVERSATION, snapshot=(stored_state, stored_seq))
+    # from now on the store gets the same events as the journal
+    conversation_log.observers.append(lambda events: conversation_store.apply_events(conversation_log_value, events))
+    # the other logs are brought in the background, only the ones that changed are read
+    threading.Thread(
+        target=import_json_logs,
+        args=(conversation_store, logs_folder, DEFAULT_CONVERSATION),
+        kwargs={"skip": [conversation_log_value]},
+        daemon=True,
+    ).start()
+else:
+    conversation_log = ConversationLog(conversation_log_path)
+    chat_history_all = conversation_log.load(DEFAULT_CONVERSATION)
 chat_history = chat_history_all["history"]
+
+def is_conversation_message(msg):
+    """User and assistant messages, the bond grows with them, the rest are internal"""
+    return msg["role"] == "user" or msg["role"] == "assistant"
+
+# how many user and assistant messages the history has, kept up to date so counting them never reads the history
+if conversation_store is not None:
+    conversation_message_count = conversation_store.count_messages(conversation_log_value, roles=["user", "assistant"])
+else:
+    conversation_message_count = len([msg for msg in chat_history if is_conversation_message(msg)])
 current_bond_weight = chat_history_all["bond"]
 current_2nd_bond_weight = chat_history_all["bond_2nd"]
 current_applied_states = chat_history_all["applied_states"]
@@ -130,64 +315,81 @@ current_ended = chat_history_all.get("ended", None)
 username = chat_history_all["username"]
 ran_post_inference_last = chat_history_all.get("ran_post_inference_last", False)
 
-visited_locations = chat_history_all.get("visited_locations", [])
+# the same list as in the log, so visiting a location through the log updates it
+visited_locations = chat_history_all.setdefault("visited_locations", [])
 last_requested_location_change = chat_history_all.get("last_requested_location_change", None)
 last_requested_location_change_was_rejected_since_n_inferences = chat_history_all.get("last_requested_location_change_was_rejected_since_n_inferences", 0)
 last_requested_location_change_was_accepted_since_n_inferences = chat_history_all.get("last_requested_location_change_was_accepted_since_n_inferences", 0)
 
 def save_conversation_log():
-    """Save the current chat history to the conversation log file"""
-    with open(conversation_log_path, "w", encoding="utf-8") as f:
-        json.dump(chat_history_all, f, ensure_ascii=False, indent=4)
+    """Write what changed in the conversation since the last save to the journal, in the persistence thread,
+    saves asked for close together end up as a single write"""
+    persistence_worker.mark_dirty("conversation_log", conversation_log.commit)
+    persistence_worker.mark_dirty("token_cache", token_cache.save)
+
+def flush_conversation_log():
+    """Wait until everything saved so far is on disk, used before the process goes away"""
+    persistence_worker.flush()
+    conversation_log.close()
+    if conversation_store is not None:
+        # the store has everything in the log files now, next time it is trusted without parsing them
+        conversation_store.set_signature(conversation_log_value, log_signature(conversation_log_path))
+
+def close_app():
+    """Everything that has to happen before the process goes away"""
+    flush_conversation_log()
+    if emotion_worker is not None:
+        emotion_worker.close()
 
 def update_username(new_username):
     """Update the username in the chat history and save the log"""
-    chat_history_all["username"] = new_username
+    conversation_log.record({"type": FIELDS_UPDATED, "fields": {"username": new_username}})
     save_conversation_log()
 
 def update_bond(new_bond: float, save=True):
     """Update the bond weight in the chat history and save the log"""
-    chat_history_all["bond"] = new_bond
+    conversation_log.record({"type": BOND_UPDATED, "bond": new_bond})
     if save:
         save_conversation_log()
 
 def update_2nd_bond(new_2nd_bond: float, save=True):
     """Update the second bond weight in the chat history and save the log"""
-    chat_history_all["bond_2nd"] = new_2nd_bond
+    conversation_log.record({"type": BOND_UPDATED, "bond_2nd": new_2nd_bond})
     if save:
         save_conversation_log()
 
 def update_applied_states(new_states, save=True):
     """Update the applied states in the chat history and save the log"""
-    chat_history_all["applied_states"] = new_states
+    conversation_log.record({"type": STATES_UPDATED, "applied_states": new_states})
     if save:
         save_conversation_log()
 
 def update_stranger(is_stranger, save=True):
     """Update the stranger status in the chat history and save the log"""
-    chat_history_all["stranger"] = is_stranger
+    conversation_log.record({"type": BOND_UPDATED, "stranger": is_stranger})
     if save:
         save_conversation_log()
 
 def update_ran_post_inference_last(ran_post_inference, save=True):
     """Update the ran_post_inference_last status in the chat history and save the log"""
-    chat_history_all["ran_post_inference_last"] = ran_post_inference
+    conversation_log.record({"type": FIELDS_UPDATED, "fields": {"ran_post_inference_last": ran_post_inference}})
     if save:
         save_conversation_log()
 
 def update_location_change_request(location_change_request, save=True):
     """Update the last requested location change in the chat history and save the log"""
-    chat_history_all["last_requested_location_change"] = location_change_request
-    chat_history_all["last_requested_location_change_was_rejected_since_n_inferences"] = 0
-    chat_history_all["last_requested_location_change_was_accepted_since_n_inferences"] = 0
+    conversation_log.record({"type": FIELDS_UPDATED, "fields": {
+        "last_requested_location_change": location_change_request,
+        "last_requested_location_change_was_rejected_since_n_inferences": 0,
+        "last_requested_location_change_was_accepted_since_n_inferences": 0,
+    }})
     if save:
         save_conversation_log()
 
 def add_visited_location(location, save=True):
     """Add a visited location to the chat history and save the log"""
     if location not in visited_locations:
-        visited_locations.append(location)
-        chat_history_all["visited_locations"] = visited_locations
+        conversation_log.record({"type": LOCATION_VISITED, "location": location})
         if save:
             save_conversation_log()
 
@@ -198,47 +400,222 @@ SYSTEM_PROMPT_EMOTIONS = None
 SYSTEM_PROMPT_STATES = None
 SYSTEM_PROMPT_BONDS = None
 
-CACHE_TOKENS = {}
+# a single connection to the node server shared by every call to the model
+inference_client = InferenceClient("ws://localhost:8000")
+
+# the tokenizer path may be relative to the character folder
+token_counter = create_token_counter(
+    TOKEN_COUNTER,
+    inference_client,
+    model_name=path.basename(model_path),
+    tokenizer_path=path.join(character_folder, TOKENIZER_PATH) if TOKENIZER_PATH else None,
+    characters_per_token=ESTIMATOR_CHARACTERS_PER_TOKEN,
+    safety_margin=ESTIMATOR_SAFETY_MARGIN,
+)
+
+# token counts by content hash, kept in the logs folder so a restarted session starts warm
+token_cache = TokenCountCache(token_counter, path.join(logs_folder, "token_cache.json"))
+token_cache.load()
+
+# used to overlap the post inference analysis calls, they share the single inference connection
+POST_INFERENCE_EXECUTOR = ThreadPoolExecutor(max_workers=3)
+
+# runs the stages of a turn and of the post inference analysis as soon as their inputs are ready
+TURN_PIPELINE_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# optimistic post inference, the turns waiting to be analysed in order and the result waiting to be applied
+POST_INFERENCE_LOCK = threading.Lock()
+POST_INFERENCE_TURNS = deque()
+# optimistic turns whose analysis result wasn't applied yet, queued, running or waiting to be applied,
+# the log only says the post inference ran once there are none, so a restart analyses the ones left
+POST_INFERENCE_UNAPPLIED_TURNS = 0
+PENDING_POST_INFERENCE_RESULT = None
+
+# sampling settings for the analysis calls, we want a more focused response there
+ANALYSIS_SAMPLING_SETTINGS = {
+    "stop": ["<|eot_id|>", "<|start_header_id|>"],
+    "repeat_penalty": 1.0,           # No repeat penalty
+    "frequency_penalty": 0.0,        # No frequency penalty
+    "presence_penalty": 0.0,          # No presence penalty
+    "temperature": 0.8,              # Lower temperature for focused responses
+    "top_p": 0.8,                   # Nucleus sampling
+}
+
+# max tokens of each analysis call follows the lengths observed for it, the given max tokens is the ceiling
+ANALYSIS_TOKEN_BUDGET = AdaptiveTokenBudget()
+
+def run_analysis_generation(prompt, max_tokens, label, json_schema=None, is_decided=None):
+    """Stream a focused analysis generation, returns the response text and the last message received
+    if is_decided is given the generation is cancelled as soon as it says the partial response settles the answer"""
+    # only answers that say when they are settled can be cut short safely, a json answer cut short is invalid
+    adaptive = json_schema is None and is_decided is not None
+    budget = ANALYSIS_TOKEN_BUDGET.get(label, max_tokens) if adaptive else max_tokens
+    while True:
+        action = {
+            "action": "generate",
+            "prompt": prompt,
+            "max_tokens": budget,
+            "stream": True,
+            **ANALYSIS_SAMPLING_SETTINGS,
+        }
+        if is_decided is None:
+            action["frame_interval_ms"] = STREAM_FRAME_INTERVAL_MS
+            action["frame_max_tokens"] = STREAM_FRAME_MAX_TOKENS
+        # otherwise every token comes on its own, so the generation is cancelled at the token that settles it
+        # and not at the end of a frame with more tokens decoded after it
+        if json_schema is not None:
+            # the server constrains the sampling with a grammar so the output is always valid json
+            action["json_schema"] = json_schema
+
+        response = ""
+        last_message = None
+        used_tokens = 0
+        decided = False
+        print(f"{label}: ", end="", flush=True)
+        stream = inference_client.stream(action)
+        for message in stream:
+            last_message = message
+            if message["type"] == "token" or message["type"] == "tokens":
+                text = message["text"]
+                response += text
+                used_tokens += len(message["texts"]) if message["type"] == "tokens" else 1
+                print(text, end="", flush=True)
+                if is_decided is not None and is_decided(response):
+                    decided = True
+                    break
+        # closing the stream early cancels the rest of the generation
+        stream.close()
+        print(" [decided early]" if decided else "")
+
+        if last_message is None or last_message["type"] == "error":
+            return response, last_message
+
+        if adaptive:
+            ANALYSIS_TOKEN_BUDGET.observe(label, used_tokens, budget, decided)
+            # the answer is longer than the recent ones and got cut off, it is run again with the whole budget
+            if not decided and used_tokens >= budget and budget < max_tokens:
+                print(f"{label}: ran out of its budget of {budget} tokens, running it again with {max_tokens}")
+                budget = max_tokens
+                continue
+
+        return response, last_message
+
+def run_classification(prompt, labels, label):
+    """Score the candidate labels for the answer to the prompt, returns the most likely label, its probability
+    and the message received, the label is None and the probability 0 if the classification failed"""
+    response = inference_client.request({
+        "action": "classify",
+        "prompt": prompt,
+        "labels": labels,
+    })
+    if response["type"] == "error":
+        print(f"{label}: error during classification: {response['message']}")
+        return None, 0.0, response
+
+    probabilities = response["probabilities"]
+    best_label = max(probabilities, key=probabilities.get)
+    print(f"{label}: {best_label} ({probabilities[best_label]:.2f} confidence)", probabilities)
+    return best_label, probabilities[best_label], response
+
+def is_classification_confident(answer, confidence, label):
+    """Whether a classified answer can be used, one below CLASSIFICATION_MIN_CONFIDENCE is sampled instead"""
+    if answer is not None and confidence < CLASSIFICATION_MIN_CONFIDENCE:
+        print(f"{label}: {answer} is below the minimum confidence of {CLASSIFICATION_MIN_CONFIDENCE:.2f}, sampling the answer instead.")
+        return False
+    return True
+
+def run_bond_sentiment_classification(prompt):
+    """Classify how the interaction went by label probability, returns the sentiment in the same words
+    the sampled answer would use, how confident it is and the last message received"""
+    # the answer is prefilled so the next token is the sentiment itself, intensity words are shared
+    # by both polarities so those take a second pass to pick the polarity
+    prompt += SENTIMENT_CLASSIFICATION_PREFILL
+    sentiment, confidence, response = run_classification(prompt, SENTIMENT_CLASSIFICATION_LABELS, "Post inference bond classification")
+    if sentiment is None:
+        return "", 0.0, response
+    if sentiment in SENTIMENT_CLASSIFICATION_INTENSITIES:
+        polarity, polarity_confidence, response = run_classification(prompt + " " + sentiment, SENTIMENT_POLARITY_LABELS, "Post inference bond polarity classification")
+        if polarity is None:
+            return "", 0.0, response
+        sentiment += " " + polarity
+        # as sure as the least sure of the two
+        confidence = min(confidence, polarity_confidence)
+    return sentiment, confidence, response
+
 def count_tokens(text):
     """Estimate token count for a given text"""
-    global CACHE_TOKENS
-    if text in CACHE_TOKENS:
-        CACHE_TOKENS[text]["used_in_last_count"] = True
-        return CACHE_TOKENS[text]["value"]
-    
-    # call to webserver to get token count
-    ws = websocket.create_connection("ws://localhost:8000")
-    ws.send(json.dumps({"action": "count_tokens", "text": text}))
-    response = json.loads(ws.recv())
-    ws.close()
+    return token_cache.count(text)
+
+def count_tokens_batch(texts):
+    """Count tokens for every text not in the cache yet using a single request, fills the cache"""
+    return token_cache.count_batch(texts)
+
+def format_history_message(msg):
+    """Format a single history message with the role tags, None for internal messages"""
+    role = msg["role"]
+    content = msg["content"]
+    if role == "user":
+        return f"<|start_header_id|>user<|end_header_id|>\n\n{content}<|eot_id|>"
+    elif role == "assistant":
+        return f"<|start_header_id|>assistant<|end_header_id|>\n\n{content}<|eot_id|>"
+    # internal role
+    return None
+
+# token counts of the formatted history messages and their running sum, kept in step with chat_history,
+# only the last page is indexed at first, the prompts bring in the older messages they can reach
+history_index = HistoryTokenIndex(format_history_message, count_tokens_batch, page_size=HISTORY_PAGE_SIZE)
+history_index.rebuild(chat_history, start=max(0, len(chat_history) - HISTORY_PAGE_SIZE))
+
+def append_history_message(msg):
+    """Add a message at the end of the chat history"""
+    global conversation_message_count
+    conversation_log.record({"type": MESSAGE_APPENDED, "message": msg})
+    history_index.append(msg)
+    if is_conversation_message(msg):
+        conversation_message_count += 1
+
+# index of the first history message kept in the window when using the stable window mode
+WINDOW_START_INDEX = 0
+def select_stable_history_window(history_index, available_tokens):
+    """Keep the window starting at the same message for as long as it fits, when it doesn't
+    evict the oldest messages in one big chunk so the prompt prefix stays the same for many turns"""
+    global WINDOW_START_INDEX
+    start_index = min(WINDOW_START_INDEX, len(history_index))
+    token_count = history_index.tokens_between(start_index)
+
+    if token_count > available_tokens:
+        # free the hysteresis fraction of the window at once instead of one message per turn
+        target_tokens = available_tokens * (1.0 - WINDOW_HYSTERESIS)
+        new_start_index = max(start_index, history_index.window_start(target_tokens))
+        print(f"[Window evicted {new_start_index - start_index} messages, window now starts at message {new_start_index}]", flush=True)
+        start_index = new_start_index
+        token_count = history_index.tokens_between(start_index)
+
+    WINDOW_START_INDEX = start_index
+    return history_index.window_texts(start_index), token_count
+
+LAST_PROMPT_PARTS = []
+LAST_PREFIX_REUSED_TOKENS = 0
+def report_prefix_reuse(prompt_parts):
+    """Report how many tokens at the start of the prompt are the same as in the previous prompt"""
+    global LAST_PROMPT_PARTS
+    global LAST_PREFIX_REUSED_TOKENS
+    prompt_parts = [part for part in prompt_parts if part]
+    reused_tokens = 0
+    for previous_part, part in zip(LAST_PROMPT_PARTS, prompt_parts):
+        if previous_part != part:
+            break
+        reused_tokens += count_tokens(part)
+    total_tokens = sum(count_tokens(part) for part in prompt_parts)
+    LAST_PROMPT_PARTS = prompt_parts
+    LAST_PREFIX_REUSED_TOKENS = reused_tokens
+    print(f"[Prefix reuse: {reused_tokens}/{total_tokens} tokens same as the previous prompt]", flush=True)
 
-    if response["type"] == "error":
-        raise Exception("Failed to count tokens:", response["message"])
-
-    token_count = response["n_tokens"]
-    CACHE_TOKENS[text] = {"value": token_count, "used_in_last_count": True}
-    return token_count
-
-def clean_token_cache():
-    # Remove entries not used in the last count
-    global CACHE_TOKENS
-    keys_to_remove = [key for key, value in CACHE_TOKENS.items() if not value["used_in_last_count"]]
-    for key in keys_to_remove:
-        del CACHE_TOKENS[key]
-
-def prepare_token_cache():
-    # Mark all entries as not used
-    global CACHE_TOKENS
-    for key in CACHE_TOKENS:
-        CACHE_TOKENS[key]["used_in_last_count"] = False
-
-def format_prompt(history, max_context=6000, special_instructions="", special_instructions_in_assistant_space=False):
+def format_prompt(history_index, max_context=6000, special_instructions="", special_instructions_in_assistant_space=False):
     """Format the conversation history with proper role tags for Llama 3.3
     Uses sliding window to keep only recent messages that fit in context.
     Reserves space for system prompt, new message, and response generation.
     """
-    prepare_token_cache()
-
     # Start with system prompt
     combined_system_prompt = SYSTEM_PROMPT + "\n" + SYSTEM_PROMPT_EMOTIONS + "\n" + SYSTEM_PROMPT_STATES + "\n" + SYSTEM_PROMPT_BONDS
     system_part = f"<|start_header_id|>system<|end_header_id|>\n\n{combined_system_prompt}<|eot_id|>"
@@ -252,6 +629,15 @@ def format_prompt(history, max_context=6000, special_instructions="", special_in
         special_instructions_user = f"<|start_header_id|>user<|end_header_id|>\n\n*{special_instructions}*<|eot_id|>"
     elif special_instructions and special_instructions_in_assistant_space:
         assistant_start = f"*{special_instructions}*\n"
+
+    # count every segment we may need in a single round-trip, together with any history message
+    # that changed since the last prompt
+    segments_to_count = [system_part, end_prompt]
+    if special_instructions_user:
+        segments_to_count.append(special_instructions_user)
+    if assistant_start:
+        segments_to_count.append(assistant_start)
+    history_index.refresh(segments_to_count)
     
     # Count tokens for system and user parts (reserve space)
     system_tokens = count_tokens(system_part)
@@ -264,31 +650,18 @@ def format_prompt(history, max_context=6000, special_instructions="", special_in
     
     end_prompt_tokens = count_tokens(end_prompt)
     available_tokens = max_context - system_tokens - special_instructions_user_tokens - end_prompt_tokens - assistant_start_tokens
+    history_index.cover(available_tokens)
     
-    # Build history from most recent messages backwards
-    history_parts = []
-    token_count = 0
-        
-    # Iterate through history in reverse to keep most recent messages
-    for msg in reversed(history):
-        role = msg["role"]
-        content = msg["content"]
-        if role == "user":
-            msg_text = f"<|start_header_id|>user<|end_header_id|>\n\n{content}<|eot_id|>"
-        elif role == "assistant":
-            msg_text = f"<|start_header_id|>assistant<|end_header_id|>\n\n{content}<|eot_id|>"
-        else:
-            #internal role, skip
-            continue
-            
-        msg_tokens = count_tokens(msg_text)
-            
-        # Check if adding this message would exceed available tokens
-        if token_count + msg_tokens > available_tokens:
-            break
-            
-        history_parts.insert(0, msg_text)  # Insert at beginning to maintain order
-        token_count += msg_tokens
+    if WINDOW_MODE == "stable":
+        history_parts, token_count = select_stable_history_window(history_index, available_tokens)
+        window_start = WINDOW_START_INDEX
+    else:
+        # keep the longest run of most recent messages that fits
+        window_start = history_index.window_start(available_tokens)
+        history_parts = history_index.window_texts(window_start)
+        token_count = history_index.tokens_between(window_start)
+    # the messages well before the window don't need to stay indexed
+    history_index.forget_before(window_start)
 
     # wedge special instructions one before history
     if special_instructions_user:
@@ -306,8 +679,8 @@ def format_prompt(history, max_context=6000, special_instructions="", special_in
     # Log token usage
     #total_tokens = system_tokens + token_count + user_tokens
     print(f"[Token usage: {token_count}/{max_context}, kept {len(history_parts)} history messages]", flush=True)
+    report_prefix_reuse([system_part] + history_parts + [end_prompt, assistant_start])
 
-    clean_token_cache()
     
     return prompt
 
@@ -363,7 +736,7 @@ def format_prompt_for_analysis(
 
 # Create QApplication instance before any widgets
 app = QApplication([])
-chat_window = ChatWindow(character_name_value, chat_history, username)
+chat_window = ChatWindow(character_name_value, chat_history, username, history_page_size=HISTORY_PAGE_SIZE)
 
 # display the window
 chat_window.show()
@@ -375,6 +748,8 @@ print("Starting chat with character:", character_name_value)
 
 states_handler = StatesHandler(character_folder)
 emotion_handler = EmotionHandler(character_folder, states_handler.get_all_states())
+# the streamed replies are analysed by it instead of by emotion_handler, see EMOTION_DETECTION
+emotion_worker = EmotionWorker(character_folder, states_handler.get_all_states()) if EMOTION_DETECTION == "process" else None
 bonds_handler = BondsHandler(character_folder)
 bonds_handler.check_against_status(states_handler.get_all_states())
 scenery_handler = SceneryHandler(character_folder, states_handler.get_all_states())
@@ -389,6 +764,8 @@ def prepare_llm():
     bonds_handler.apply_names(character_name_value, chat_window.username)
     states_handler.apply_names(character_name_value, chat_window.username)
     emotion_handler.apply_names(character_name_value, chat_window.username, character_pronouns=character_pronouns_value)
+    if emotion_worker is not None:
+        emotion_worker.apply_names(character_name_value, chat_window.username, character_pronouns=character_pronouns_value)
     scenery_handler.apply_names(character_name_value, chat_window.username)
 
     global SYSTEM_PROMPT_EMOTIONS
@@ -415,25 +792,11 @@ def prepare_llm():
         states_triggered_add = set([])
         states_triggered_discard = set([])
         emotions_triggered = set([])
-        emotion_handler.restart_rolling_emotions()
-        # split the message into words to simuate rolling tokens
+        # the same emotions and states as when the message was streamed, in a single pass over it
         last_emotion = None
-        for word in last_message["content"].split():
-            last_emotion_given, last_states_triggered = emotion_handler.process_rolling_token(word + " ")
-            if last_emotion_given is not None:
-                last_emotion = last_emotion_given
-                emotions_triggered.add(last_emotion_given)
-            for state in last_states_triggered:
-                sign = state[0]
-                state_name = state[1]
-                if sign == "+":
-                    states_triggered_add.add(state_name)
-                    if state_name in states_triggered_discard:
-                        states_triggered_discard.remove(state_name)
-                elif sign == "-":
-                    states_triggered_discard.add(state_name)
-                    if state_name in states_triggered_add:
-                        states_triggered_add.remove(state_name)
+        for last_emotion, last_states_triggered in emotion_handler.analyze_message(last_message["content"]):
+            emotions_triggered.add(last_emotion)
+            merge_triggered_states(last_states_triggered, states_triggered_add, states_triggered_discard)
         if last_emotion is None:
             last_emotion = "neutral"
             print("No emotion detected in previous assistant message, starting with neutral emotion.")
@@ -453,21 +816,28 @@ def prepare_llm():
     # call a http request to the node server to indicate we are ready
     model_path_absolute = path.abspath(model_path)
     
-    # call to webserver to get token count
-    ws = websocket.create_connection("ws://localhost:8000")
-    ws.send(json.dumps({"action": "load_model", "model_path": model_path_absolute}))
-    response = json.loads(ws.recv())
-    ws.close()
+    response = inference_client.request({"action": "load_model", "model_path": model_path_absolute})
 
     if response["type"] == "error":
         chat_window.update_status("Failed to load model.")
         raise Exception("Failed to load model:", response["message"])
 
+    # the model is loaded now, use it once to calibrate the estimator against the real tokenizer
+    if isinstance(token_counter, EstimatorTokenCounter):
+        calibration_texts = [msg["content"] for msg in chat_history[-32:] if msg["role"] == "user" or msg["role"] == "assistant"]
+        if calibration_texts:
+            response = inference_client.request({"action": "count_tokens_batch", "texts": calibration_texts})
+            if response["type"] != "error":
+                token_counter.calibrate(calibration_texts, response["n_tokens"])
+
     chat_window.update_status("Model loaded. Ready to chat!")
 
 def run_inference(user_input, dangling_user_message):
     if not user_input:
         return  # skip empty input
+
+    # an optimistic analysis of an earlier turn may have finished meanwhile
+    apply_pending_post_inference_result()
     
     global bonds_handler
     global current_applied_states
@@ -676,218 +1046,298 @@ def run_inference(user_input, dangling_user_message):
 
     # Update chat history if last message is not from user
     if not dangling_user_message:
-        chat_history.append({"role": "user", "content": user_input})
+        append_history_message({"role": "user", "content": user_input})
         save_conversation_log()
 
     chat_window.character_is_typing()
 
-    scenery_change_was_just_accepted = False
-    scenery_change_was_just_rejected = False
-    scenery_change_wasnt_asked = False
-    is_a_stubboness_repeat = False
-    if last_requested_location_change is not None and last_requested_location_change_was_accepted_since_n_inferences == 0 and last_requested_location_change_was_rejected_since_n_inferences == 0:
-        print(f"Pending scenery change to location: {last_requested_location_change}, performing user acceptance check in order to progress the scenery change.")
-        # we first need to confirm whether the user accepted the location change
-        instructions = scenery_handler.get_system_prompt_for_scenery_change_check()
-        scenery_change_analysis_prompt = format_prompt_for_analysis(
-            chat_history,
-            chat_window.username,
-            character_name_value,
-            "",
-            instructions,
-            scenery_handler.get_system_prompt_confirmation_prompt(last_requested_location_change),
+    # the turn is a graph of stages, each one starts as soon as what it needs is ready, so the
+    # scenery checks, the bond instructions and the history token counting all overlap
+    def check_scenery_acceptance():
+        """Check whether the user accepted the location change the character asked for last turn"""
+        scenery_change_was_just_accepted = False
+        scenery_change_was_just_rejected = False
+        scenery_change_wasnt_asked = False
+        is_a_stubboness_repeat = False
+        if last_requested_location_change is not None and last_requested_location_change_was_accepted_since_n_inferences == 0 and last_requested_location_change_was_rejected_since_n_inferences == 0:
+            print(f"Pending scenery change to location: {last_requested_location_change}, performing user acceptance check in order to progress the scenery change.")
+            # we first need to confirm whether the user accepted the location change
+            instructions = scenery_handler.get_system_prompt_for_scenery_change_check()
+            scenery_change_analysis_prompt = format_prompt_for_analysis(
+                chat_history,
+                chat_window.username,
+                character_name_value,
+                "",
+                instructions,
+                scenery_handler.get_system_prompt_confirmation_prompt(last_requested_location_change),
+            )
+
+            classified = False
+            if CLASSIFICATION_MODE == "logprobs":
+                scenery_change_answer, confidence, _ = run_classification(
+                    scenery_change_analysis_prompt,
+                    SCENERY_CHANGE_CHECK_LABELS,
+                    "Location acceptance classification",
+                )
+                classified = is_classification_confident(scenery_change_answer, confidence, "Location acceptance classification")
+            if not classified:
+                scenery_change_response, _ = run_analysis_generation(
+                    scenery_change_analysis_prompt,
+                    24,
+                    "Location acceptance response",
+                    is_decided=scenery_handler.is_check_response_decided,
+                )
+
+                lowered = scenery_change_response.strip().lower()
+                if "yes" in lowered or "accept" in lowered or "sure" in lowered or "yeah" in lowered or "yep" in lowered:
+                    scenery_change_answer = "yes"
+                elif ("no" in lowered or "reject" in lowered or "not" in lowered or "don't" in lowered or "decline" in lowered) and not (("asked" in lowered) or ("question" in lowered)):
+                    scenery_change_answer = "no"
+                elif ("no" in lowered or "never" in lowered) and (("asked" in lowered) or ("question" in lowered)):
+                    scenery_change_answer = "not_asked"
+                else:
+                    scenery_change_answer = None
+
+            if scenery_change_answer == "yes":
+                # user accepted the location change
+                scenery_change_was_just_accepted = True
+            elif scenery_change_answer == "no":
+                # user rejected the location change
+                scenery_change_was_just_rejected = True
+            elif scenery_change_answer == "not_asked":
+                print("The character was not asked to change location, so we are not already there.")
+                scenery_change_wasnt_asked = True
+            else:
+                print("Could not determine if user accepted or rejected the location change, assuming rejection.")
+                scenery_change_was_just_rejected = True
+
+            is_a_stubboness_repeat = True
+
+        return scenery_change_was_just_accepted, scenery_change_was_just_rejected, scenery_change_wasnt_asked, is_a_stubboness_repeat
+
+    def check_dead_end():
+        return bonds_handler.is_bond_dead_end(
+            current_bond_weight,
+            current_stranger,
         )
 
-        action = {
-            "action": "generate",
-            "prompt": scenery_change_analysis_prompt,
-            "max_tokens": 24,
-            "stream": True,
-            "stop": ["<|eot_id|>", "<|start_header_id|>"],
-
-            # different settings for this as we want a more focused response
-            "repeat_penalty": 1.0,           # No repeat penalty
-            "frequency_penalty": 0.0,        # No frequency penalty
-            "presence_penalty": 0.0,          # No presence penalty
-            "temperature": 0.8,              # Lower temperature for focused responses
-            "top_p": 0.8,                   # Nucleus sampling
-        }
-        ws = websocket.create_connection("ws://localhost:8000")
-        ws.send(json.dumps(action))
+    def get_scenery_change(scenery_change_was_just_accepted, scenery_change_was_just_rejected, scenery_change_wasnt_asked):
+        return scenery_handler.get_prompt_for_scenery_change(
+            visited_locations,
+            last_requested_location_change_was_accepted_since_n_inferences * 2,
+            last_requested_location_change_was_rejected_since_n_inferences * 2,
+            current_applied_states,
+            last_requested_location_change,
+            scenery_change_was_just_accepted,
+            scenery_change_was_just_rejected,
+            scenery_change_wasnt_asked,
+        )
 
-        scenery_change_response = ""
+    def check_scenery_sanity(scenery_change_location, is_a_stubboness_repeat):
+        """Check that we are not already at the location the character is about to ask for"""
+        scenery_change_is_already_there = False
+        if scenery_change_location is not None and not is_a_stubboness_repeat:
+            print(f"Scenery change detected to location: {scenery_change_location} we will do a sanity check to ensure we are not already there")
+
+            sanity_check_prompt = scenery_handler.get_system_prompt_for_scenery_change_sanity_confirmation_check(scenery_change_location)
+            scenery_change_sanity_analysis_prompt = format_prompt_for_analysis(
+                chat_history,
+                chat_window.username,
+                character_name_value,
+                "",
+                sanity_check_prompt,
+                scenery_handler.get_system_prompt_confirmation_sanity_prompt(scenery_change_location),
+                4,
+            )
 
-        next_message = json.loads(ws.recv())
-        print("Location acceptance response: ", end="", flush=True)
-        while next_message["type"] != "done" and next_message["type"] != "error":
-            if next_message["type"] == "token":
-                text = next_message["text"]
-                scenery_change_response += text
-                print(text, end="", flush=True)
-            next_message = json.loads(ws.recv())
-        ws.close()
-        print()
-
-        lowered = scenery_change_response.strip().lower()
-        if "yes" in lowered or "accept" in lowered or "sure" in lowered or "yeah" in lowered or "yep" in lowered:
-            # user accepted the location change
-            scenery_change_was_just_accepted = True
-        elif ("no" in lowered or "reject" in lowered or "not" in lowered or "don't" in lowered or "decline" in lowered) and not (("asked" in lowered) or ("question" in lowered)):
-            # user rejected the location change
-            scenery_change_was_just_rejected = True
-        elif ("no" in lowered or "never" in lowered) and (("asked" in lowered) or ("question" in lowered)):
-            print("The character was not asked to change location, so we are not already there.")
-            scenery_change_wasnt_asked = True
-        else:
-            print("Could not determine if user accepted or rejected the location change, assuming rejection.")
-            scenery_change_was_just_rejected = True
+            classified = False
+            if CLASSIFICATION_MODE == "logprobs":
+                scenery_change_sanity_answer, confidence, _ = run_classification(
+                    scenery_change_sanity_analysis_prompt,
+                    SCENERY_SANITY_CHECK_LABELS,
+                    "Sanity location classification",
+                )
+                classified = is_classification_confident(scenery_change_sanity_answer, confidence, "Sanity location classification")
+            if not classified:
+                scenery_change_sanity_response, _ = run_analysis_generation(
+                    scenery_change_sanity_analysis_prompt,
+                    24,
+                    "Sanity Location Response",
+                    is_decided=scenery_handler.is_sanity_response_decided,
+                )
+
+                lowered = scenery_change_sanity_response.strip().lower()
+                if "yes" in lowered or "accept" in lowered or "sure" in lowered or "yeah" in lowered or "yep" in lowered:
+                    scenery_change_sanity_answer = "yes"
+                elif "no" in lowered or "reject" in lowered or "not" in lowered or "don't" in lowered or "decline" in lowered:
+                    scenery_change_sanity_answer = "no"
+                else:
+                    scenery_change_sanity_answer = None
+
+            if scenery_change_sanity_answer == "yes":
+                print("We are already at the requested location.")
+                scenery_change_is_already_there = True
+            elif scenery_change_sanity_answer == "no":
+                print("We are not already at the requested location.")
+                scenery_change_is_already_there = False
+            else:
+                print("Could not determine if user accepted or rejected the sanity check for location change, assuming we are not already there.")
+                scenery_change_is_already_there = False
 
-        is_a_stubboness_repeat = True
+        return scenery_change_is_already_there
 
-    is_dead_end_due_to_bond = bonds_handler.is_bond_dead_end(
-        current_bond_weight,
-        current_stranger,
-    )
+    def get_bond_instructions():
+        return bonds_handler.get_instructions_for_bond(
+            current_bond_weight,
+            current_2nd_bond_weight,
+            current_applied_states,
+            current_stranger,
+        )
 
-    scenery_change_location, scenery_change_prompt = scenery_handler.get_prompt_for_scenery_change(
-        visited_locations,
-        last_requested_location_change_was_accepted_since_n_inferences * 2,
-        last_requested_location_change_was_rejected_since_n_inferences * 2,
-        current_applied_states,
-        last_requested_location_change,
-        scenery_change_was_just_accepted,
-        scenery_change_was_just_rejected,
-        scenery_change_wasnt_asked,
-    )
+    def count_history_tokens():
+        """Count the new history messages ahead of time so building the prompt doesn't wait on it"""
+        history_index.refresh()
+        return True
 
-    scenery_change_is_already_there = False
-    if scenery_change_location is not None and not is_a_stubboness_repeat:
-        print(f"Scenery change detected to location: {scenery_change_location} we will do a sanity check to ensure we are not already there")
+    def build_prompt(bond_instructions, scenery_change_prompt, scenery_change_is_already_there, scenery_change_wasnt_asked, is_dead_end_due_to_bond, history_token_counted):
+        system_prompt_for_end = bond_instructions + ("" if scenery_change_is_already_there or scenery_change_wasnt_asked else scenery_change_prompt)
 
-        sanity_check_prompt = scenery_handler.get_system_prompt_for_scenery_change_sanity_confirmation_check(scenery_change_location)
-        scenery_change_sanity_analysis_prompt = format_prompt_for_analysis(
-            chat_history,
-            chat_window.username,
-            character_name_value,
-            "",
-            sanity_check_prompt,
-            scenery_handler.get_system_prompt_confirmation_sanity_prompt(scenery_change_location),
-            4,
+        # Format the prompt with history
+        return format_prompt(
+            history_index,
+            max_context=CONTEXT_WINDOW_SIZE - 512,
+            special_instructions=system_prompt_for_end,
+            special_instructions_in_assistant_space=is_dead_end_due_to_bond is not None,
         )
 
+    def generate(prompt):
+        """Generate the response, streaming it to the window"""
+        response = ""
+        emotions_triggered = set([])
+        states_triggered_add = set([])
+        states_triggered_discard = set([])
+
+        # with the worker this thread only forwards the text, the events are merged in order as they come back
+        worker = emotion_worker if emotion_worker is not None and emotion_worker.alive else None
+        if worker is not None:
+            worker.restart()
+        else:
+            emotion_handler.restart_rolling_emotions()
+
+        def apply_emotion_events(events):
+            for emotion_triggered, state_triggered in events:
+                emotions_triggered.add(emotion_triggered)
+                merge_triggered_states(state_triggered, states_triggered_add, states_triggered_discard)
+            # only the last emotion of the frame is shown
+            if events:
+                chat_window.showcase_emotion(events[-1][0])
+
+        def take_over_from_worker(worker):
+            """The worker died in the middle of the reply, the reply so far is analysed again here so the rolling
+            text is the same, only the events the worker didn't give are applied, the rest of the reply is done here"""
+            print(f"The emotion worker died, detecting the emotions of the reply inline from chunk {worker.received_seq + 1}.")
+            emotion_handler.restart_rolling_emotions()
+            for i, chunk in enumerate(worker.chunks):
+                events = emotion_handler.process_rolling_chunk(chunk)
+                if i >= worker.received_seq:
+                    apply_emotion_events(events)
+
+        stop = ["<|eot_id|>", "<|start_header_id|>", f"\n{chat_window.username}:", f"\n{chat_window.username.lower()}:"]
+
         action = {
             "action": "generate",
-            "prompt": scenery_change_sanity_analysis_prompt,
-            "max_tokens": 24,
+            "prompt": prompt,
+            "max_tokens": 512,
             "stream": True,
-            "stop": ["<|eot_id|>", "<|start_header_id|>"],
-
-            # different settings for this as we want a more focused response
-            "repeat_penalty": 1.0,           # No repeat penalty
-            "frequency_penalty": 0.0,        # No frequency penalty
-            "presence_penalty": 0.0,          # No presence penalty
-            "temperature": 0.8,              # Lower temperature for focused responses
-            "top_p": 0.8,                   # Nucleus sampling
+            "stop": stop,
+            "repeat_penalty": REPEAT_PENALTY,           # Penalize repetitions (1.0 = no penalty, higher = more penalty)
+            "frequency_penalty": FREQUENCY_PENALTY,        # Reduce likelihood of frequently used tokens
+            "presence_penalty": PRESENCE_PENALTY,          # Encourage new topics/ideas
+            "temperature": TEMPERATURE,              # Creativity of responses
+            "top_p": TOP_P,                   # Nucleus sampling
+            "max_characters": 1000,            # Limit response length in characters, it will cutoff gracefully at the nearest paragraph
+            "max_paragraphs": 3,               # Limit response length in paragraphs
+            "keep_context": WINDOW_MODE == "stable", # keep the evaluated prompt around so the next turn can reuse its prefix
+            "frame_interval_ms": STREAM_FRAME_INTERVAL_MS, # send the tokens in frames, see STREAM_FRAME_MAX_TOKENS
+            "frame_max_tokens": STREAM_FRAME_MAX_TOKENS,
         }
-        ws = websocket.create_connection("ws://localhost:8000")
-        ws.send(json.dumps(action))
-
-        scenery_change_sanity_response = ""
-
-        next_message = json.loads(ws.recv())
-        print("Sanity Location Response: ", end="", flush=True)
-        while next_message["type"] != "done" and next_message["type"] != "error":
-            if next_message["type"] == "token":
+        next_message = None
+        for next_message in inference_client.stream(action):
+            if next_message["type"] == "token" or next_message["type"] == "tokens":
+                # a frame carries several tokens, the window gets its text once as a whole but the emotions
+                # are detected token by token, the same as when the message is replayed
                 text = next_message["text"]
-                scenery_change_sanity_response += text
+                tokens = next_message["texts"] if next_message["type"] == "tokens" else [text]
+                chat_window.add_character_text(text)
+                if worker is not None:
+                    worker.feed(tokens)
+                    apply_emotion_events(worker.events())
+                    if not worker.alive:
+                        take_over_from_worker(worker)
+                        worker = None
+                else:
+                    apply_emotion_events(emotion_handler.process_rolling_chunk(tokens))
+                response += text
                 print(text, end="", flush=True)
-            next_message = json.loads(ws.recv())
-        ws.close()
-        print()
-
-        lowered = scenery_change_sanity_response.strip().lower()
-        if "yes" in lowered or "accept" in lowered or "sure" in lowered or "yeah" in lowered or "yep" in lowered:
-            # user accepted the location change
-            print("We are already at the requested location.")
-            scenery_change_is_already_there = True
-        elif "no" in lowered or "reject" in lowered or "not" in lowered or "don't" in lowered or "decline" in lowered:
-            # user rejected the location change
-            print("We are not already at the requested location.")
-            scenery_change_is_already_there = False
-        else:
-            print("Could not determine if user accepted or rejected the sanity check for location change, assuming we are not already there.")
-            scenery_change_is_already_there = False
-
-    system_prompt_for_end = bonds_handler.get_instructions_for_bond(
-        current_bond_weight,
-        current_2nd_bond_weight,
-        current_applied_states,
-        current_stranger,
-    ) + ("" if scenery_change_is_already_there or scenery_change_wasnt_asked else scenery_change_prompt)
-    
-    # Format the prompt with history
-    prompt = format_prompt(
-        chat_history,
-        max_context=CONTEXT_WINDOW_SIZE - 512,
-        special_instructions=system_prompt_for_end,
-        special_instructions_in_assistant_space=is_dead_end_due_to_bond is not None,
-    )
-
-    # Generate response
-    response = ""
-    emotion_handler.restart_rolling_emotions()
-    emotions_triggered = set([])
-    states_triggered_add = set([])
-    states_triggered_discard = set([])
-
-    stop = ["<|eot_id|>", "<|start_header_id|>", f"\n{chat_window.username}:", f"\n{chat_window.username.lower()}:"]
-
-    action = {
-        "action": "generate",
-        "prompt": prompt,
-        "max_tokens": 512,
-        "stream": True,
-        "stop": stop,
-        "repeat_penalty": REPEAT_PENALTY,           # Penalize repetitions (1.0 = no penalty, higher = more penalty)
-        "frequency_penalty": FREQUENCY_PENALTY,        # Reduce likelihood of frequently used tokens
-        "presence_penalty": PRESENCE_PENALTY,          # Encourage new topics/ideas
-        "temperature": TEMPERATURE,              # Creativity of responses
-        "top_p": TOP_P,                   # Nucleus sampling
-        "max_characters": 1000,            # Limit response length in characters, it will cutoff gracefully at the nearest paragraph
-        "max_paragraphs": 3,               # Limit response length in paragraphs
-    }
-    ws = websocket.create_connection("ws://localhost:8000")
-    ws.send(json.dumps(action))
-
-    next_message = json.loads(ws.recv())
-    while next_message["type"] != "done" and next_message["type"] != "error":
-        if next_message["type"] == "token":
-            text = next_message["text"]
-            chat_window.add_character_text(text)
-            emotion_triggered, state_triggered = emotion_handler.process_rolling_token(text)
-            if emotion_triggered is not None:
-                chat_window.showcase_emotion(emotion_triggered)
-                emotions_triggered.add(emotion_triggered)
-            for state in state_triggered:
-                sign = state[0]
-                state_name = state[1]
-                if sign == "+":
-                    states_triggered_add.add(state_name)
-                    if state_name in states_triggered_discard:
-                        states_triggered_discard.remove(state_name)
-                elif sign == "-":
-                    states_triggered_discard.add(state_name)
-                    if state_name in states_triggered_add:
-                        states_triggered_add.remove(state_name)
-            response += text
-            print(text, end="", flush=True)
-        next_message = json.loads(ws.recv())
-
-    ws.close()
 
-    if next_message["type"] == "error":
-        chat_window.add_system_text(f"Error during generation: {next_message['message']}")
-        raise Exception("Error during generation: " + next_message["message"])
+        if next_message["type"] == "error":
+            chat_window.add_system_text(f"Error during generation: {next_message['message']}")
+            raise Exception("Error during generation: " + next_message["message"])
+
+        # the turn commits with every event of the reply in it
+        if worker is not None:
+            apply_emotion_events(worker.finish())
+            if worker.received_seq < worker.seq:
+                take_over_from_worker(worker)
+
+        return response, emotions_triggered, states_triggered_add, states_triggered_discard
+
+    turn_pipeline = Pipeline("Turn")
+    turn_pipeline.add_stage(
+        "scenery_acceptance",
+        check_scenery_acceptance,
+        outputs=["scenery_change_was_just_accepted", "scenery_change_was_just_rejected", "scenery_change_wasnt_asked", "is_a_stubboness_repeat"],
+    )
+    turn_pipeline.add_stage("dead_end", check_dead_end, outputs=["is_dead_end_due_to_bond"])
+    turn_pipeline.add_stage(
+        "scenery_change",
+        get_scenery_change,
+        inputs=["scenery_change_was_just_accepted", "scenery_change_was_just_rejected", "scenery_change_wasnt_asked"],
+        outputs=["scenery_change_location", "scenery_change_prompt"],
+    )
+    turn_pipeline.add_stage(
+        "scenery_sanity",
+        check_scenery_sanity,
+        inputs=["scenery_change_location", "is_a_stubboness_repeat"],
+        outputs=["scenery_change_is_already_there"],
+    )
+    turn_pipeline.add_stage("bond_instructions", get_bond_instructions)
+    turn_pipeline.add_stage("history_token_count", count_history_tokens, outputs=["history_token_counted"])
+    turn_pipeline.add_stage(
+        "format_prompt",
+        build_prompt,
+        inputs=["bond_instructions", "scenery_change_prompt", "scenery_change_is_already_there", "scenery_change_wasnt_asked", "is_dead_end_due_to_bond", "history_token_counted"],
+        outputs=["prompt"],
+    )
+    turn_pipeline.add_stage(
+        "generate",
+        generate,
+        inputs=["prompt"],
+        outputs=["response", "emotions_triggered", "states_triggered_add", "states_triggered_discard"],
+    )
+    turn = turn_pipeline.run(TURN_PIPELINE_EXECUTOR)
+    # what the first token waited for
+    turn_pipeline.report("format_prompt")
+
+    response = turn["response"]
+    emotions_triggered = turn["emotions_triggered"]
+    states_triggered_add = turn["states_triggered_add"]
+    states_triggered_discard = turn["states_triggered_discard"]
+    is_dead_end_due_to_bond = turn["is_dead_end_due_to_bond"]
+    scenery_change_location = turn["scenery_change_location"]
+    scenery_change_is_already_there = turn["scenery_change_is_already_there"]
+    scenery_change_was_just_accepted = turn["scenery_change_was_just_accepted"]
+    scenery_change_was_just_rejected = turn["scenery_change_was_just_rejected"]
 
     global LAST_EMOTIONS_TRIGGERED
     global LAST_STATES_TRIGGERED_ADD
@@ -897,15 +1347,17 @@ def run_inference(user_input, dangling_user_message):
     LAST_STATES_TRIGGERED_ADD = states_triggered_add
     LAST_STATES_TRIGGERED_DISCARD = states_triggered_discard
 
-    chat_history.append({"role": "assistant", "content": response.strip()})
+    append_history_message({"role": "assistant", "content": response.strip()})
     ran_post_inference_last = False
-    chat_history_all["ran_post_inference_last"] = ran_post_inference_last
+    update_ran_post_inference_last(ran_post_inference_last, save=False)
+    if POST_INFERENCE_POLICY == "optimistic":
+        queue_post_inference_turn()
 
     if is_dead_end_due_to_bond:
         print(f"End state detected from post inference: {is_dead_end_due_to_bond}")
         ended_readable = states_handler.format_end_state_human_readable(is_dead_end_due_to_bond)
         chat_window.character_finished_typing(ended_readable)
-        chat_history_all["ended"] = ended_readable
+        conversation_log.record({"type": FIELDS_UPDATED, "fields": {"ended": ended_readable}})
         current_ended = ended_readable
         save_conversation_log()
     else:
@@ -925,14 +1377,14 @@ def run_inference(user_input, dangling_user_message):
                 last_requested_location_change_was_rejected_since_n_inferences,
             )
             # add the location as we are already there
-            if not scenery_change_location in visited_locations:
-                visited_locations.append(scenery_change_location)
-                chat_history_all["visited_locations"] = visited_locations
+            add_visited_location(scenery_change_location, save=False)
         else:
             last_requested_location_change_was_accepted_since_n_inferences = 0
-        chat_history_all["last_requested_location_change_was_rejected_since_n_inferences"] = last_requested_location_change_was_rejected_since_n_inferences
-        chat_history_all["last_requested_location_change_was_accepted_since_n_inferences"] = last_requested_location_change_was_accepted_since_n_inferences
-        chat_history_all["last_requested_location_change"] = last_requested_location_change
+        conversation_log.record({"type": FIELDS_UPDATED, "fields": {
+            "last_requested_location_change_was_rejected_since_n_inferences": last_requested_location_change_was_rejected_since_n_inferences,
+            "last_requested_location_change_was_accepted_since_n_inferences": last_requested_location_change_was_accepted_since_n_inferences,
+            "last_requested_location_change": last_requested_location_change,
+        }})
     else:
         if last_requested_location_change_was_rejected_since_n_inferences != 0 or scenery_change_was_just_rejected:
             last_requested_location_change_was_rejected_since_n_inferences += 1
@@ -941,11 +1393,11 @@ def run_inference(user_input, dangling_user_message):
             # so that the counter goes up and the character can request a new change later
             # the character should do at a increased rate because the first time
             last_requested_location_change_was_accepted_since_n_inferences += 1
-            if not last_requested_location_change in visited_locations:
-                visited_locations.append(last_requested_location_change)
-                chat_history_all["visited_locations"] = visited_locations
-        chat_history_all["last_requested_location_change_was_rejected_since_n_inferences"] = last_requested_location_change_was_rejected_since_n_inferences
-        chat_history_all["last_requested_location_change_was_accepted_since_n_inferences"] = last_requested_location_change_was_accepted_since_n_inferences
+            add_visited_location(last_requested_location_change, save=False)
+        conversation_log.record({"type": FIELDS_UPDATED, "fields": {
+            "last_requested_location_change_was_rejected_since_n_inferences": last_requested_location_change_was_rejected_since_n_inferences,
+            "last_requested_location_change_was_accepted_since_n_inferences": last_requested_location_change_was_accepted_since_n_inferences,
+        }})
 
     save_conversation_log()
 
@@ -953,39 +1405,28 @@ def run_inference(user_input, dangling_user_message):
 def edit_message(index, new_content):
     """Edit a message in the chat history and save the log"""
     if 0 <= index < len(chat_history):
-        chat_history[index]["content"] = new_content
+        conversation_log.record({"type": MESSAGE_EDITED, "index": index, "content": new_content})
+        history_index.edit(index, chat_history[index])
         save_conversation_log()
 
 def delete_message(index):
     """Delete a message from the chat history and save the log"""
+    global WINDOW_START_INDEX
+    global conversation_message_count
     if 0 <= index < len(chat_history):
-        del chat_history[index]
+        if is_conversation_message(chat_history[index]):
+            conversation_message_count -= 1
+        conversation_log.record({"type": MESSAGE_DELETED, "index": index})
+        history_index.delete(index)
+        # the stable window keeps starting at the same message
+        if index < WINDOW_START_INDEX:
+            WINDOW_START_INDEX -= 1
         save_conversation_log()
 
-def run_post_inference():
-    """Function to run after inference is complete (if needed)"""
-
-    print("Running post inference analysis...")
-
-    global LAST_EMOTIONS_TRIGGERED
-    global LAST_STATES_TRIGGERED_ADD
-    global LAST_STATES_TRIGGERED_DISCARD
-    global current_bond_weight
-    global current_2nd_bond_weight
-    global current_stranger
-    global current_applied_states
-    global ran_post_inference_last
-
-    special_user_message_regarding_bonds = "*" + bonds_handler.get_instructions_for_bond(
-        current_bond_weight,
-        current_2nd_bond_weight,
-        current_applied_states,
-        current_stranger,
-        for_bond_change=True,
-    ) + "*"
-
+def run_separate_post_inference_analysis(turn, special_user_message_regarding_bonds):
+    """Run the bond, 2nd bond and states analysis as separate calls, one after the other or overlapped"""
     post_bond_analysis_prompt = format_prompt_for_analysis(
-        chat_history,
+        turn["history"],
         chat_window.username,
         character_name_value,
         special_user_message_regarding_bonds,
@@ -993,96 +1434,84 @@ def run_post_inference():
         bonds_handler.get_post_inference_confirmation_prompt(),
     )
 
-    # we will start a streaming request to the server
-    action = {
-        "action": "generate",
-        "prompt": post_bond_analysis_prompt,
-        "max_tokens": 24,
-        "stream": True,
-        "stop": ["<|eot_id|>", "<|start_header_id|>"],
-
-        # different settings for this as we want a more focused response
-        "repeat_penalty": 1.0,           # No repeat penalty
-        "frequency_penalty": 0.0,        # No frequency penalty
-        "presence_penalty": 0.0,          # No presence penalty
-        "temperature": 0.8,              # Lower temperature for focused responses
-        "top_p": 0.8,                   # Nucleus sampling
-    }
-    ws = websocket.create_connection("ws://localhost:8000")
-    ws.send(json.dumps(action))
-
-    post_inference_bonds_response = ""
-
-    next_message = json.loads(ws.recv())
-    print("Post inference bond response: ", end="", flush=True)
-    while next_message["type"] != "done" and next_message["type"] != "error":
-        if next_message["type"] == "token":
-            text = next_message["text"]
-            post_inference_bonds_response += text
-            print(text, end="", flush=True)
-        next_message = json.loads(ws.recv())
-    ws.close()
-    print()
-
-    if next_message["type"] == "error":
-        chat_window.add_system_text(f"Error during post processing: {next_message['message']}", postinference_thread=True)
-        raise Exception("Error during post processing: " + next_message["message"])
-    
-    expected_bond_change = bonds_handler.analyze_response_for_bond_change(
-        post_inference_bonds_response,
-    )
-    
-    # second bond calculation
-    can_ascend_2nd_bond = bonds_handler.can_ascend_2nd_bond(
-        current_bond_weight,
-        current_2nd_bond_weight,
-        current_stranger,
-        expected_bond_change,
+    post_inference_state_prompt = format_prompt_for_analysis(
+        turn["history"],
+        chat_window.username,
+        character_name_value,
+        special_user_message_regarding_bonds,
+        states_handler.get_post_inference_system_instructions(),
+        states_handler.get_post_inference_confirmation_prompt(),
     )
 
-    second_bond_change = 0
-    if can_ascend_2nd_bond:
-        print("Second bond can be ascended based on current bond and expected bond change, the change is: ", expected_bond_change)
+    # the 2nd bond questions only matter if the bond change turns out positive, but the prompt
+    # itself only depends on the current bond so it can be prepared (and started) right away
+    post_2nd_bond_analysis_prompt = None
+    ascent_question_count = 0
+    if bonds_handler.has_2nd_bond_ascent_rules(turn["bond"], turn["bond_2nd"], turn["stranger"]):
+        ascent_question_count = len(bonds_handler.get_2nd_bond_ascent_questions(turn["bond"], turn["bond_2nd"], turn["stranger"]))
         post_2nd_bond_analysis_prompt = format_prompt_for_analysis(
-            chat_history,
+            turn["history"],
             chat_window.username,
             character_name_value,
             special_user_message_regarding_bonds,
             bonds_handler.get_2nd_bond_post_inference_system_instructions(),
-            bonds_handler.get_2nd_bond_post_inference_confirmation_prompt(current_bond_weight, current_2nd_bond_weight, current_stranger),
+            bonds_handler.get_2nd_bond_post_inference_confirmation_prompt(turn["bond"], turn["bond_2nd"], turn["stranger"]),
         )
 
-        # we will start a streaming request to the server
-        action = {
-            "action": "generate",
-            "prompt": post_2nd_bond_analysis_prompt,
-            "max_tokens": 24,
-            "stream": True,
-            "stop": ["<|eot_id|>", "<|start_header_id|>"],
-
-            # different settings for this as we want a more focused response
-            "repeat_penalty": 1.0,           # No repeat penalty
-            "frequency_penalty": 0.0,        # No frequency penalty
-            "presence_penalty": 0.0,          # No presence penalty
-            "temperature": 0.8,              # Lower temperature for focused responses
-            "top_p": 0.8,                   # Nucleus sampling
-        }
-        ws = websocket.create_connection("ws://localhost:8000")
-        ws.send(json.dumps(action))
+    def is_2nd_bond_response_decided(response):
+        return bonds_handler.is_2nd_bond_response_decided(response, ascent_question_count)
+
+    def analyze_bond_sentiment():
+        classified = False
+        if CLASSIFICATION_MODE == "logprobs":
+            post_inference_bonds_response, confidence, next_message = run_bond_sentiment_classification(post_bond_analysis_prompt)
+            classified = is_classification_confident(post_inference_bonds_response or None, confidence, "Post inference bond classification")
+        if not classified:
+            post_inference_bonds_response, next_message = run_analysis_generation(
+                post_bond_analysis_prompt,
+                24,
+                "Post inference bond response",
+                is_decided=bonds_handler.is_post_inference_response_decided,
+            )
+
+        if next_message["type"] == "error":
+            chat_window.add_system_text(f"Error during post processing: {next_message['message']}", postinference_thread=True)
+            raise Exception("Error during post processing: " + next_message["message"])
+        
+        return bonds_handler.analyze_response_for_bond_change(
+            post_inference_bonds_response,
+        )
 
-        post_inference_2nd_bonds_response = ""
+    def check_2nd_bond_ascent(expected_bond_change):
+        # second bond calculation
+        can_ascend_2nd_bond = bonds_handler.can_ascend_2nd_bond(
+            turn["bond"],
+            turn["bond_2nd"],
+            turn["stranger"],
+            expected_bond_change,
+        )
+        if can_ascend_2nd_bond:
+            print("Second bond can be ascended based on current bond and expected bond change, the change is: ", expected_bond_change)
+        return can_ascend_2nd_bond
+
+    def answer_2nd_bond_questions(can_ascend_2nd_bond=True):
+        if post_2nd_bond_analysis_prompt is None or not can_ascend_2nd_bond:
+            return None
+        return run_analysis_generation(
+            post_2nd_bond_analysis_prompt,
+            24,
+            "Post inference 2nd bond response",
+            is_decided=is_2nd_bond_response_decided,
+        )
 
-        next_message = json.loads(ws.recv())
-        print("Post inference 2nd bond response: ", end="", flush=True)
-        while next_message["type"] != "done" and next_message["type"] != "error":
-            if next_message["type"] == "token":
-                text = next_message["text"]
-                post_inference_2nd_bonds_response += text
-                print(text, end="", flush=True)
-            next_message = json.loads(ws.recv())
-        ws.close()
-        print()
+    def analyze_2nd_bond_change(can_ascend_2nd_bond, post_inference_2nd_bonds_result):
+        if not can_ascend_2nd_bond:
+            print("Second bond cannot be ascended based on current bond and expected bond change, skipping analysis.")
+            if post_inference_2nd_bonds_result is not None:
+                print("Discarding the speculative 2nd bond analysis.")
+            return 0
 
+        post_inference_2nd_bonds_response, next_message = post_inference_2nd_bonds_result
         if next_message["type"] == "error":
             chat_window.add_system_text(f"Error during post processing: {next_message['message']}", postinference_thread=True)
             raise Exception("Error during post processing: " + next_message["message"])
@@ -1091,91 +1520,272 @@ def run_post_inference():
             post_inference_2nd_bonds_response,
         )
         print("Second bond change analyzed as: ", second_bond_change)
-    else:
-        print("Second bond cannot be ascended based on current bond and expected bond change, skipping analysis.")
-    
-    post_inference_state_prompt = format_prompt_for_analysis(
-        chat_history,
+        return second_bond_change
+
+    def analyze_states():
+        post_inference_state_response, _ = run_analysis_generation(
+            post_inference_state_prompt,
+            64,
+            "Post inference state response",
+            is_decided=states_handler.is_post_inference_response_decided,
+        )
+        return states_handler.analyze_response_for_states(
+            post_inference_state_response,
+        )
+
+    # concurrent mode overlaps the calls, and starts the 2nd bond questions speculatively without waiting to
+    # know if they will be needed, sequential runs the stages one by one in the order they are added
+    concurrent = POST_INFERENCE_MODE == "concurrent"
+    analysis_pipeline = Pipeline("Post inference")
+    analysis_pipeline.add_stage("bond_sentiment", analyze_bond_sentiment, outputs=["expected_bond_change"])
+    analysis_pipeline.add_stage("2nd_bond_ascent", check_2nd_bond_ascent, inputs=["expected_bond_change"], outputs=["can_ascend_2nd_bond"])
+    analysis_pipeline.add_stage(
+        "2nd_bond_answers",
+        answer_2nd_bond_questions,
+        inputs=[] if concurrent else ["can_ascend_2nd_bond"],
+        outputs=["post_inference_2nd_bonds_result"],
+    )
+    analysis_pipeline.add_stage(
+        "2nd_bond_change",
+        analyze_2nd_bond_change,
+        inputs=["can_ascend_2nd_bond", "post_inference_2nd_bonds_result"],
+        outputs=["second_bond_change"],
+    )
+    analysis_pipeline.add_stage(
+        "states",
+        analyze_states,
+        outputs=["new_applied_states_add", "new_applied_states_decrease", "new_applied_states_remove"],
+    )
+    analysis = analysis_pipeline.run(POST_INFERENCE_EXECUTOR if concurrent else None)
+    analysis_pipeline.report()
+
+    return (
+        analysis["expected_bond_change"],
+        analysis["second_bond_change"],
+        analysis["new_applied_states_add"],
+        analysis["new_applied_states_decrease"],
+        analysis["new_applied_states_remove"],
+    )
+
+def run_combined_post_inference_analysis(turn, special_user_message_regarding_bonds):
+    """Run the bond, 2nd bond and states analysis as a single call whose output is constrained to a json schema
+    so the transcript is only sent and evaluated once"""
+    # the questions are only asked if there are any, they are only used if the bond change turns out positive
+    ascent_questions = []
+    if bonds_handler.has_2nd_bond_ascent_rules(turn["bond"], turn["bond_2nd"], turn["stranger"]):
+        ascent_questions = bonds_handler.get_2nd_bond_ascent_questions(turn["bond"], turn["bond_2nd"], turn["stranger"])
+
+    properties = bonds_handler.get_structured_post_inference_schema()
+    instructions = [bonds_handler.get_structured_post_inference_instructions()]
+    if ascent_questions:
+        properties.update(bonds_handler.get_structured_2nd_bond_schema(ascent_questions))
+        instructions.append(bonds_handler.get_structured_2nd_bond_instructions(ascent_questions))
+    properties.update(states_handler.get_structured_post_inference_schema())
+    instructions.append(states_handler.get_structured_post_inference_instructions())
+    json_schema = {
+        "type": "object",
+        "properties": properties,
+    }
+
+    system_prompt = f"You are an assistant that analyses conversations between {character_name_value} and {chat_window.username}. " + \
+        "You MUST respond with a JSON object with the following fields:\n\n" + "\n\n".join(instructions)
+
+    post_combined_analysis_prompt = format_prompt_for_analysis(
+        turn["history"],
         chat_window.username,
         character_name_value,
         special_user_message_regarding_bonds,
-        states_handler.get_post_inference_system_instructions(),
-        states_handler.get_post_inference_confirmation_prompt(),
+        system_prompt,
+        "Your analysis (output ONLY the JSON object):",
     )
 
-     # we will start a streaming request to the server
-    action = {
-        "action": "generate",
-        "prompt": post_inference_state_prompt,
-        "max_tokens": 64,
-        "stream": True,
-        # default ones
-        "stop": ["<|eot_id|>", "<|start_header_id|>"],
-
-        # different settings for this as we want a more focused response
-        "repeat_penalty": 1.0,           # No repeat penalty
-        "frequency_penalty": 0.0,        # No frequency penalty
-        "presence_penalty": 0.0,          # No presence penalty
-        "temperature": 0.8,              # Lower temperature for focused responses
-        "top_p": 0.8,                   # Nucleus sampling
-    }
-    ws = websocket.create_connection("ws://localhost:8000")
-    ws.send(json.dumps(action))
-
-    post_inference_state_response = ""
-
-    next_message = json.loads(ws.recv())
-    print("Post inference state response: ", end="", flush=True)
-    while next_message["type"] != "done" and next_message["type"] != "error":
-        if next_message["type"] == "token":
-            text = next_message["text"]
-            post_inference_state_response += text
-            print(text, end="", flush=True)
-        next_message = json.loads(ws.recv())
-    print()
-    ws.close()
-
-    new_applied_states_add, new_applied_states_decrease, new_applied_states_remove = states_handler.analyze_response_for_states(
-        post_inference_state_response,
+    post_inference_combined_response, next_message = run_analysis_generation(
+        post_combined_analysis_prompt,
+        192,
+        "Post inference combined response",
+        json_schema=json_schema,
     )
 
+    if next_message["type"] == "error":
+        chat_window.add_system_text(f"Error during post processing: {next_message['message']}", postinference_thread=True)
+        raise Exception("Error during post processing: " + next_message["message"])
+
+    try:
+        analysis = json.loads(post_inference_combined_response)
+    except json.JSONDecodeError:
+        # only happens if the generation was cut by max tokens, every field then falls back to neutral
+        print("Warning: Could not parse the combined post inference response, defaulting to neutral.")
+        analysis = {}
+
+    expected_bond_change = bonds_handler.get_bond_change_from_structured_analysis(analysis)
+
+    second_bond_change = 0
+    if ascent_questions and bonds_handler.can_ascend_2nd_bond(
+        turn["bond"],
+        turn["bond_2nd"],
+        turn["stranger"],
+        expected_bond_change,
+    ):
+        second_bond_change = bonds_handler.get_2nd_bond_change_from_structured_analysis(analysis)
+        print("Second bond change analyzed as: ", second_bond_change)
+
+    new_applied_states_add, new_applied_states_decrease, new_applied_states_remove = states_handler.analyze_structured_analysis_for_states(analysis)
+
+    return expected_bond_change, second_bond_change, new_applied_states_add, new_applied_states_decrease, new_applied_states_remove
+
+def get_committed_post_inference_state():
+    """Return the bond and states the next analysis builds upon, a result still waiting to be applied counts as committed"""
+    if PENDING_POST_INFERENCE_RESULT is not None:
+        return dict(PENDING_POST_INFERENCE_RESULT)
+    return {
+        "bond": current_bond_weight,
+        "bond_2nd": current_2nd_bond_weight,
+        "stranger": current_stranger,
+        "applied_states": current_applied_states,
+    }
+
+def snapshot_post_inference_turn():
+    """Copy what the analysis of the turn that just finished needs, so the next turn can go on meanwhile"""
+    return {
+        # the analysis only looks at the last messages, copying a page of them is plenty
+        "history": [dict(msg) for msg in chat_history[-HISTORY_PAGE_SIZE:]],
+        "message_count": conversation_message_count,
+        "states_triggered_add": set(LAST_STATES_TRIGGERED_ADD),
+        "states_triggered_discard": set(LAST_STATES_TRIGGERED_DISCARD),
+    }
+
+def queue_post_inference_turn():
+    """Keep the snapshot of the turn that just finished until its analysis gets to run"""
+    global POST_INFERENCE_UNAPPLIED_TURNS
+    with POST_INFERENCE_LOCK:
+        POST_INFERENCE_TURNS.append(snapshot_post_inference_turn())
+        POST_INFERENCE_UNAPPLIED_TURNS += 1
+
+def apply_pending_post_inference_result():
+    """Apply the result of an optimistic analysis that finished since the last turn started"""
+    global PENDING_POST_INFERENCE_RESULT
+    with POST_INFERENCE_LOCK:
+        result = PENDING_POST_INFERENCE_RESULT
+        PENDING_POST_INFERENCE_RESULT = None
+        if result is not None:
+            print("Applying post inference result from the previous turn.")
+            apply_post_inference_result(result)
+
+def apply_post_inference_result(result):
+    """Commit the bond and states resulting from the analysis and save the log"""
+    global current_bond_weight
+    global current_2nd_bond_weight
+    global current_stranger
+    global current_applied_states
+    global ran_post_inference_last
+    global POST_INFERENCE_UNAPPLIED_TURNS
+
+    update_bond(result["bond"], save=False)
+    update_2nd_bond(result["bond_2nd"], save=False)
+    update_stranger(result["stranger"], save=False)
+    update_applied_states(result["applied_states"], save=False)
+    # a later turn that is still waiting for its analysis keeps it off
+    POST_INFERENCE_UNAPPLIED_TURNS = max(0, POST_INFERENCE_UNAPPLIED_TURNS - 1)
+    ran_post_inference_last = POST_INFERENCE_UNAPPLIED_TURNS == 0
+    update_ran_post_inference_last(ran_post_inference_last, save=False)
+    current_bond_weight = result["bond"]
+    current_2nd_bond_weight = result["bond_2nd"]
+    current_stranger = result["stranger"]
+    current_applied_states = result["applied_states"]
+
+    save_conversation_log()
+
+def compute_post_inference_result(turn):
+    """Run the analysis of the turn and calculate the bond and states that result from it"""
+    special_user_message_regarding_bonds = "*" + bonds_handler.get_instructions_for_bond(
+        turn["bond"],
+        turn["bond_2nd"],
+        turn["applied_states"],
+        turn["stranger"],
+        for_bond_change=True,
+    ) + "*"
+
+    if POST_INFERENCE_MODE == "combined":
+        analysis = run_combined_post_inference_analysis(turn, special_user_message_regarding_bonds)
+    else:
+        analysis = run_separate_post_inference_analysis(turn, special_user_message_regarding_bonds)
+    expected_bond_change, second_bond_change, new_applied_states_add, new_applied_states_decrease, new_applied_states_remove = analysis
+
     new_applied_states = states_handler.get_next_applying_states(
-        current_applied_states,
+        turn["applied_states"],
         new_applied_states_add,
         new_applied_states_decrease,
         new_applied_states_remove,
-        LAST_STATES_TRIGGERED_ADD,
-        LAST_STATES_TRIGGERED_DISCARD,
+        turn["states_triggered_add"],
+        turn["states_triggered_discard"],
     )
 
     # calculate bond and states changes
     mini_bonuses = states_handler.get_mini_bonuses(new_applied_states)
     new_bond, new_2nd_bond, new_stranger = bonds_handler.calculate_bond_change(
-        current_bond_weight,
-        current_2nd_bond_weight,
-        current_stranger,
-        len([msg for msg in chat_history if msg["role"] == "user" or msg["role"] == "assistant"]),
+        turn["bond"],
+        turn["bond_2nd"],
+        turn["stranger"],
+        turn["message_count"],
         expected_bond_change,
         second_bond_change,
         mini_bonuses,
     )
 
-    print(f"Updated bond: {current_bond_weight}|{current_2nd_bond_weight} -> {new_bond}|{new_2nd_bond}, stranger: {current_stranger} -> {new_stranger}, applied states: {current_applied_states} -> {new_applied_states}, bond mini bonuses: {mini_bonuses}")
+    print(f"Updated bond: {turn['bond']}|{turn['bond_2nd']} -> {new_bond}|{new_2nd_bond}, stranger: {turn['stranger']} -> {new_stranger}, applied states: {turn['applied_states']} -> {new_applied_states}, bond mini bonuses: {mini_bonuses}")
 
-    update_bond(new_bond, save=False)
-    update_2nd_bond(new_2nd_bond, save=False)
-    update_stranger(new_stranger, save=False)
-    update_applied_states(new_applied_states, save=False)
-    update_ran_post_inference_last(True, save=False)
-    ran_post_inference_last = True
-    current_bond_weight = new_bond
-    current_2nd_bond_weight = new_2nd_bond
-    current_stranger = new_stranger
-    current_applied_states = new_applied_states
+    return {
+        "bond": new_bond,
+        "bond_2nd": new_2nd_bond,
+        "stranger": new_stranger,
+        "applied_states": new_applied_states,
+    }
+
+def run_post_inference():
+    """Function to run after inference is complete (if needed)"""
+
+    print("Running post inference analysis...")
+
+    global PENDING_POST_INFERENCE_RESULT
+    global POST_INFERENCE_UNAPPLIED_TURNS
+
+    if POST_INFERENCE_POLICY == "optimistic":
+        # the next turn may already be generating with the last committed state, so the result is kept aside
+        # and applied when the turn after starts, the runs come in order so each one builds on the previous result
+        with POST_INFERENCE_LOCK:
+            if POST_INFERENCE_TURNS:
+                turn = POST_INFERENCE_TURNS.popleft()
+            else:
+                # e.g. the last turn of the previous session, it wasn't queued so it's counted here
+                turn = snapshot_post_inference_turn()
+                POST_INFERENCE_UNAPPLIED_TURNS += 1
+            turn.update(get_committed_post_inference_state())
+        result = compute_post_inference_result(turn)
+        with POST_INFERENCE_LOCK:
+            if PENDING_POST_INFERENCE_RESULT is not None:
+                # this result builds on the one that wasn't applied yet, so applying it covers both turns
+                POST_INFERENCE_UNAPPLIED_TURNS -= 1
+            PENDING_POST_INFERENCE_RESULT = result
+        print("Post inference result will be applied on the next turn.")
+        return
+
+    turn = {
+        "history": chat_history,
+        "message_count": conversation_message_count,
+        "states_triggered_add": LAST_STATES_TRIGGERED_ADD,
+        "states_triggered_discard": LAST_STATES_TRIGGERED_DISCARD,
+        **get_committed_post_inference_state(),
+    }
+    apply_post_inference_result(compute_post_inference_result(turn))
 
+# the log keeps which policy its results came from, it can only change between sessions
+if chat_history_all.get("post_inference_policy") != POST_INFERENCE_POLICY:
+    conversation_log.record({"type": FIELDS_UPDATED, "fields": {"post_inference_policy": POST_INFERENCE_POLICY}})
     save_conversation_log()
 
 # Start the chat
+chat_window.set_post_inference_policy(POST_INFERENCE_POLICY)
+chat_window.set_close_function(close_app)
 chat_window.run(
     current_ended,
     ran_post_inference_last,